@@ -1,20 +1,27 @@
 # LangChain RAG & Agent Architecture Implementation
 import os
 import json
+import threading
 import warnings
 import time
-from datetime import datetime, timedelta
-from typing import List
+from functools import lru_cache
+from typing import TYPE_CHECKING, Callable, List
 from pathlib import Path
 from dotenv import load_dotenv
-from groq import Groq
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain.memory.summary_buffer import ConversationSummaryBufferMemory 
 from ..utils.email_sample import EmailSample
-from langchain.schema import Document
-from langchain_community.vectorstores import FAISS
-from langchain_groq import ChatGroq
-from langchain.chains import ConversationChain
+from ..utils.email_store import EmailStore
+from .seen_index import SeenIdIndex
+from .query_cache import LRUCache, normalize_query
+from .rate_limiter import Reservation, shared_scheduler
+from .rw_lock import ReadWriteLock
+from .token_counter import TokenCounter, tokenizer_for_model
+
+# LangChain, Groq, HuggingFace and FAISS take seconds to import; they are imported where they are
+# first used, normally on the warm-up thread, so that the prompt is shown while they load
+if TYPE_CHECKING:
+    from langchain_core.documents import Document
+    from .segmented_store import SegmentedVectorStore
+
 # Suppress warnings
 warnings.filterwarnings("ignore", category=DeprecationWarning)
 warnings.filterwarnings("ignore", message=".*tokenizers.*")
@@ -23,7 +30,25 @@ os.environ["TOKENIZERS_PARALLELISM"] = "false"
 # Load configuration
 load_dotenv(dotenv_path=".env")
 CONFIG_DIR = os.getenv("CONFIG_DIR")
-RULES_AGENTS = json.loads(Path(CONFIG_DIR, "rules_agents.json").read_text(encoding="utf-8"))
+
+
+@lru_cache(maxsize=1)
+def load_rules_agents() -> list:
+    """Agent rules from rules_agents.json, read on first use."""
+    return json.loads(Path(CONFIG_DIR, "rules_agents.json").read_text(encoding="utf-8"))
+
+
+PROMPT_TEMPLATE = """
+You are a helpful email assistant.
+system_prompt: 
+{system_prompt}
+
+user_input: 
+{user_input}
+
+Reference the following email materials:
+{email_content}
+        """
 
 class tools:
     """
@@ -40,143 +65,750 @@ class tools:
     
 class BaseAgent:
     """RAG + Agent architecture based on LangChain"""
-    def __init__(self, model_name: str = None):
+    def __init__(self, model_name: str = None, stream: bool = True, quiet: bool = False, background: bool = True):
+        """
+        stream: print the response token by token as it arrives
+        quiet: do not echo the full prompt on every turn
+        background: load the models and the FAISS index on a warm-up thread; call wait_until_ready()
+            (chat_loop does) before using them. With False they are loaded before __init__ returns.
+        """
         # Validate required environment variables
-        groq_api_key = os.getenv("GROQ_API_KEY")
-        if not groq_api_key:
+        # LLM_BACKEND=stub answers with a canned reply instead of calling Groq, for local testing
+        self.llm_backend = os.getenv("LLM_BACKEND") or "groq"
+        self.__groq_api_key = os.getenv("GROQ_API_KEY")
+        if not self.__groq_api_key and self.llm_backend != "stub":
             raise ValueError("GROQ_API_KEY environment variable is required")
         
-        embedding_model_name = os.getenv("EMBEDDING_MODEL_NAME")
-        if not embedding_model_name:
+        self.embedding_model_name = os.getenv("EMBEDDING_MODEL_NAME")
+        if not self.embedding_model_name:
             # Use a default embedding model if not specified
-            embedding_model_name = "all-MiniLM-L6-v2"
-            print(f"Warning: EMBEDDING_MODEL_NAME not set, using default: {embedding_model_name}")
+            self.embedding_model_name = "all-MiniLM-L6-v2"
+            print(f"Warning: EMBEDDING_MODEL_NAME not set, using default: {self.embedding_model_name}")
         
-        self.__client = Groq(api_key=groq_api_key)
         self.model_name = os.getenv("LLAMA3_8B") or os.getenv("MODEL_DEEPSEEK1")
         if not self.model_name:
             raise ValueError("Either LLAMA3_8B or MODEL_DEEPSEEK1 environment variable is required")
         
-        self.model = ChatGroq(model=self.model_name, api_key=groq_api_key, temperature=0.8)
-        self.embeddings = HuggingFaceEmbeddings(model_name=embedding_model_name, model_kwargs={"device": "cpu"})
-        self.memory = ConversationSummaryBufferMemory(llm=self.model, max_token_limit=2000)
-        self.conversation_chain = ConversationChain(llm=self.model, memory=self.memory, verbose=True)
-        self.rag_retriever = self._init_rag_retriever()
-        self.saved_emails = {"id": []}
+        # Query vectors and retrieval results are cached per normalized question
+        query_cache_size = int(os.getenv("QUERY_CACHE_SIZE") or 1024)
+        query_cache_ttl = float(os.getenv("QUERY_CACHE_TTL") or 600)
+        self.query_vector_cache = LRUCache(query_cache_size, query_cache_ttl)
+        self.retrieval_cache = LRUCache(query_cache_size, query_cache_ttl)
+        # LLM token counts for rate budgeting; chunk counts are stored at ingest and summed per prompt
+        self.token_counter = TokenCounter(
+            os.getenv("LLM_TOKENIZER") or tokenizer_for_model(self.model_name),
+            approximate=os.getenv("TOKEN_COUNT_MODE", "").lower() == "approximate",
+        )
+        self.stream = stream
+        self.quiet = quiet or os.getenv("AGENT_QUIET", "").lower() in ("1", "true", "yes")
+        self.turn_latencies = []
+        self.email_store = EmailStore()
+        self.seen_ids = SeenIdIndex(
+            Path(CONFIG_DIR, "ljs_columbia_email_saved.log"),
+            legacy_json=Path(CONFIG_DIR, "ljs_columbia_email_saved.json"),
+        )
+        # ANN index used when a new index is built; see index_factory.INDEX_TYPES
+        self.index_config = {
+            "index_type": os.getenv("FAISS_INDEX_TYPE") or "flat",
+            "nprobe": int(os.getenv("FAISS_NPROBE") or 0) or None,
+            "ef_search": int(os.getenv("FAISS_EF_SEARCH") or 0) or None,
+        }
         self.new_emails = []
-        self.token_limit_per_minute = 6000
-        self.token_spent_per_minute = 0
-        self.query_time = datetime.min
+        # Provider quota shared by every agent in the process that uses the same model
+        self.rate_scheduler = shared_scheduler(
+            self.model_name,
+            tokens_per_minute=int(os.getenv("GROQ_TOKENS_PER_MINUTE") or 6000),
+            requests_per_minute=int(os.getenv("GROQ_REQUESTS_PER_MINUTE") or 30),
+        )
+        self.rate_limit_timeout = float(os.getenv("RATE_LIMIT_TIMEOUT") or 120)
+        self.expected_completion_tokens = 512
+        # Retrieved emails are packed into the prompt by token budget instead of a fixed count
+        self.retrieval_candidates = int(os.getenv("RETRIEVAL_CANDIDATES") or 20)
+        self.context_window = int(os.getenv("LLM_CONTEXT_WINDOW") or 8192)
+        # Retrieved emails are spread over threads: at most thread_cap per thread, MMR over thread vectors
+        self.thread_cap = int(os.getenv("THREAD_MAX_EMAILS") or 2)
+        self.thread_diversity = float(os.getenv("THREAD_DIVERSITY") or 0.3)
+        # Near-identical emails (newsletters, notifications) are linked to an indexed copy instead of embedded
+        self.near_duplicate_config = {
+            "threshold": float(os.getenv("NEAR_DUP_THRESHOLD") or 0.8),
+            "min_words": int(os.getenv("NEAR_DUP_MIN_WORDS") or 20),
+        }
+        # Each index save writes a new segment; past max_segments, a background thread merges fan_in of them
+        self.segment_config = {
+            "max_segments": int(os.getenv("VECTORSTORE_MAX_SEGMENTS") or 8),
+            "fan_in": int(os.getenv("VECTORSTORE_COMPACTION_FAN_IN") or 4),
+        }
+        # Set by the warm-up: LLM, memory, embeddings, chunker, context packer and the indexes
+        self.rag_retriever = None
+        # Searches share the index; appends take it exclusively only for the in-memory update
+        self._index_lock = ReadWriteLock()
+        self._ingest_lock = threading.RLock()
+        self._unsaved_new_index = False
+        self._ready = threading.Event()
+        self._warmup_error = None
+        if background:
+            threading.Thread(target=self._warm_up, name="agent-warm-up", daemon=True).start()
+        else:
+            self._warm_up()
+            self.wait_until_ready()
 
-    def _init_rag_retriever(self) -> FAISS:
-        """Initialize RAG retriever. Only load if exists; do not create with dummy text."""
-        vectorstore_path = os.path.join(CONFIG_DIR, "ljs_columbia_email_vectorstore.faiss")
-        if os.path.exists(vectorstore_path):
-            # Note: allow_dangerous_deserialization=True is used because we trust our own vectorstore files
-            # This is safe since we created these files ourselves and they haven't been modified by untrusted sources
-            return FAISS.load_local(vectorstore_path, self.embeddings, allow_dangerous_deserialization=True)
+    def _warm_up(self) -> None:
+        """Import the heavy libraries, load the LLM client, the embedding model and the FAISS index."""
+        start_time = time.perf_counter()
+        try:
+            self._load_models()
+            self.rag_retriever = self._init_rag_retriever()
+            # Emails deleted from the store since the index was last opened
+            self.apply_deletions()
+        except Exception as e:
+            self._warmup_error = e
+        finally:
+            self._ready.set()
+        if self._warmup_error is None and not self.quiet:
+            print(f"[WARM-UP] models and index ready in {time.perf_counter() - start_time:.2f}s")
+
+    def _load_models(self) -> None:
+        from groq import Groq
+        from langchain.chains import ConversationChain
+        from langchain_groq import ChatGroq
+        from .chunker import EmailChunker
+        from .context_packer import ContextPacker
+        from .embedding_cache import CachedEmbeddings, EmbeddingCache
+        from .embedding_engine import EmbeddingEngine
+        from .lexical_index import BM25Index
+        from .metadata_index import MetadataIndex
+        from .near_duplicates import NearDuplicateIndex
+        from .thread_index import ThreadIndex
+
+        if self.llm_backend == "stub":
+            from langchain_core.language_models.fake_chat_models import FakeListChatModel
+
+            self.model = FakeListChatModel(responses=[os.getenv("LLM_STUB_RESPONSE") or "This is a stub answer."])
         else:
-            # No index exists yet; will be created when new emails are added
+            self.__client = Groq(api_key=self.__groq_api_key)
+            self.model = ChatGroq(model=self.model_name, api_key=self.__groq_api_key, temperature=0.8)
+        # Document embeddings are cached on disk by text hash, so index rebuilds only re-embed new text
+        self.embedding_engine = EmbeddingEngine(
+            self.embedding_model_name,
+            batch_size=int(os.getenv("EMBEDDING_BATCH_SIZE") or 64),
+            num_workers=int(os.getenv("EMBEDDING_WORKERS") or 0),
+        )
+        self.embeddings = CachedEmbeddings(
+            self.embedding_engine,
+            EmbeddingCache(Path(CONFIG_DIR, "embedding_cache"), self.embedding_model_name),
+            query_cache=self.query_vector_cache,
+        )
+        # Emails are indexed as token-bounded chunks so long bodies are not truncated by the embedding model
+        self.chunker = EmailChunker(
+            self.embedding_engine.tokenizer,
+            max_tokens=self.embedding_engine.max_seq_length,
+            token_counter=self.token_counter,
+        )
+        self.context_packer = ContextPacker(self.token_counter, context_window=self.context_window)
+        self.memory = self.new_session_memory()
+        self.conversation_chain = ConversationChain(llm=self.model, memory=self.memory, verbose=not self.quiet)
+        self.metadata_index = MetadataIndex()
+        self.lexical_index = BM25Index()
+        self.thread_index = ThreadIndex()
+        self.near_duplicates = NearDuplicateIndex(**self.near_duplicate_config)
+
+    def new_session_memory(self):
+        """Conversation memory for one chat session."""
+        from langchain.memory.summary_buffer import ConversationSummaryBufferMemory
+
+        return ConversationSummaryBufferMemory(llm=self.model, max_token_limit=2000)
+
+    @property
+    def ready(self) -> bool:
+        """True once the warm-up has finished (successfully or not)."""
+        return self._ready.is_set()
+
+    def wait_until_ready(self) -> None:
+        """Block until the warm-up has finished; re-raise its error if it failed."""
+        self._ready.wait()
+        if self._warmup_error is not None:
+            raise RuntimeError("Agent warm-up failed") from self._warmup_error
+
+    def _init_rag_retriever(self) -> "SegmentedVectorStore":
+        """Initialize RAG retriever. Load if exists, else rebuild from the email store; do not create with dummy text."""
+        from .index_factory import load_index_config
+        from .lexical_index import LEXICAL_INDEX
+        from .metadata_index import MetadataIndex
+        from .near_duplicates import NEAR_DUPLICATES, NearDuplicateIndex
+        from .segmented_store import SegmentedVectorStore
+        from .thread_index import THREAD_INDEX
+
+        vectorstore_path = os.path.join(CONFIG_DIR, "ljs_columbia_email_vectorstore.faiss")
+        saved_config = load_index_config(vectorstore_path)
+        retriever = SegmentedVectorStore.load(
+            vectorstore_path,
+            self.embeddings,
+            {
+                **saved_config,
+                "nprobe": self.index_config["nprobe"] or saved_config.get("nprobe"),
+                "ef_search": self.index_config["ef_search"] or saved_config.get("ef_search"),
+            },
+            **self._store_options(),
+        )
+        if retriever is None:
+            return self._rebuild_from_store(vectorstore_path)
+        self.metadata_index = MetadataIndex.from_vectorstore(retriever)
+        # Each segment carries the BM25 and thread indexes of its chunks; segments from before that get them built now
+        self.lexical_index = retriever.side_index(LEXICAL_INDEX)
+        self.thread_index = retriever.side_index(THREAD_INDEX)
+        for name in (LEXICAL_INDEX, THREAD_INDEX):
+            # Whole-index pickles written before the indexes were kept per segment
+            Path(vectorstore_path, name).unlink(missing_ok=True)
+        if os.path.exists(os.path.join(vectorstore_path, NEAR_DUPLICATES)):
+            self.near_duplicates = NearDuplicateIndex.load(vectorstore_path, **self.near_duplicate_config)
+        if saved_config["index_type"] != self.index_config["index_type"]:
+            print(
+                f"FAISS index is '{saved_config['index_type']}', not '{self.index_config['index_type']}'. "
+                f"Run `python -m src.email_agent.agent.index_factory migrate {self.index_config['index_type']}` to convert it."
+            )
+        return retriever
+
+    def _rebuild_from_store(self, vectorstore_path: str, batch_size: int = 256, train_size: int = 4096) -> "SegmentedVectorStore":
+        """
+        Rebuild the FAISS index from the local email store without downloading anything.
+        The first train_size emails form the initial batch, so IVF/PQ indexes are trained on a real sample.
+        """
+        retriever = None
+        batch, email_ids = [], []
+        for email in self.email_store.iter_emails():
+            batch.append(email)
+            if len(batch) == (batch_size if retriever else train_size):
+                retriever = self._add_documents(retriever, self.chunk_emails(batch))
+                email_ids.extend(email.id for email in batch)
+                batch = []
+        if batch:
+            retriever = self._add_documents(retriever, self.chunk_emails(batch))
+            email_ids.extend(email.id for email in batch)
+        if retriever is None:
+            # No index and no stored emails yet; will be created when new emails are added
             return None
+        print(f"Rebuilt FAISS index from {len(self.email_store)} stored emails.")
+        self._save_retriever(retriever, vectorstore_path, new_index=True)
+        # Seen only once saved: an interrupted rebuild starts over instead of skipping these emails
+        self.seen_ids.add_many(email_ids)
+        return retriever
+
+    def _store_options(self) -> dict:
+        """SegmentedVectorStore options: compaction settings and the side indexes saved with each segment."""
+        from .lexical_index import LEXICAL_INDEX, BM25Index
+        from .thread_index import THREAD_INDEX, ThreadIndex
+
+        return {**self.segment_config, "side_indexes": {LEXICAL_INDEX: BM25Index, THREAD_INDEX: ThreadIndex}}
+
+    def _save_retriever(self, retriever: "SegmentedVectorStore", vectorstore_path: str, new_index: bool = False) -> None:
+        """
+        Save the chunks added since the last save as a new vectorstore segment (with their BM25 and thread
+        indexes), append the new near-duplicate signatures to their log, and save the index config, with the
+        faiss factory string actually built, when the index was just built. Each checkpoint writes what
+        changed, not the whole indexes.
+        """
+        from .index_factory import save_index_config
+
+        retriever.save()
+        self.near_duplicates.save(vectorstore_path)
+        if new_index:
+            # Record the index actually built: IVF types fall back to Flat on a small first batch
+            save_index_config(vectorstore_path, {**self.index_config, "factory": retriever.segment_factories()[0]})
+
+    def chunk_emails(self, emails) -> List["Document"]:
+        """
+        Chunk EmailSamples or an EmailBatch for indexing. Near-duplicates of indexed emails are linked to
+        them and chunked whole, with their canonical email id under "duplicate_of" (see embed_documents);
+        the rest keep only the text each message adds to its thread.
+        """
+        duplicates = {}
+
+        def new_text(email_id: str, thread_id: str, content: str) -> str:
+            canonical = self.near_duplicates.check(email_id, content)
+            if canonical is not None:
+                duplicates[email_id] = canonical
+                return content
+            return self.thread_index.new_text(thread_id, content)
+
+        documents = self.chunker.chunk_many(emails, new_text=new_text)
+        for document in documents:
+            if document.metadata["id"] in duplicates:
+                document.metadata["duplicate_of"] = duplicates[document.metadata["id"]]
+        return documents
+
+    def embed_documents(self, documents: List["Document"]) -> List[List[float]]:
+        """
+        Vectors of chunks to index. Chunks of near-duplicates are not embedded: they take the mean vector
+        of their canonical email's chunks (found in this batch or in the index, and served by the embedding
+        cache), so that BM25 and the sender/thread/date filters still find them and filtered searches rank
+        them like their canonical copy. Unfiltered vector searches skip them (MetadataIndex.duplicate_positions).
+        """
+        import numpy as np
+
+        vectors = [None] * len(documents)
+        originals = [i for i, document in enumerate(documents) if "duplicate_of" not in document.metadata]
+        for i, vector in zip(originals, self.embeddings.embed_documents([documents[i].page_content for i in originals])):
+            vectors[i] = vector
+        canonical_texts = {}
+        for i in originals:
+            canonical_texts.setdefault(documents[i].metadata.get("id"), []).append(documents[i].page_content)
+        duplicates = [i for i, vector in enumerate(vectors) if vector is None]
+        means = {}
+        for i in duplicates:
+            canonical = documents[i].metadata["duplicate_of"]
+            if canonical not in means:
+                texts = canonical_texts.get(canonical)
+                if texts is None and self.rag_retriever is not None:
+                    with self._index_lock.read():
+                        positions = [p for p in sorted(self.metadata_index.positions_of([canonical])) if not self.rag_retriever.is_deleted(p)]
+                        texts = [document.page_content for document in self.rag_retriever.documents_at(positions)]
+                means[canonical] = np.mean(self.embeddings.embed_documents(texts), axis=0).tolist() if texts else None
+        # A canonical email that is gone from the index leaves its duplicates to be embedded themselves
+        orphans = [i for i in duplicates if means[documents[i].metadata["duplicate_of"]] is None]
+        for i, vector in zip(orphans, self.embeddings.embed_documents([documents[i].page_content for i in orphans]) if orphans else ()):
+            vectors[i] = vector
+        for i in duplicates:
+            if vectors[i] is None:
+                vectors[i] = means[documents[i].metadata["duplicate_of"]]
+        return vectors
+
+    def _add_documents(self, retriever: "SegmentedVectorStore", documents: List["Document"]) -> "SegmentedVectorStore":
+        """
+        Add documents to the vectorstore (building it if needed), the metadata side indexes, the BM25 index
+        and the thread index. Documents are embedded before the index write lock is taken, so searches only
+        wait for the in-memory append.
+        """
+        from .lexical_index import BM25Index
+        from .metadata_index import MetadataIndex
+        from .segmented_store import SegmentedVectorStore
+
+        texts = [document.page_content for document in documents]
+        vectors = self.embed_documents(documents)
+        if retriever is None:
+            vectorstore_path = os.path.join(CONFIG_DIR, "ljs_columbia_email_vectorstore.faiss")
+            retriever = SegmentedVectorStore.build(
+                vectorstore_path, documents, self.embeddings, self.index_config, vectors=vectors, **self._store_options()
+            )
+            metadata_index, lexical_index = MetadataIndex(), BM25Index()
+            metadata_index.add(0, documents)
+            lexical_index.add(0, documents)
+            with self._index_lock.write():
+                self.metadata_index, self.lexical_index = metadata_index, lexical_index
+                self.thread_index.add(documents, vectors)
+                self.retrieval_cache.clear()
+            return retriever
+        with self._index_lock.write():
+            start = retriever.add_embeddings(texts, vectors, [document.metadata for document in documents])
+            self.metadata_index.add(start, documents)
+            self.lexical_index.add(start, documents)
+            self.thread_index.add(documents, vectors)
+            # New documents can change any ranking, so cached results are stale
+            self.retrieval_cache.clear()
+        return retriever
 
     def _filter_email_samples(self, email_samples: List[EmailSample]) -> List[EmailSample]:
-        """Filter new emails from email samples"""
+        """Filter new emails from email samples; _update_retriever records them as seen once they are indexed"""
         necessary_emails = []
-        if os.path.exists(os.path.join(CONFIG_DIR, "ljs_columbia_email_saved.json")):
-            self.saved_emails = json.loads(Path(CONFIG_DIR, "ljs_columbia_email_saved.json").read_text(encoding="utf-8"))
-            for email in email_samples:
-                if email.id not in self.saved_emails["id"]:
-                    necessary_emails.append(email)
-                    self.saved_emails["id"].append(email.id)
-            with open(os.path.join(CONFIG_DIR, "ljs_columbia_email_saved.json"), "w", encoding="utf-8") as f:
-                json.dump(self.saved_emails, f, ensure_ascii=False)
-        else:
-            necessary_emails = email_samples
-            with open(os.path.join(CONFIG_DIR, "ljs_columbia_email_saved.json"), "w", encoding="utf-8") as f:
-                json.dump(self.saved_emails, f, ensure_ascii=False)
+        batch_ids = set()
+        for email in email_samples:
+            if email.id not in self.seen_ids and email.id not in batch_ids:
+                necessary_emails.append(email)
+                batch_ids.add(email.id)
         self.new_emails = necessary_emails
         return necessary_emails
 
-    def _update_retriever(self, email_samples: List[EmailSample]) -> None:
-        """Update RAG retriever. Create FAISS index if it does not exist."""
-        necessary_emails = self._filter_email_samples(email_samples)
-        content = [str(email) for email in necessary_emails]
-        # for email in content:
-        #     print(email)
-        vectorstore_path = os.path.join(CONFIG_DIR, "ljs_columbia_email_vectorstore.faiss")
-        if self.rag_retriever is None:
-            if content:
-                # Create new FAISS index with actual email content
-                self.rag_retriever = FAISS.from_texts(content, self.embeddings)
-                self.rag_retriever.save_local(vectorstore_path)
-            else:
+    def _update_retriever(self, email_samples: List[EmailSample]) -> int:
+        """
+        Update RAG retriever. Create FAISS index if it does not exist.
+        Updates are serialized; searches keep running except during the in-memory append.
+        Returns the number of emails indexed. Emails are recorded as seen only after the index is saved,
+        so a failed or interrupted update indexes them again next time.
+        """
+        with self._ingest_lock:
+            necessary_emails = self._filter_email_samples(email_samples)
+            content = self.chunk_emails(necessary_emails)
+            # for email in content:
+            #     print(email)
+            try:
+                if content:
+                    self.index_documents(content)
+            except Exception:
+                # The thread lines chunk_emails handed out were not indexed; a retry must chunk them again
+                self.thread_index.discard_pending({email.thread_id for email in necessary_emails})
+                raise
+            if not content and self.rag_retriever is None:
                 # No data to create index
                 print("No email content to create FAISS index.")
-        else:
-            if content:
-                self.rag_retriever.add_texts(content)
-                self.rag_retriever.save_local(vectorstore_path)
-
-    def _get_top_k_emails(self, user_input: str, k: int = 5) -> str:
-        """Get top k emails from RAG retriever"""
-        emails = self.rag_retriever.similarity_search(user_input, k=k)
-        email_content = "\n\n".join([email.page_content for email in emails])
-        return email_content
-    
+            self.seen_ids.add_many(email.id for email in necessary_emails)
+            if not self.quiet:
+                print(f"Embedding cache: {self.embeddings.stats()}")
+                print(f"Near-duplicates: {self.near_duplicates.stats()}")
+            return len(necessary_emails)
+
+    def index_documents(self, documents: List["Document"], save: bool = True) -> None:
+        """
+        Append chunked emails to the FAISS, metadata and BM25 indexes, creating the FAISS index on first use.
+        With save=False the caller checkpoints the index later with save_index().
+        """
+        with self._ingest_lock:
+            if self.rag_retriever is None:
+                # Create new FAISS index with actual email content
+                retriever = self._add_documents(None, documents)
+                with self._index_lock.write():
+                    self.rag_retriever = retriever
+                self._unsaved_new_index = True
+            else:
+                self._add_documents(self.rag_retriever, documents)
+            if save:
+                self.save_index()
+
+    def save_index(self) -> None:
+        """Write the FAISS index and its side files to disk (the index config too when the index was just created)."""
+        vectorstore_path = os.path.join(CONFIG_DIR, "ljs_columbia_email_vectorstore.faiss")
+        with self._ingest_lock:
+            if self.rag_retriever is not None:
+                self._save_retriever(self.rag_retriever, vectorstore_path, new_index=self._unsaved_new_index)
+                self._unsaved_new_index = False
+                # Tombstones of chunks that were in the tail are durable only now
+                self.apply_deletions()
+
+    def apply_deletions(self) -> int:
+        """
+        Tombstone the chunks of emails deleted from the email store, so they are no longer retrieved;
+        compaction drops them from the index files. A store tombstone is cleared once the index has logged
+        the deletion, i.e. when all of the email's chunks are in saved segments; its id then leaves seen_ids too.
+        Returns the chunks deleted.
+        """
+        with self._ingest_lock:
+            email_ids = self.email_store.tombstones()
+            if not email_ids:
+                return 0
+            if self.rag_retriever is None:
+                # Nothing indexed yet; a rebuild only reads the emails left in the store
+                self.seen_ids.discard_many(email_ids)
+                self.email_store.clear_tombstones(email_ids)
+                return 0
+            by_email = {email_id: self.metadata_index.positions_of([email_id]) for email_id in email_ids}
+            with self._index_lock.write():
+                deleted = self.rag_retriever.delete(set().union(*by_email.values()))
+                self.retrieval_cache.clear()
+            saved = self.rag_retriever.saved_positions
+            durable = [email_id for email_id, positions in by_email.items() if all(position < saved for position in positions)]
+            # Deleted emails never come back, so their seen ids would only grow the log
+            self.seen_ids.discard_many(durable)
+            self.email_store.clear_tombstones(durable)
+            if deleted and not self.quiet:
+                print(f"Deleted {deleted} chunks of {len(email_ids)} removed emails from the index")
+            return deleted
+
+    def _get_top_k_emails(self, user_input: str, k: int = 5, chunks_per_email: int = 4) -> List[List["Document"]]:
+        """
+        Get top k emails from RAG retriever, each as its list of matching chunks.
+        Sender/date filters found in the question narrow the candidates first; vector and BM25
+        hits over those candidates are then merged with reciprocal rank fusion, and the k emails
+        are picked from the ranked ones so that they spread over threads (ThreadIndex.diversify).
+        """
+        return self._get_top_k_emails_many([user_input], k, chunks_per_email)[0]
+
+    def _get_top_k_emails_many(self, user_inputs: List[str], k: int = 5, chunks_per_email: int = 4) -> List[List[List["Document"]]]:
+        """
+        _get_top_k_emails for several questions: those not in the retrieval cache are embedded
+        in one batch and searched with one multi-query FAISS search.
+        """
+        from .chunker import collapse_to_emails
+        from .lexical_index import reciprocal_rank_fusion
+        from .metadata_index import parse_query_filters
+
+        n_chunks = k * chunks_per_email
+        cache_keys = [(normalize_query(user_input), n_chunks) for user_input in user_inputs]
+        if self.rag_retriever is None:
+            return [[] for _ in user_inputs]
+        ranked = [self.retrieval_cache.get(cache_key) for cache_key in cache_keys]
+        misses = [i for i, positions in enumerate(ranked) if positions is None]
+        # Embed outside the index lock; only the searches need a stable index
+        query_vectors = self.embeddings.embed_queries([user_inputs[i] for i in misses]) if misses else []
+        with self._index_lock.read():
+            if misses:
+                candidates = []
+                for i in misses:
+                    filters = parse_query_filters(user_inputs[i], senders=self.metadata_index.by_sender)
+                    candidates.append(self.metadata_index.candidates(**filters) if filters else None)
+                    if candidates[-1] is not None and not self.quiet:
+                        print(f"Searching {len(candidates[-1])} chunks matching {filters}")
+                vector_hits = self.rag_retriever.search(query_vectors, n_chunks, candidates, exclude=self.metadata_index.duplicate_positions())
+                for i, hits, positions in zip(misses, vector_hits, candidates):
+                    lexical_hits = [
+                        position
+                        for position, _ in self.lexical_index.search(user_inputs[i], n_chunks, positions)
+                        if not self.rag_retriever.is_deleted(position)
+                    ]
+                    ranked[i] = reciprocal_rank_fusion([hits, lexical_hits])[:n_chunks]
+                    self.retrieval_cache.put(cache_keys[i], ranked[i])
+            return [
+                self.thread_index.diversify(
+                    collapse_to_emails(self.rag_retriever.documents_at(positions), len(positions)),
+                    k,
+                    per_thread=self.thread_cap,
+                    diversity=self.thread_diversity,
+                )
+                for positions in ranked
+            ]
+
+    @staticmethod
+    def _get_system_prompt() -> str:
+        return "\n\n".join([msg["content"] for msg in load_rules_agents() if msg["role"] == "system"])
+
     def _get_prompt(self, user_input: str, email_content: str) -> str:
         """Get prompt for RAG retrieval"""
-        system_prompt = "\n\n".join([msg["content"] for msg in RULES_AGENTS if msg["role"] == "system"])
-        prompt = f"""
-You are a helpful email assistant.
-system_prompt: 
-{system_prompt}
+        return PROMPT_TEMPLATE.format(system_prompt=self._get_system_prompt(), user_input=user_input, email_content=email_content)
 
-user_input: 
-{user_input}
+    def _count_prompt_tokens(self, user_input: str, emails: List[List["Document"]]) -> int:
+        """
+        Tokens of the prompt built from user_input and emails, without re-tokenizing it: the template with
+        the system prompt and each email are memoized segments, so only the question is counted afresh.
+        """
+        from .chunker import count_email_chunk_tokens
 
-Reference the following email materials:
-{email_content}
+        static_prompt = PROMPT_TEMPLATE.format(system_prompt=self._get_system_prompt(), user_input="", email_content="")
+        separators = self.token_counter.count_segment("\n\n") * max(0, len(emails) - 1)
+        return (
+            self.token_counter.count_segment(static_prompt)
+            + self.token_counter.count(user_input)
+            + sum(count_email_chunk_tokens(email, self.token_counter) for email in emails)
+            + separators
+        )
+
+    def _pack_prompt(self, user_input: str, candidates: List[List["Document"]], history: str = "", rate_available: int = None) -> tuple:
         """
-        return prompt
-
-    def _get_prompt_from_user_input(self, user_input: str) -> str:
-        """Process user input, combine RAG retrieval and historical messages to generate response"""
-        emails = self._get_top_k_emails(user_input, tools.numerical_input(input("How many emails to retrieve? (default: 5) :")))
-        prompt = self._get_prompt(user_input, emails)
-        return prompt
-
-    def _check_token_limit(self, prompt: str) -> bool:
-        """Check if the prompt is too long"""
-        token_needed = self.model.get_num_tokens(prompt)
-        if datetime.now() - self.query_time > timedelta(minutes=1):
-            self.token_spent_per_minute = 0
-            self.query_time = datetime.now()
-        if self.token_spent_per_minute + token_needed < self.token_limit_per_minute:
-            self.token_spent_per_minute += token_needed
-            return True
-        else:
-            print(f"Token limit reached, please wait for 1 minute since {self.query_time.strftime('%Y-%m-%d %H:%M:%S')}.")
-            print(f"Token spent: {self.token_spent_per_minute}")
-            return False
+        Pack the candidate emails into whatever the context window and rate_available leave after
+        the template, question and conversation history. Returns (prompt, prompt_tokens, emails),
+        prompt_tokens including the history.
+        """
+        from .chunker import format_email_chunks
+
+        fixed_tokens = self._count_prompt_tokens(user_input, []) + self.token_counter.count(history)
+        budget = self.context_packer.budget(fixed_tokens, self.expected_completion_tokens, rate_available=rate_available)
+        emails, email_tokens = self.context_packer.pack(candidates, budget)
+        if not self.quiet:
+            print(f"[CONTEXT] {len(emails)} of {len(candidates)} emails, {email_tokens} tokens (budget {budget})")
+        prompt = self._get_prompt(user_input, "\n\n".join([format_email_chunks(email) for email in emails]))
+        return prompt, fixed_tokens + email_tokens, emails
+
+    def _get_prompt_from_user_input(self, user_input: str) -> tuple:
+        """
+        Process user input, combine RAG retrieval and historical messages to generate response.
+        The top retrieval_candidates emails are packed into the budget left by the context window
+        and the remaining rate budget. Returns (prompt, prompt_tokens).
+        """
+        candidates = self._get_top_k_emails(user_input, self.retrieval_candidates)
+        history = self.memory.load_memory_variables({})[self.memory.memory_key]
+        prompt, prompt_tokens, _ = self._pack_prompt(
+            user_input,
+            candidates,
+            history=str(history),
+            rate_available=self.rate_scheduler.status()["tokens_available"],
+        )
+        return prompt, prompt_tokens
+
+    def _check_token_limit(self, prompt: str, prompt_tokens: int = None) -> Reservation:
+        """
+        Wait for room in the token and request budgets for this prompt plus an expected completion.
+        Returns the reservation to settle once the response is in (see _settle_token_usage), or None
+        if no capacity frees up within rate_limit_timeout seconds. The reservation is returned rather
+        than kept on the agent, so concurrent turns each settle their own.
+        """
+        if prompt_tokens is None:
+            prompt_tokens = self.token_counter.count(prompt)
+        token_needed = prompt_tokens + self.expected_completion_tokens
+        start_time = time.perf_counter()
+        try:
+            reservation = self.rate_scheduler.acquire(token_needed, timeout=self.rate_limit_timeout)
+        except TimeoutError:
+            print(f"Token limit reached: no capacity for {token_needed} tokens within {self.rate_limit_timeout:.0f}s.")
+            print(f"Rate limit status: {self.rate_scheduler.status()}")
+            return None
+        waited = time.perf_counter() - start_time
+        if waited > 1:
+            print(f"Waited {waited:.1f}s for rate limit capacity.")
+        return reservation
+
+    def _settle_token_usage(self, reservation: Reservation, prompt_tokens: int, response: str) -> None:
+        """Charge the actual prompt + completion tokens against the reservation made for this turn."""
+        actual_tokens = prompt_tokens + self.token_counter.count(response)
+        self.rate_scheduler.settle(reservation, actual_tokens)
 
     def _get_response_from_prompt(self, prompt: str) -> dict:
         response = self.conversation_chain.invoke(prompt)
         return response
 
-    def chat_loop(self, email_samples: List[EmailSample]) -> None:
-        """Interactive chat loop"""
-        self._update_retriever(email_samples)
+    def _stream_response_from_prompt(self, prompt: str) -> dict:
+        """
+        Stream the response to stdout as tokens arrive, then record the finished turn in the conversation memory.
+        Returns {"response", "time_to_first_token", "total_latency"} (seconds).
+        """
+        history = self.memory.load_memory_variables({})[self.memory.memory_key]
+        full_prompt = self.conversation_chain.prompt.format(history=history, input=prompt)
+        if not self.quiet:
+            print(f"Prompt after formatting:\n{full_prompt}")
+        start_time = time.perf_counter()
+        first_token_time = None
+        parts = []
+        print("Agent: ", end="", flush=True)
+        for chunk in self.model.stream(full_prompt):
+            if first_token_time is None and chunk.content:
+                first_token_time = time.perf_counter()
+            parts.append(chunk.content)
+            print(chunk.content, end="", flush=True)
+        print()
+        total_latency = time.perf_counter() - start_time
+        response = "".join(parts)
+        self.memory.save_context({"input": prompt}, {"response": response})
+        return {
+            "response": response,
+            "time_to_first_token": (first_token_time or time.perf_counter()) - start_time,
+            "total_latency": total_latency,
+        }
+
+    def index_emails(self, email_samples: List[EmailSample]) -> int:
+        """Wait for the warm-up, then add the emails not indexed yet to the retriever. Returns how many were added."""
+        self.wait_until_ready()
+        return self._update_retriever(email_samples)
+
+    def _answer_prompt(self, question: str, packed: tuple) -> dict:
+        """Answer one batch question: wait for rate capacity, call the LLM, settle the tokens it really used."""
+        prompt, prompt_tokens, emails = packed
+        result = {"question": question, "emails": len(emails)}
+        start_time = time.perf_counter()
+        try:
+            reservation = self.rate_scheduler.acquire(prompt_tokens + self.expected_completion_tokens, timeout=self.rate_limit_timeout)
+        except TimeoutError as e:
+            result["error"] = str(e)
+            return result
+        call_time = time.perf_counter()
+        try:
+            message = self.model.invoke(prompt)
+        except Exception as e:
+            self.rate_scheduler.settle(reservation, prompt_tokens)
+            result["error"] = f"{type(e).__name__}: {e}"
+            return result
+        # Prefer the provider's token usage over our own count when it is reported
+        usage = getattr(message, "usage_metadata", None) or {}
+        result.update(
+            answer=message.content,
+            rate_limit_wait=round(call_time - start_time, 3),
+            latency=round(time.perf_counter() - call_time, 3),
+            prompt_tokens=usage.get("input_tokens", prompt_tokens),
+            completion_tokens=usage.get("output_tokens", self.token_counter.count(message.content)),
+        )
+        self.rate_scheduler.settle(reservation, result["prompt_tokens"] + result["completion_tokens"])
+        return result
+
+    def answer(self, question: str, memory=None) -> dict:
+        """
+        Answer one question without streaming, for callers other than the chat loop (e.g. the HTTP server).
+        memory is the session's conversation memory (see new_session_memory); the turn is saved to it.
+        Returns the same fields as answer_batch.
+        """
+        self.wait_until_ready()
+        history = str(memory.load_memory_variables({})[memory.memory_key]) if memory is not None else ""
+        candidates = self._get_top_k_emails(question, self.retrieval_candidates)
+        prompt, prompt_tokens, emails = self._pack_prompt(
+            question,
+            candidates,
+            history=history,
+            rate_available=self.rate_scheduler.status()["tokens_available"],
+        )
+        full_prompt = self.conversation_chain.prompt.format(history=history, input=prompt) if memory is not None else prompt
+        result = self._answer_prompt(question, (full_prompt, prompt_tokens, emails))
+        if memory is not None and "answer" in result:
+            memory.save_context({"input": prompt}, {"response": result["answer"]})
+        return result
+
+    def answer_batch(self, questions: List[str], max_concurrency: int = 4) -> List[dict]:
+        """
+        Answer independent questions without conversation memory, e.g. for nightly digests.
+        All questions are embedded in one batch and searched with one multi-query FAISS search;
+        up to max_concurrency LLM calls then run at once under the shared rate scheduler.
+        Each context is sized so that max_concurrency requests fit in the per-minute token budget.
+        Returns one dict per question, in order: question, emails, answer, rate_limit_wait,
+        latency (seconds), prompt_tokens, completion_tokens, or error if it failed.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.wait_until_ready()
+        start_time = time.perf_counter()
+        candidates = self._get_top_k_emails_many(questions, self.retrieval_candidates)
+        rate_share = int(self.rate_scheduler.tokens.capacity) // max_concurrency
+        packed = [self._pack_prompt(question, emails, rate_available=rate_share) for question, emails in zip(questions, candidates)]
+        retrieval_time = time.perf_counter() - start_time
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            results = list(executor.map(self._answer_prompt, questions, packed))
+        elapsed = time.perf_counter() - start_time
+        failed = sum(1 for result in results if "error" in result)
+        print(
+            f"[BATCH] {len(questions)} questions in {elapsed:.2f}s ({len(questions) / elapsed:.2f} questions/s, "
+            f"retrieval {retrieval_time:.2f}s, concurrency {max_concurrency}, failed {failed})"
+        )
+        return results
+
+    def _ingest_when_ready(self, email_samples: List[EmailSample], ingest: Callable[["BaseAgent"], object] = None) -> None:
+        """
+        Index new emails on a background thread: ingest(self) if given (it waits for the warm-up itself
+        before touching the index), else email_samples once the warm-up has loaded the models.
+        """
+        if ingest is not None:
+            try:
+                ingest(self)
+            except Exception as e:
+                print(f"Mailbox sync failed, answering from the local index: {e}")
+            return
+        self._ready.wait()
+        if self._warmup_error is None:
+            try:
+                self._update_retriever(email_samples)
+            except Exception as e:
+                self._warmup_error = e
+
+    def chat_loop(self, email_samples: List[EmailSample] = (), ingest: Callable[["BaseAgent"], object] = None) -> None:
+        """
+        Interactive chat loop. The prompt is shown right away; new emails (email_samples, or whatever
+        ingest(agent) streams in, e.g. a mailbox sync) are indexed in the background. Questions wait for
+        the warm-up, which loads the saved index, and for the ingest only while there is no index yet;
+        otherwise they are answered from the emails indexed so far.
+        """
+        ingest_thread = threading.Thread(target=self._ingest_when_ready, args=(email_samples, ingest), name="agent-ingest", daemon=True)
+        ingest_thread.start()
         print("Type 'exit' to quit.")
         while True:
             user_input = input("You: ")
             if user_input.lower() in ["exit", "quit"]:
+                print(f"Query vector cache: {self.query_vector_cache.stats()}")
+                print(f"Retrieval cache: {self.retrieval_cache.stats()}")
+                print(f"Token counter: {self.token_counter.stats()}")
                 print("Bye!")
                 break
-            prompt = self._get_prompt_from_user_input(user_input)
-            if not self._check_token_limit(prompt):
+            self.wait_until_ready()
+            if ingest_thread.is_alive():
+                if self.rag_retriever is None:
+                    print("Loading the email index...")
+                    ingest_thread.join()
+                else:
+                    print("(New emails are still being indexed; answering from the emails indexed so far.)")
+            self.wait_until_ready()
+            prompt, prompt_tokens = self._get_prompt_from_user_input(user_input)
+            reservation = self._check_token_limit(prompt, prompt_tokens)
+            if reservation is None:
                 continue
-            response = self._get_response_from_prompt(prompt)
-            print(f"Agent: {response['response']}")
+            if self.stream:
+                response = self._stream_response_from_prompt(prompt)
+            else:
+                start_time = time.perf_counter()
+                response = self._get_response_from_prompt(prompt)
+                response["total_latency"] = response["time_to_first_token"] = time.perf_counter() - start_time
+                print(f"Agent: {response['response']}")
+            self._settle_token_usage(reservation, prompt_tokens, response["response"])
+            self.turn_latencies.append((response["time_to_first_token"], response["total_latency"]))
+            print(f"[LATENCY] first token: {response['time_to_first_token']:.2f}s, total: {response['total_latency']:.2f}s")
     
 
 def time_test(fun):
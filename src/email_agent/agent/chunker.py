@@ -0,0 +1,150 @@
+from typing import List
+
+from langchain_core.documents import Document
+from ..utils.email_batch import EmailBatch
+from ..utils.email_sample import EmailSample
+from ..utils.email_store import parse_date
+
+
+def _header(subject: str, sender: str, date: str) -> str:
+    return f"【Subject】: {subject}\n【Sender】: {sender}\n【Date】: {date}\n"
+
+
+class EmailChunker:
+    """
+    Split email bodies into token-bounded windows so nothing is silently truncated by the embedding model.
+    Each chunk is a Document whose text is a short header (subject/sender/date) plus a slice of the body,
+    carrying id/thread_id/sender/date/chunk metadata of its parent email (date_ts is the date in epoch seconds).
+    With a token_counter, the LLM token count of each body slice is stored as "tokens" at ingest,
+    so prompt budgets are a sum over retrieved chunks (see count_email_chunk_tokens).
+    """
+
+    def __init__(self, tokenizer, max_tokens: int = 256, overlap: int = 32, token_counter=None):
+        self.tokenizer = tokenizer
+        self.max_tokens = max_tokens
+        self.overlap = overlap
+        self.token_counter = token_counter
+
+    def _count_tokens(self, text: str) -> int:
+        return len(self.tokenizer(text, add_special_tokens=False)["input_ids"])
+
+    def split(self, text: str, budget: int) -> List[str]:
+        """
+        Cut text into windows of at most budget tokens, overlapping by self.overlap tokens. The overlap is
+        capped at a quarter of the budget, so a long header that shrinks the budget cannot shrink the step
+        below half a window and multiply the chunks.
+        """
+        offsets = self.tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)["offset_mapping"]
+        if len(offsets) <= budget:
+            return [text] if text.strip() else []
+        step = max(1, budget - min(self.overlap, budget // 4))
+        windows = []
+        for start in range(0, len(offsets), step):
+            end = min(start + budget, len(offsets))
+            windows.append(text[offsets[start][0]:offsets[end - 1][1]])
+            if end == len(offsets):
+                break
+        return windows
+
+    def chunk(self, email: EmailSample) -> List[Document]:
+        return self._chunk(email.id, email.thread_id, email.subject, email.sender, email.date, email.content)
+
+    def _chunk(self, id: str, thread_id: str, subject: str, sender: str, date: str, content: str) -> List[Document]:
+        header = _header(subject, sender, date)
+        # Leave room for the header and the [CLS]/[SEP] tokens the model adds
+        budget = max(self.overlap + 1, self.max_tokens - self._count_tokens(header) - 2)
+        bodies = self.split(content, budget) or [""]
+        date_ts = parse_date(date)
+        documents = [
+            Document(
+                page_content=header + body,
+                metadata={
+                    "id": id,
+                    "thread_id": thread_id,
+                    "subject": subject,
+                    "sender": sender,
+                    "date": date,
+                    "date_ts": date_ts,
+                    "chunk": i,
+                    "n_chunks": len(bodies),
+                },
+            )
+            for i, body in enumerate(bodies)
+        ]
+        if self.token_counter is not None:
+            for document, body in zip(documents, bodies):
+                document.metadata["tokens"] = self.token_counter.count(body)
+        return documents
+
+    def chunk_many(self, emails, new_text=None) -> List[Document]:
+        """
+        Chunk a list of EmailSamples, or the rows of an EmailBatch without building EmailSamples.
+        new_text(id, thread_id, content), if given, replaces each body with the part to index
+        (see BaseAgent.chunk_emails); emails it returns None for are left out.
+        """
+        fields = ("id", "thread_id", "subject", "sender", "date", "content")
+        if isinstance(emails, EmailBatch):
+            rows = emails.iter_rows(*fields)
+        else:
+            rows = ((email.id, email.thread_id, email.subject, email.sender, email.date, email.content) for email in emails)
+        documents = []
+        for row in rows:
+            if new_text is not None:
+                content = new_text(row[0], row[1], row[5])
+                if content is None:
+                    continue
+                row = (*row[:5], content)
+            documents.extend(self._chunk(*row))
+        return documents
+
+
+def collapse_to_emails(documents: List[Document], k: int) -> List[List[Document]]:
+    """
+    Group ranked chunk hits by parent email, keeping the first k emails in rank order.
+    Each group holds that email's matched chunks in body order. Documents indexed before
+    chunking (no "id" metadata) count as an email of their own.
+    """
+    groups = {}
+    for i, document in enumerate(documents):
+        key = document.metadata.get("id", f"__document_{i}")
+        if key not in groups:
+            if len(groups) == k:
+                continue
+            groups[key] = []
+        groups[key].append(document)
+    return [sorted(group, key=lambda document: document.metadata.get("chunk", 0)) for group in groups.values()]
+
+
+def _email_prefix(metadata: dict) -> str:
+    header = _header(metadata["subject"], metadata["sender"], metadata["date"])
+    return f"【Id】: {metadata['id']}\n【Thread ID】: {metadata['thread_id']}\n{header}【Content】: "
+
+
+def _email_suffix(metadata: dict, n_shown: int) -> str:
+    return f"\n(showing {n_shown} of {metadata['n_chunks']} parts)" if metadata["n_chunks"] > n_shown else ""
+
+
+def format_email_chunks(chunks: List[Document]) -> str:
+    """Render one email's matched chunks: the shared header once, then the relevant body slices."""
+    metadata = chunks[0].metadata
+    if "id" not in metadata:
+        return chunks[0].page_content
+    header = _header(metadata["subject"], metadata["sender"], metadata["date"])
+    content = "\n...\n".join(chunk.page_content[len(header):] for chunk in chunks)
+    return _email_prefix(metadata) + content + _email_suffix(metadata, len(chunks))
+
+
+def count_email_chunk_tokens(chunks: List[Document], token_counter) -> int:
+    """
+    Tokens of format_email_chunks(chunks), summed from the per-chunk counts stored at ingest plus
+    the (memoized) header and separators. Chunks indexed without counts are tokenized once instead.
+    """
+    metadata = chunks[0].metadata
+    if "tokens" not in metadata:
+        return token_counter.count_segment(format_email_chunks(chunks))
+    return (
+        token_counter.count_segment(_email_prefix(metadata))
+        + sum(chunk.metadata["tokens"] for chunk in chunks)
+        + token_counter.count_segment("\n...\n") * (len(chunks) - 1)
+        + token_counter.count_segment(_email_suffix(metadata, len(chunks)))
+    )
@@ -0,0 +1,96 @@
+from typing import List
+
+from langchain_core.documents import Document
+from ..utils.email_body import strip_quoted
+from .chunker import _header, count_email_chunk_tokens
+from .embedding_cache import normalize_text
+
+
+class ContextPacker:
+    """
+    Choose which retrieved email chunks go into the prompt, within a token budget.
+    - budget: what is left of the context window and of the remaining rate budget once the fixed
+      part of the prompt (template, question, history) and the expected completion are set aside
+    - pack: walk the emails in rank order, drop quoted history and chunks already included
+      (forwards, replies quoting each other), and add chunks greedily while they fit; the email
+      that overflows is cut to the remaining tokens and lower-ranked emails are left out
+    Chunk token counts come from the chunk metadata (counted at ingest), so packing rarely tokenizes.
+    """
+
+    def __init__(self, token_counter, context_window: int = 8192, min_budget: int = 512):
+        self.token_counter = token_counter
+        self.context_window = context_window
+        self.min_budget = min_budget
+
+    def budget(self, fixed_tokens: int, completion_tokens: int, rate_available: int = None) -> int:
+        limit = self.context_window if rate_available is None else min(self.context_window, rate_available)
+        budget = limit - fixed_tokens - completion_tokens
+        # Under a drained rate budget, pack a minimal context and let the scheduler wait for it
+        budget = max(budget, self.min_budget)
+        return min(budget, self.context_window - fixed_tokens - completion_tokens)
+
+    def _body(self, chunk: Document) -> str:
+        metadata = chunk.metadata
+        return chunk.page_content[len(_header(metadata["subject"], metadata["sender"], metadata["date"])):]
+
+    def _with_body(self, chunk: Document, body: str) -> Document:
+        metadata = chunk.metadata
+        header = _header(metadata["subject"], metadata["sender"], metadata["date"])
+        return Document(page_content=header + body, metadata={**metadata, "tokens": self.token_counter.count_segment(body)})
+
+    def _truncate(self, chunk: Document, tokens: int) -> Document:
+        """Cut a chunk's body to about tokens tokens, assuming tokens are spread evenly over the text."""
+        body = self._body(chunk)
+        body = body[: max(0, len(body) * tokens // max(1, chunk.metadata["tokens"]))].rsplit(" ", 1)[0]
+        return self._with_body(chunk, body + " ...")
+
+    def _clean(self, email: List[Document], seen: set) -> List[Document]:
+        """Strip quoted history from an email's chunks and drop chunks whose text was already included."""
+        if "tokens" not in email[0].metadata:
+            # Indexed without chunk metadata; packed whole
+            return email
+        cleaned = []
+        for chunk in email:
+            body = self._body(chunk)
+            stripped = strip_quoted(body)
+            key = normalize_text(stripped).lower()
+            if not key or key in seen:
+                continue
+            seen.add(key)
+            cleaned.append(chunk if stripped == body else self._with_body(chunk, stripped))
+        return cleaned
+
+    def pack(self, emails: List[List[Document]], budget: int) -> tuple:
+        """Returns (packed emails in rank order, their token count including separators)."""
+        separator = self.token_counter.count_segment("\n\n")
+        packed, used, seen = [], 0, set()
+        for email in emails:
+            email = self._clean(email, seen)
+            if not email:
+                continue
+            cost = count_email_chunk_tokens(email, self.token_counter) + (separator if packed else 0)
+            if used + cost <= budget:
+                packed.append(email)
+                used += cost
+                continue
+            # Lowest-ranked email that reaches the budget: keep the chunks that fit, truncate the next one
+            if "tokens" not in email[0].metadata:
+                break
+            kept = []
+            for chunk in email:
+                candidate = kept + [chunk]
+                cost = count_email_chunk_tokens(candidate, self.token_counter) + (separator if packed else 0)
+                if used + cost <= budget:
+                    kept = candidate
+                    continue
+                # Small margin for the " ..." marker and tokens merging across the cut
+                remaining = budget - used - (cost - chunk.metadata["tokens"]) - 8
+                if remaining > 32:
+                    kept.append(self._truncate(chunk, remaining))
+                break
+            if kept:
+                cost = count_email_chunk_tokens(kept, self.token_counter) + (separator if packed else 0)
+                packed.append(kept)
+                used += cost
+            break
+        return packed, used
@@ -0,0 +1,181 @@
+import hashlib
+import os
+import threading
+from pathlib import Path
+from typing import List
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from .query_cache import LRUCache, normalize_query
+
+
+def normalize_text(text: str) -> str:
+    """Collapse whitespace so that texts differing only in spacing share a cache entry."""
+    return " ".join(text.split())
+
+
+def text_key(text: str) -> str:
+    return hashlib.sha1(normalize_text(text).encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Persistent embedding cache for one model, keyed by the hash of the normalized text.
+    Vectors are appended to a raw float32/float16 matrix (vectors.<dtype>.bin) read through
+    np.memmap; keys.txt holds the text hash of each row, in row order.
+    """
+
+    def __init__(self, cache_dir: Path, model_name: str, dtype: str = "float32"):
+        self.dir = Path(cache_dir, model_name.replace("/", "__"))
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.dtype = np.dtype(dtype)
+        self._keys_path = self.dir / "keys.txt"
+        self._vectors_path = self.dir / f"vectors.{self.dtype.name}.bin"
+        self._lock = threading.Lock()
+        self._rows = {}
+        self._dim = None
+        self._mmap = None
+        self._load()
+
+    def _load(self) -> None:
+        dim_path = self.dir / "dim"
+        if dim_path.exists():
+            self._dim = int(dim_path.read_text())
+        keys_text = self._keys_path.read_text(encoding="utf-8") if self._keys_path.exists() else ""
+        # A line without its newline is a key torn by a crash
+        keys = keys_text.split("\n")[:-1]
+        vector_bytes = self._vectors_path.stat().st_size if self._vectors_path.exists() else 0
+        row_bytes = self._dim * self.dtype.itemsize if self._dim else 0
+        # After a crash either file may be longer than the other; only rows present in both count
+        n_rows = min(len(keys), vector_bytes // row_bytes) if row_bytes else 0
+        # Cut both files back to those rows, so that the next append lines keys up with their vectors again
+        if vector_bytes != n_rows * row_bytes:
+            os.truncate(self._vectors_path, n_rows * row_bytes)
+        if len(keys) != n_rows or not keys_text.endswith("\n") and keys_text:
+            tmp_path = self._keys_path.with_suffix(".tmp")
+            tmp_path.write_text("".join(f"{key}\n" for key in keys[:n_rows]), encoding="utf-8")
+            os.replace(tmp_path, self._keys_path)
+        self._rows = {key: row for row, key in enumerate(keys[:n_rows])}
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def _matrix(self) -> np.ndarray:
+        if self._mmap is None or len(self._mmap) < len(self._rows):
+            self._mmap = np.memmap(self._vectors_path, dtype=self.dtype, mode="r", shape=(len(self._rows), self._dim))
+        return self._mmap
+
+    def get_many(self, keys: List[str]) -> dict:
+        """Return {key: float32 vector} for the keys that are cached."""
+        with self._lock:
+            found = [(key, self._rows[key]) for key in keys if key in self._rows]
+            if not found:
+                return {}
+            matrix = self._matrix()
+            return {key: np.asarray(matrix[row], dtype=np.float32) for key, row in found}
+
+    def put_many(self, keys: List[str], vectors: List[List[float]]) -> None:
+        with self._lock:
+            new = {}
+            for key, vector in zip(keys, vectors):
+                if key not in self._rows and key not in new:
+                    new[key] = vector
+            if not new:
+                return
+            matrix = np.asarray(list(new.values()), dtype=self.dtype)
+            if self._dim is None:
+                self._dim = matrix.shape[1]
+                tmp_path = self.dir / "dim.tmp"
+                tmp_path.write_text(str(self._dim))
+                os.replace(tmp_path, self.dir / "dim")
+            # Vectors are written before keys, so a key never points past the end of the matrix
+            with open(self._vectors_path, "ab") as f:
+                f.write(matrix.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            with open(self._keys_path, "a", encoding="utf-8") as f:
+                f.write("".join(f"{key}\n" for key in new))
+            for key in new:
+                self._rows[key] = len(self._rows)
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embeddings wrapper that serves embed_documents from an EmbeddingCache and only sends
+    cache misses to the underlying model. Query vectors are kept in an in-memory LRU keyed by
+    the normalized query text, if query_cache is given.
+    """
+
+    def __init__(self, embeddings: Embeddings, cache: EmbeddingCache, query_cache: LRUCache = None):
+        self.embeddings = embeddings
+        self.cache = cache
+        self.query_cache = query_cache
+        self.hits = 0
+        self.misses = 0
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [text_key(text) for text in texts]
+        cached = self.cache.get_many(keys)
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in cached and key not in missing:
+                missing[key] = text
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            vectors = self.embeddings.embed_documents(list(missing.values()))
+            self.cache.put_many(list(missing), vectors)
+            # Round through the cache dtype so hits and misses return identical vectors
+            cached.update(
+                zip(missing, (np.asarray(vector, dtype=self.cache.dtype).astype(np.float32) for vector in vectors))
+            )
+        return [cached[key].tolist() for key in keys]
+
+    def cached_vectors(self, texts: List[str]) -> list:
+        """Cached vector of each text, or None where it is not cached; never calls the model."""
+        keys = [text_key(text) for text in texts]
+        cached = self.cache.get_many(keys)
+        return [cached.get(key) for key in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        if self.query_cache is None:
+            return self.embeddings.embed_query(text)
+        key = normalize_query(text)
+        vector = self.query_cache.get(key)
+        if vector is None:
+            vector = self.embeddings.embed_query(text)
+            self.query_cache.put(key, vector)
+        return vector
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        """
+        Embed many queries in one model call, serving repeated questions from the query cache.
+        Sentence-transformers models encode queries and documents alike, so this matches embed_query.
+        """
+        if self.query_cache is None:
+            return self.embeddings.embed_documents(texts)
+        keys = [normalize_query(text) for text in texts]
+        vectors = {}
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key in vectors or key in missing:
+                continue
+            vector = self.query_cache.get(key)
+            if vector is None:
+                missing[key] = text
+            else:
+                vectors[key] = vector
+        if missing:
+            for key, vector in zip(missing, self.embeddings.embed_documents(list(missing.values()))):
+                self.query_cache.put(key, vector)
+                vectors[key] = vector
+        return [vectors[key] for key in keys]
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "cached_vectors": len(self.cache),
+        }
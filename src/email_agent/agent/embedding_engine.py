@@ -0,0 +1,135 @@
+import os
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import List
+
+from langchain_core.embeddings import Embeddings
+from langchain_huggingface import HuggingFaceEmbeddings
+
+_WORKER_EMBEDDINGS = None
+
+
+def _load_embeddings(model_name: str, batch_size: int) -> HuggingFaceEmbeddings:
+    return HuggingFaceEmbeddings(
+        model_name=model_name,
+        model_kwargs={"device": "cpu"},
+        encode_kwargs={"batch_size": batch_size},
+    )
+
+
+def _init_worker(model_name: str, batch_size: int) -> None:
+    """Load the model once per worker process, pinned to a single core."""
+    global _WORKER_EMBEDDINGS
+    import torch
+
+    torch.set_num_threads(1)
+    _WORKER_EMBEDDINGS = _load_embeddings(model_name, batch_size)
+
+
+def _embed_batch(texts: List[str]) -> List[List[float]]:
+    return _WORKER_EMBEDDINGS.embed_documents(texts)
+
+
+class EmbeddingEngine(Embeddings):
+    """
+    Batched embedding engine for bulk ingestion, producing the same vectors as HuggingFaceEmbeddings.
+    - Texts are sorted by length and cut into batches of batch_size, so each forward pass pads little
+    - With num_workers > 1 the batches are spread over a pool of single-core worker processes
+    - Results are returned in input order, ready for FAISS.from_texts / add_texts
+    """
+
+    def __init__(self, model_name: str, batch_size: int = 64, num_workers: int = 0):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self._local = _load_embeddings(model_name, batch_size)
+        self._pool = None
+
+    @property
+    def tokenizer(self):
+        """Tokenizer of the underlying sentence-transformers model."""
+        return self._local._client.tokenizer
+
+    @property
+    def max_seq_length(self) -> int:
+        """Tokens the model reads per text; anything longer is truncated."""
+        return self._local._client.max_seq_length
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            # spawn, since forking a process that already holds torch/tokenizers state is unsafe
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.num_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(self.model_name, self.batch_size),
+            )
+        return self._pool
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def _length_buckets(self, texts: List[str]) -> List[List[int]]:
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        return [order[i:i + self.batch_size] for i in range(0, len(order), self.batch_size)]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        buckets = self._length_buckets(texts)
+        batches = [[texts[i] for i in bucket] for bucket in buckets]
+        if self.num_workers > 1 and len(batches) > 1:
+            results = self._get_pool().map(_embed_batch, batches)
+        else:
+            results = map(self._local.embed_documents, batches)
+        vectors = [None] * len(texts)
+        for bucket, batch_vectors in zip(buckets, results):
+            for i, vector in zip(bucket, batch_vectors):
+                vectors[i] = vector
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._local.embed_query(text)
+
+
+def benchmark_embedding(n: int = 2000, batch_size: int = 64, workers: tuple = (0, 2, 4)) -> None:
+    """
+    Measure ingestion throughput in emails/second and emails/second per core,
+    and check that every configuration reproduces the default HuggingFaceEmbeddings vectors.
+    """
+    import numpy as np
+    from ..utils.email_store import EmailStore
+
+    model_name = os.getenv("EMBEDDING_MODEL_NAME") or "all-MiniLM-L6-v2"
+    texts = []
+    for email in EmailStore().iter_emails():
+        texts.append(str(email))
+        if len(texts) == n:
+            break
+    if not texts:
+        texts = [f"Meeting {i} about project milestone. " * (1 + i % 40) for i in range(n)]
+
+    start_time = time.perf_counter()
+    reference = HuggingFaceEmbeddings(model_name=model_name, model_kwargs={"device": "cpu"}).embed_documents(texts)
+    elapsed = time.perf_counter() - start_time
+    print(f"[DEFAULT] {len(texts)} emails in {elapsed:.2f}s ({len(texts) / elapsed:.1f} emails/s)")
+
+    for num_workers in workers:
+        engine = EmbeddingEngine(model_name, batch_size=batch_size, num_workers=num_workers)
+        if num_workers > 1:
+            engine.embed_documents(texts[: batch_size * num_workers])  # start and warm up the pool
+        start_time = time.perf_counter()
+        vectors = engine.embed_documents(texts)
+        elapsed = time.perf_counter() - start_time
+        engine.close()
+        cores = max(1, num_workers) if num_workers > 1 else os.cpu_count()
+        same = np.allclose(vectors, reference, atol=1e-5)
+        print(
+            f"[ENGINE workers={num_workers}] {len(texts)} emails in {elapsed:.2f}s "
+            f"({len(texts) / elapsed:.1f} emails/s, {len(texts) / elapsed / cores:.1f} emails/s/core, same vectors: {same})"
+        )
+
+
+if __name__ == "__main__":
+    benchmark_embedding()
@@ -0,0 +1,223 @@
+import json
+import os
+import sys
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING, List
+
+import faiss
+import numpy as np
+from langchain_core.documents import Document
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+from langchain_core.embeddings import Embeddings
+
+if TYPE_CHECKING:
+    from .segmented_store import SegmentedVectorStore
+
+INDEX_TYPES = ("flat", "ivf_flat", "hnsw", "ivf_pq", "ivf_sq8")
+INDEX_CONFIG = "index_config.json"
+# FAISS wants roughly 39 training vectors per IVF centroid
+_MIN_POINTS_PER_CENTROID = 39
+# Each PQ sub-quantizer is a k-means over 2^8 codes, which FAISS refuses to train on fewer points
+_PQ_CODES = 256
+
+
+def default_nlist(n_vectors: int) -> int:
+    return max(1, min(4 * int(np.sqrt(max(n_vectors, 1))), n_vectors // _MIN_POINTS_PER_CENTROID))
+
+
+def too_few_to_train(index_type: str, n_vectors: int, nlist: int = None) -> bool:
+    """Whether index_type is an IVF type and n_vectors cannot train its coarse quantizer (or its PQ codebooks)."""
+    nlist = nlist or default_nlist(n_vectors)
+    if index_type == "ivf_pq" and n_vectors < _PQ_CODES:
+        return True
+    return index_type.startswith("ivf") and n_vectors < nlist * _MIN_POINTS_PER_CENTROID
+
+
+def factory_string(index_type: str, dim: int, n_vectors: int, nlist: int = None, hnsw_m: int = 32, pq_m: int = None) -> str:
+    """
+    Translate an index type into a faiss.index_factory description.
+    IVF types fall back to Flat while there are too few vectors to train the coarse quantizer.
+    """
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type '{index_type}', expected one of {INDEX_TYPES}")
+    nlist = nlist or default_nlist(n_vectors)
+    if too_few_to_train(index_type, n_vectors, nlist):
+        print(f"Only {n_vectors} vectors, too few to train IVF{nlist}; using a flat index.")
+        return "Flat"
+    if index_type == "flat":
+        return "Flat"
+    if index_type == "hnsw":
+        return f"HNSW{hnsw_m},Flat"
+    if index_type == "ivf_flat":
+        return f"IVF{nlist},Flat"
+    if index_type == "ivf_sq8":
+        return f"IVF{nlist},SQ8"
+    # PQ sub-quantizers must divide the dimension; aim for 8 dims per sub-vector
+    pq_m = pq_m or next(m for m in range(max(1, dim // 8), 0, -1) if dim % m == 0)
+    return f"IVF{nlist},PQ{pq_m}x8"
+
+
+def describe_index(index: faiss.Index) -> str:
+    """The faiss.index_factory description of a built index, e.g. "IVF256,PQ48x8" (see factory_string)."""
+    # Keep the argument referenced: the downcast wrapper does not own the index
+    typed = faiss.downcast_index(index)
+    if isinstance(typed, faiss.IndexFlat):
+        return "Flat"
+    if isinstance(typed, faiss.IndexHNSW):
+        return f"HNSW{typed.hnsw.nb_neighbors(1)},Flat"
+    if isinstance(typed, faiss.IndexIVFPQ):
+        return f"IVF{typed.nlist},PQ{typed.pq.M}x{typed.pq.nbits}"
+    if isinstance(typed, faiss.IndexIVFScalarQuantizer):
+        return f"IVF{typed.nlist},SQ8"
+    if isinstance(typed, faiss.IndexIVFFlat):
+        return f"IVF{typed.nlist},Flat"
+    return type(typed).__name__
+
+
+def make_index(index_type: str, vectors: np.ndarray, sample_size: int = 50000, seed: int = 0, **params) -> faiss.Index:
+    """Create an empty index of index_type and train it on a random sample of vectors if needed."""
+    n_vectors, dim = vectors.shape
+    index = faiss.index_factory(dim, factory_string(index_type, dim, n_vectors, **params), faiss.METRIC_L2)
+    if not index.is_trained:
+        rng = np.random.default_rng(seed)
+        sample = vectors[rng.choice(n_vectors, size=min(sample_size, n_vectors), replace=False)]
+        start_time = time.perf_counter()
+        index.train(np.ascontiguousarray(sample, dtype=np.float32))
+        print(f"Trained {index_type} index on {len(sample)} vectors in {time.perf_counter() - start_time:.2f}s")
+    return index
+
+
+def set_search_params(index: faiss.Index, nprobe: int = None, ef_search: int = None) -> None:
+    """Apply query-time knobs: nprobe for IVF indexes, efSearch for HNSW."""
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None and nprobe:
+        ivf.nprobe = nprobe
+    hnsw = getattr(faiss.downcast_index(index), "hnsw", None)
+    if hnsw is not None and ef_search:
+        hnsw.efSearch = ef_search
+
+
+def build_vectorstore(
+    documents: List[Document],
+    embeddings: Embeddings,
+    index_type: str = "flat",
+    nprobe: int = None,
+    ef_search: int = None,
+    vectors=None,
+    **params,
+) -> FAISS:
+    """Embed documents (unless their vectors are given) and index them in a LangChain FAISS store backed by the chosen index type."""
+    texts = [document.page_content for document in documents]
+    vectors = np.asarray(embeddings.embed_documents(texts) if vectors is None else vectors, dtype=np.float32)
+    index = make_index(index_type, vectors, **params)
+    set_search_params(index, nprobe, ef_search)
+    vectorstore = FAISS(embeddings, index, InMemoryDocstore(), {})
+    vectorstore.add_embeddings(zip(texts, vectors.tolist()), metadatas=[document.metadata for document in documents])
+    return vectorstore
+
+
+def save_index_config(path: str, config: dict) -> None:
+    tmp_path = Path(path, INDEX_CONFIG + ".tmp")
+    tmp_path.write_text(json.dumps(config, indent=2))
+    os.replace(tmp_path, Path(path, INDEX_CONFIG))
+
+
+def load_index_config(path: str) -> dict:
+    config_path = Path(path, INDEX_CONFIG)
+    if not config_path.exists():
+        return {"index_type": "flat"}
+    return json.loads(config_path.read_text())
+
+
+def migrate_vectorstore(
+    path: str,
+    embeddings: Embeddings,
+    index_type: str,
+    nprobe: int = None,
+    ef_search: int = None,
+    **params,
+) -> "SegmentedVectorStore":
+    """
+    Rebuild a saved vectorstore with another index type, keeping its docstore and ids.
+    All segments are merged into one new segment of index_type; vectors are reconstructed from the
+    old indexes, so nothing is re-embedded. The new segment replaces the old ones in one manifest swap.
+    """
+    from .lexical_index import LEXICAL_INDEX, BM25Index
+    from .segmented_store import SegmentedVectorStore
+    from .thread_index import THREAD_INDEX, ThreadIndex
+
+    config = {"index_type": index_type, "nprobe": nprobe, "ef_search": ef_search, **params}
+    store = SegmentedVectorStore.load(path, embeddings, config, side_indexes={LEXICAL_INDEX: BM25Index, THREAD_INDEX: ThreadIndex})
+    if store is None:
+        raise FileNotFoundError(f"No vectorstore in '{path}'")
+    store.compact(index_type, full=True, **params)
+    # The factory actually built: IVF types fall back to Flat on small stores
+    factory = store.segment_factories()[0] if store.ntotal else None
+    save_index_config(path, {**config, "factory": factory})
+    print(f"Migrated {store.ntotal} vectors in '{path}' to {index_type} ({factory}).")
+    return store
+
+
+def _report_vectors(n: int, dim: int, seed: int = 0) -> np.ndarray:
+    """Use cached email embeddings if there are enough, else clustered random vectors."""
+    from .embedding_cache import EmbeddingCache
+
+    config_dir = os.getenv("CONFIG_DIR")
+    model_name = os.getenv("EMBEDDING_MODEL_NAME") or "all-MiniLM-L6-v2"
+    if config_dir and Path(config_dir, "embedding_cache").exists():
+        cache = EmbeddingCache(Path(config_dir, "embedding_cache"), model_name)
+        if len(cache) >= n:
+            return np.asarray(cache._matrix()[:n], dtype=np.float32)
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(max(1, n // 100), dim))
+    vectors = centers[rng.integers(len(centers), size=n)] + 0.3 * rng.normal(size=(n, dim))
+    return vectors.astype(np.float32)
+
+
+def recall_latency_report(n: int = 100000, dim: int = 384, n_queries: int = 500, k: int = 10) -> None:
+    """
+    Print recall@k against exact search, mean query latency and index size for each index type
+    over a range of nprobe / efSearch settings, to pick an index per deployment size.
+    """
+    vectors = _report_vectors(n + n_queries, dim)
+    database, queries = vectors[:n], vectors[n:]
+    exact = faiss.IndexFlatL2(database.shape[1])
+    exact.add(database)
+    _, truth = exact.search(queries, k)
+    print(f"{n} vectors, {len(queries)} queries, recall@{k}")
+    print(f"{'index':<10} {'param':<14} {'recall':>7} {'ms/query':>9} {'MB':>8}")
+    for index_type in INDEX_TYPES:
+        index = make_index(index_type, database)
+        index.add(database)
+        size_mb = faiss.serialize_index(index).nbytes / 1e6
+        if index_type == "hnsw":
+            settings = [("efSearch", value) for value in (16, 32, 64, 128)]
+        elif index_type.startswith("ivf"):
+            settings = [("nprobe", value) for value in (1, 4, 16, 64)]
+        else:
+            settings = [("-", None)]
+        for name, value in settings:
+            set_search_params(index, nprobe=value if name == "nprobe" else None, ef_search=value if name == "efSearch" else None)
+            start_time = time.perf_counter()
+            _, found = index.search(queries, k)
+            elapsed = (time.perf_counter() - start_time) / len(queries) * 1000
+            recall = np.mean([len(set(a) & set(b)) / k for a, b in zip(found, truth)])
+            print(f"{index_type:<10} {f'{name}={value}' if value else '-':<14} {recall:>7.3f} {elapsed:>9.3f} {size_mb:>8.1f}")
+
+
+if __name__ == "__main__":
+    # python -m src.email_agent.agent.index_factory [report N | migrate INDEX_TYPE]
+    if len(sys.argv) > 2 and sys.argv[1] == "migrate":
+        from .embedding_engine import EmbeddingEngine
+
+        migrate_vectorstore(
+            os.path.join(os.getenv("CONFIG_DIR"), "ljs_columbia_email_vectorstore.faiss"),
+            EmbeddingEngine(os.getenv("EMBEDDING_MODEL_NAME") or "all-MiniLM-L6-v2"),
+            sys.argv[2],
+            nprobe=int(os.getenv("FAISS_NPROBE") or 0) or None,
+            ef_search=int(os.getenv("FAISS_EF_SEARCH") or 0) or None,
+        )
+    else:
+        recall_latency_report(int(sys.argv[2]) if len(sys.argv) > 2 else 100000)
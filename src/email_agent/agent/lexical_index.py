@@ -0,0 +1,154 @@
+import heapq
+import math
+import re
+from typing import TYPE_CHECKING, List
+
+from langchain_core.documents import Document
+
+if TYPE_CHECKING:
+    from .segmented_store import SegmentedVectorStore
+
+LEXICAL_INDEX = "bm25.pkl"
+# Keeps codes like "CS4111", "INC-004211" or "j.doe@columbia.edu" as single tokens
+_TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[-_.@][a-z0-9]+)*")
+
+
+def tokenize(text: str) -> List[str]:
+    return _TOKEN_PATTERN.findall(text.lower())
+
+
+class BM25Index:
+    """
+    In-process BM25 inverted index over chunk text, keyed by FAISS row position so that
+    lexical hits line up with vector hits and with MetadataIndex candidates.
+    Documents are added incrementally; scoring only touches postings of the query terms.
+    Each vectorstore segment is saved with the index of its own chunks (from_documents), and the
+    segment indexes are merged on load.
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75, common_ratio: float = 0.1):
+        self.k1 = k1
+        self.b = b
+        self.common_ratio = common_ratio
+        self.postings = {}  # term -> {position: term frequency}
+        self.doc_lengths = {}  # position -> number of tokens
+        self._total_length = 0
+
+    def __len__(self) -> int:
+        return len(self.doc_lengths)
+
+    @classmethod
+    def from_vectorstore(cls, vectorstore: "SegmentedVectorStore") -> "BM25Index":
+        index = cls()
+        for position, document in vectorstore.iter_documents():
+            index._add_one(position, document.page_content)
+        return index
+
+    @classmethod
+    def from_documents(cls, positions, documents: List[Document], vectors=None) -> "BM25Index":
+        """Index of one vectorstore segment, whose documents sit at the given positions."""
+        index = cls()
+        for position, document in zip(positions, documents):
+            index._add_one(int(position), document.page_content)
+        return index
+
+    @classmethod
+    def merge(cls, indexes: List["BM25Index"]) -> "BM25Index":
+        """One index over the positions of several (segment) indexes; their positions do not overlap."""
+        merged = cls()
+        for index in indexes:
+            for term, postings in index.postings.items():
+                merged.postings.setdefault(term, {}).update(postings)
+            merged.doc_lengths.update(index.doc_lengths)
+            merged._total_length += index._total_length
+        return merged
+
+    def _add_one(self, position: int, text: str) -> None:
+        tokens = tokenize(text)
+        self.doc_lengths[position] = len(tokens)
+        self._total_length += len(tokens)
+        counts = {}
+        for token in tokens:
+            counts[token] = counts.get(token, 0) + 1
+        for token, count in counts.items():
+            self.postings.setdefault(token, {})[position] = count
+
+    def add(self, start: int, documents: List[Document]) -> None:
+        """Index documents that were added to the vectorstore at positions start, start + 1, ..."""
+        for offset, document in enumerate(documents):
+            self._add_one(start + offset, document.page_content)
+
+    def _term_score(self, idf: float, tf: int, position: int, average_length: float) -> float:
+        norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[position] / average_length)
+        return idf * tf * (self.k1 + 1) / (tf + norm)
+
+    def search(self, query: str, k: int, candidates: set = None) -> List[tuple]:
+        """
+        Return up to k (position, score) pairs, best first, optionally restricted to candidate positions.
+        Terms found in more than common_ratio of the chunks (e.g. "ticket", "the") only rescore chunks
+        already matched by rarer terms instead of scanning their whole posting list, which keeps lookups
+        for codes and names sub-millisecond. A query made only of common terms is scored in full.
+        """
+        if not self.doc_lengths:
+            return []
+        n_docs = len(self.doc_lengths)
+        average_length = self._total_length / n_docs
+        common_df = max(1000, self.common_ratio * n_docs)
+        terms = []
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if postings:
+                idf = math.log(1 + (n_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+                terms.append((idf, postings))
+        rare = [(idf, postings) for idf, postings in terms if len(postings) <= common_df]
+        common = [(idf, postings) for idf, postings in terms if len(postings) > common_df]
+        scores = {}
+        for idf, postings in rare if rare else common:
+            for position, tf in postings.items():
+                if candidates is not None and position not in candidates:
+                    continue
+                scores[position] = scores.get(position, 0.0) + self._term_score(idf, tf, position, average_length)
+        if rare:
+            for idf, postings in common:
+                for position in scores:
+                    tf = postings.get(position)
+                    if tf:
+                        scores[position] += self._term_score(idf, tf, position, average_length)
+        return heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+
+
+def reciprocal_rank_fusion(rankings: List[List[int]], k: int = 60) -> List[int]:
+    """Merge ranked position lists: each list contributes 1 / (k + rank) per item."""
+    scores = {}
+    for ranking in rankings:
+        for rank, position in enumerate(ranking):
+            scores[position] = scores.get(position, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores, key=scores.get, reverse=True)
+
+
+def benchmark_lexical(n: int = 100000, n_queries: int = 1000, seed: int = 0) -> None:
+    """Time incremental adds and top-20 BM25 lookups on synthetic chunks with ticket numbers and course codes."""
+    import random
+    import time
+
+    rng = random.Random(seed)
+    words = [f"word{i}" for i in range(5000)]
+    documents = [
+        Document(page_content=" ".join(rng.choices(words, k=120)) + f" ticket INC-{i:06d} course CS{4000 + i % 500}")
+        for i in range(n)
+    ]
+    index = BM25Index()
+    start_time = time.perf_counter()
+    for start in range(0, n, 1000):
+        index.add(start, documents[start:start + 1000])
+    print(f"[BM25] indexed {n} chunks in {time.perf_counter() - start_time:.2f}s")
+    queries = [f"status of ticket INC-{rng.randrange(n):06d}" for _ in range(n_queries)]
+    start_time = time.perf_counter()
+    for query in queries:
+        index.search(query, 20)
+    elapsed = (time.perf_counter() - start_time) / n_queries * 1000
+    print(f"[BM25] {elapsed:.3f} ms/query over {n} chunks")
+
+
+if __name__ == "__main__":
+    benchmark_lexical()
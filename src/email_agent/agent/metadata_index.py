@@ -0,0 +1,197 @@
+import heapq
+import re
+from bisect import bisect_left
+from datetime import datetime, timedelta
+from typing import TYPE_CHECKING, List
+
+import faiss
+import numpy as np
+from langchain_core.documents import Document
+
+if TYPE_CHECKING:
+    from .segmented_store import SegmentedVectorStore
+
+# Candidate sets up to this size are scored exactly from reconstructed vectors instead of searching the index
+EXACT_SEARCH_LIMIT = 4096
+
+_SENDER_PATTERN = re.compile(r"\bfrom(:\s*|\s+)([\w.@+-]+)", re.IGNORECASE)
+_NOT_SENDERS = {"the", "this", "last", "today", "yesterday", "my", "me", "a", "an", "all", "any"}
+
+
+def _is_known_sender(name: str, senders) -> bool:
+    """Whether name is a whole word of one of the senders (lowercased From headers, see MetadataIndex.by_sender)."""
+    pattern = re.compile(rf"\b{re.escape(name)}\b")
+    return any(pattern.search(sender) for sender in senders)
+
+
+def _sender_filter(text: str, senders) -> str:
+    """
+    The sender named in text: "from:<name>" always, "from <name>" only when name looks like an address or is a
+    known sender, so that "notes from students" searches everything instead of emails from "students".
+    """
+    for match in _SENDER_PATTERN.finditer(text):
+        name = match.group(2).lower()
+        if match.group(1).startswith(":"):
+            return name
+        if name not in _NOT_SENDERS and ("@" in name or _is_known_sender(name, senders)):
+            return name
+    return None
+
+
+def parse_query_filters(text: str, now: datetime = None, senders=()) -> dict:
+    """
+    Pull structured filters out of a question, e.g. "emails from John this week"
+    -> {"sender": "john", "start": <monday 00:00>, "end": None}. Unrecognized parts are ignored.
+    senders are the known senders that a bare "from <name>" is checked against (see _sender_filter).
+    """
+    now = now or datetime.now().astimezone()
+    lowered = text.lower()
+    filters = {}
+    sender = _sender_filter(text, senders)
+    if sender:
+        filters["sender"] = sender
+    today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    week = today - timedelta(days=today.weekday())
+    if "yesterday" in lowered:
+        filters["start"], filters["end"] = today - timedelta(days=1), today
+    elif "today" in lowered:
+        filters["start"] = today
+    elif "last week" in lowered:
+        filters["start"], filters["end"] = week - timedelta(days=7), week
+    elif "this week" in lowered:
+        filters["start"] = week
+    elif "this month" in lowered:
+        filters["start"] = today.replace(day=1)
+    elif match := re.search(r"(?:last|past)\s+(\d+)\s+days?", lowered):
+        filters["start"] = today - timedelta(days=int(match.group(1)))
+    return filters
+
+
+def _timestamp(value) -> int:
+    return int(value.timestamp()) if isinstance(value, datetime) else value
+
+
+class MetadataIndex:
+    """
+    Side indexes from sender, thread and date to FAISS row positions, used to narrow the
+    candidate set before vector search, and from email id to positions, to find the chunks of
+    deleted emails. Also tracks the chunks of near-duplicate emails, which unfiltered vector
+    searches skip. Built from the chunk metadata in the docstore; documents without metadata
+    (indexed before chunking) are not filterable.
+    """
+
+    def __init__(self):
+        self.by_email = {}
+        self.by_sender = {}
+        self.by_thread = {}
+        self._dates = []  # sorted (date_ts, position)
+        self._duplicates = []  # positions of near-duplicate chunks
+        self._duplicate_array = None
+
+    @classmethod
+    def from_vectorstore(cls, vectorstore: "SegmentedVectorStore") -> "MetadataIndex":
+        index = cls()
+        for position, document in vectorstore.iter_documents():
+            index._add_one(position, document.metadata)
+        # Dates were appended unsorted; one sort instead of an insort per chunk
+        index._dates.sort()
+        return index
+
+    def _add_one(self, position: int, metadata: dict) -> None:
+        """Register one chunk; its date is appended to _dates, which the caller sorts afterwards."""
+        if "id" not in metadata:
+            return
+        self.by_email.setdefault(metadata["id"], set()).add(position)
+        self.by_sender.setdefault(metadata["sender"].lower(), set()).add(position)
+        self.by_thread.setdefault(metadata["thread_id"], set()).add(position)
+        if metadata.get("date_ts") is not None:
+            self._dates.append((metadata["date_ts"], position))
+        if metadata.get("duplicate_of") is not None:
+            self._duplicates.append(position)
+            self._duplicate_array = None
+
+    def add(self, start: int, documents: List[Document]) -> None:
+        """Register documents that were added to the index at positions start, start + 1, ..."""
+        n_dates = len(self._dates)
+        for offset, document in enumerate(documents):
+            self._add_one(start + offset, document.metadata)
+        if len(self._dates) > n_dates:
+            # Merge the batch's dates into the sorted list in one pass
+            self._dates = list(heapq.merge(self._dates[:n_dates], sorted(self._dates[n_dates:])))
+
+    def positions_of(self, email_ids) -> set:
+        """Positions of every chunk of the given emails."""
+        return set().union(*(self.by_email.get(email_id, ()) for email_id in email_ids))
+
+    def duplicate_positions(self) -> np.ndarray:
+        """Sorted positions of the chunks of near-duplicate emails (see BaseAgent.chunk_emails)."""
+        if self._duplicate_array is None:
+            self._duplicate_array = np.unique(np.asarray(self._duplicates, dtype=np.int64))
+        return self._duplicate_array
+
+    def _date_range(self, start, end) -> set:
+        low = bisect_left(self._dates, (_timestamp(start),)) if start is not None else 0
+        high = bisect_left(self._dates, (_timestamp(end),)) if end is not None else len(self._dates)
+        return {position for _, position in self._dates[low:high]}
+
+    def candidates(self, sender: str = None, thread_id: str = None, start=None, end=None) -> set:
+        """
+        Intersect the positions matching every given filter. sender matches any part of the
+        From header (name or address). Returns None when no filter applies, i.e. search everything.
+        """
+        selected = None
+        if sender:
+            matched = [positions for key, positions in self.by_sender.items() if sender.lower() in key]
+            if matched:
+                selected = set().union(*matched)
+            else:
+                print(f"No sender matches '{sender}', ignoring the sender filter.")
+        if thread_id:
+            positions = self.by_thread.get(thread_id, set())
+            selected = positions if selected is None else selected & positions
+        if start is not None or end is not None:
+            positions = self._date_range(start, end)
+            selected = positions if selected is None else selected & positions
+        return selected
+
+
+def _search_params(index: faiss.Index, selector: faiss.IDSelector) -> faiss.SearchParameters:
+    """Search parameters restricted to selector, keeping the index's own nprobe / efSearch."""
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        return faiss.SearchParametersIVF(sel=selector, nprobe=ivf.nprobe)
+    hnsw = getattr(faiss.downcast_index(index), "hnsw", None)
+    if hnsw is not None:
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=hnsw.efSearch)
+    return faiss.SearchParameters(sel=selector)
+
+
+def search_index(index: faiss.Index, query_vectors: np.ndarray, k: int, ids: np.ndarray = None, exclude: np.ndarray = None) -> tuple:
+    """
+    (distances, row ids) of the k nearest rows of one FAISS index per query, -1 where there are fewer.
+    With ids (sorted int64 row ids) only those rows are searched: small sets are scored exactly from their
+    reconstructed vectors, so the cost follows the candidate count, not the mailbox size; larger ones go
+    through the index with an id selector. Rows in exclude (deleted chunks) are skipped through a negated
+    id selector.
+    """
+    if ids is None:
+        if exclude is not None and len(exclude):
+            excluded = faiss.IDSelectorBatch(exclude)
+            return index.search(query_vectors, k, params=_search_params(index, faiss.IDSelectorNot(excluded)))
+        return index.search(query_vectors, k)
+    if len(ids) <= EXACT_SEARCH_LIMIT:
+        try:
+            vectors = index.reconstruct_batch(ids)
+            distances = ((vectors[None, :, :] - query_vectors[:, None, :]) ** 2).sum(axis=2)
+            order = np.argsort(distances, axis=1)[:, :k]
+            return np.take_along_axis(distances, order, axis=1), ids[order]
+        except RuntimeError:
+            # IVF indexes without a direct map cannot reconstruct; search through the index instead
+            pass
+    return index.search(query_vectors, k, params=_search_params(index, faiss.IDSelectorBatch(ids)))
+
+
+def vector_search(vectorstore: "SegmentedVectorStore", query: str, k: int, positions: set = None) -> List[int]:
+    """Return the positions of the k nearest chunks to query, optionally restricted to the given positions."""
+    query_vector = np.asarray([vectorstore.embedding_function.embed_query(query)], dtype=np.float32)
+    return vectorstore.search(query_vector, k, None if positions is None else [positions])[0]
@@ -0,0 +1,236 @@
+import os
+import pickle
+import re
+import threading
+import zlib
+from pathlib import Path
+
+import numpy as np
+
+NEAR_DUPLICATES = "near_duplicates.pkl"
+NEAR_DUPLICATES_LOG = "near_duplicates.log"
+_WORD = re.compile(r"\w+")
+# Universal hashing (a * x + b) mod p over 32-bit shingle hashes; a < 2^32 keeps a * x within uint64
+_PRIME = np.uint64(4294967311)
+
+
+def _bands_for(threshold: float, num_perm: int) -> tuple:
+    """
+    (bands, rows) for LSH: the largest collision threshold (1 / bands) ** (1 / rows) that is still at or
+    below the Jaccard threshold, so that pairs above it almost always share a bucket. Candidates are
+    then checked against the threshold with their full signatures.
+    """
+    best = (num_perm, 1)
+    for rows in range(1, num_perm + 1):
+        if num_perm % rows:
+            continue
+        bands = num_perm // rows
+        if (1 / bands) ** (1 / rows) <= threshold:
+            best = (bands, rows)
+    return best
+
+
+class NearDuplicateIndex:
+    """
+    MinHash signatures of indexed email bodies with LSH band buckets, to catch near-identical emails
+    (newsletters, list digests, automated notifications) before they are chunked and embedded.
+    - check(email_id, text): returns the id of an indexed email whose estimated Jaccard similarity over
+      word shingles is at least threshold (the email is linked to it), or registers the email as canonical
+    - bodies shorter than min_words are never treated as duplicates ("Thanks!", "See you then")
+    - stats(): counters for /metrics and the ingest log
+    Each index checkpoint appends what changed since the last one to near_duplicates.log; once the log outgrows
+    the snapshot (near_duplicates.pkl, temp file + os.replace) it is folded into it. Re-checking an email
+    that is already registered returns None, so emails re-read after an interrupted run are indexed again.
+    """
+
+    def __init__(self, threshold: float = 0.8, num_perm: int = 64, shingle_size: int = 3, min_words: int = 20, seed: int = 1):
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self.min_words = min_words
+        self.seed = seed
+        self.bands, self.rows = _bands_for(threshold, num_perm)
+        rng = np.random.RandomState(seed)
+        self._a = rng.randint(1, 2**32 - 1, size=(num_perm, 1), dtype=np.uint64)
+        self._b = rng.randint(0, 2**32 - 1, size=(num_perm, 1), dtype=np.uint64)
+        self._signatures = np.zeros((0, num_perm), dtype=np.uint32)
+        self._ids = []  # row -> email id
+        self._rows = {}  # email id -> row
+        self._buckets = [{} for _ in range(self.bands)]  # band -> bucket key -> rows
+        self.links = {}  # duplicate email id -> canonical email id
+        self.counters = {"checked": 0, "duplicates": 0, "canonical": 0, "too_short": 0, "compared": 0}
+        self._lock = threading.Lock()
+        # Persistence: rows and links not in the snapshot or log yet, and the sizes that decide when to fold the log
+        self._saved_rows = 0
+        self._unsaved_links = []
+        self._needs_snapshot = True
+        self._snapshot_bytes = 0
+        self._log_bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    @property
+    def enabled(self) -> bool:
+        return 0 < self.threshold <= 1
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        state["_signatures"] = self._signatures[:len(self._ids)]
+        state["_saved_rows"], state["_unsaved_links"], state["_needs_snapshot"] = len(self._ids), [], False
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path: str, **config) -> "NearDuplicateIndex":
+        """Load the saved index; if it was built with other parameters, start a new one with config."""
+        snapshot_path = Path(path, NEAR_DUPLICATES)
+        with open(snapshot_path, "rb") as f:
+            index = pickle.load(f)
+        index._snapshot_bytes = snapshot_path.stat().st_size
+        index._replay(Path(path, NEAR_DUPLICATES_LOG))
+        fresh = cls(**config)
+        if (index.num_perm, index.shingle_size, index.seed) != (fresh.num_perm, fresh.shingle_size, fresh.seed):
+            print("Near-duplicate signatures were built with other parameters; starting a new index.")
+            return fresh
+        # Thresholds only change which buckets/candidates count, so they can be updated in place
+        if (index.threshold, index.min_words) != (fresh.threshold, fresh.min_words):
+            index.threshold, index.min_words = fresh.threshold, fresh.min_words
+            if (index.bands, index.rows) != (fresh.bands, fresh.rows):
+                index.bands, index.rows = fresh.bands, fresh.rows
+                index._buckets = [{} for _ in range(index.bands)]
+                for row in range(len(index._ids)):
+                    index._add_to_buckets(row, index._signatures[row])
+        return index
+
+    def _replay(self, log_path: Path) -> None:
+        """Apply the log records after the snapshot. A record torn by a crash is cut off; replaying twice is harmless."""
+        if not log_path.exists():
+            return
+        good = 0
+        with open(log_path, "rb") as f:
+            while True:
+                try:
+                    ids, signatures, links, counters = pickle.load(f)
+                except (EOFError, pickle.UnpicklingError):
+                    break
+                for email_id, signature in zip(ids, signatures):
+                    if email_id not in self._rows:
+                        self._register(email_id, signature)
+                self.links.update(links)
+                self.counters = counters
+                good = f.tell()
+        if good != log_path.stat().st_size:
+            os.truncate(log_path, good)
+        self._saved_rows = len(self._ids)
+        self._log_bytes = good
+
+    def save(self, path: str) -> None:
+        """
+        Append the emails registered and linked since the last save to the log (one fsynced record), so a
+        checkpoint costs what changed. When the log is larger than the snapshot, write a new snapshot instead
+        and empty the log, which keeps the amortized cost per email constant.
+        """
+        snapshot_path, log_path = Path(path, NEAR_DUPLICATES), Path(path, NEAR_DUPLICATES_LOG)
+        with self._lock:
+            if self._needs_snapshot or self._log_bytes > max(self._snapshot_bytes, 1 << 20):
+                tmp_path = Path(path, NEAR_DUPLICATES + ".tmp")
+                with open(tmp_path, "wb") as f:
+                    pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp_path, snapshot_path)
+                # A crash before the log is emptied replays records the snapshot already has, which changes nothing
+                open(log_path, "wb").close()
+                self._snapshot_bytes, self._log_bytes = snapshot_path.stat().st_size, 0
+                self._saved_rows, self._unsaved_links, self._needs_snapshot = len(self._ids), [], False
+                return
+            rows = len(self._ids)
+            record = (self._ids[self._saved_rows:], self._signatures[self._saved_rows:rows].copy(), self._unsaved_links, dict(self.counters))
+            with open(log_path, "ab") as f:
+                pickle.dump(record, f, protocol=pickle.HIGHEST_PROTOCOL)
+                f.flush()
+                os.fsync(f.fileno())
+                self._log_bytes = f.tell()
+            self._saved_rows, self._unsaved_links = rows, []
+
+    def signature(self, text: str) -> np.ndarray:
+        """MinHash signature over word shingles of text, or None if it has fewer than min_words words."""
+        words = _WORD.findall(text.lower())
+        if len(words) < self.min_words:
+            return None
+        size = self.shingle_size
+        shingles = {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+        hashes = np.fromiter((zlib.crc32(shingle.encode("utf-8")) for shingle in shingles), dtype=np.uint64, count=len(shingles))
+        permuted = (self._a * hashes % _PRIME + self._b) % _PRIME
+        return permuted.min(axis=1).astype(np.uint32)
+
+    def _band_keys(self, signature: np.ndarray) -> list:
+        return [signature[band * self.rows:(band + 1) * self.rows].tobytes() for band in range(self.bands)]
+
+    def _add_to_buckets(self, row: int, signature: np.ndarray) -> None:
+        for bucket, key in zip(self._buckets, self._band_keys(signature)):
+            bucket.setdefault(key, []).append(row)
+
+    def _register(self, email_id: str, signature: np.ndarray) -> None:
+        row = len(self._ids)
+        if row == len(self._signatures):
+            grown = np.zeros((max(1024, 2 * row), self.num_perm), dtype=np.uint32)
+            grown[:row] = self._signatures[:row]
+            self._signatures = grown
+        self._signatures[row] = signature
+        self._ids.append(email_id)
+        self._rows[email_id] = row
+        self._add_to_buckets(row, signature)
+
+    def check(self, email_id: str, text: str) -> str:
+        """Return the canonical email id if text is a near-duplicate of an indexed email, else register it and return None."""
+        if not self.enabled:
+            return None
+        signature = self.signature(text)
+        with self._lock:
+            if email_id in self._rows:
+                return None
+            if email_id in self.links:
+                return self.links[email_id]
+            self.counters["checked"] += 1
+            if signature is None:
+                self.counters["too_short"] += 1
+                return None
+            candidates = set()
+            for bucket, key in zip(self._buckets, self._band_keys(signature)):
+                candidates.update(bucket.get(key, ()))
+            if candidates:
+                rows = np.fromiter(candidates, dtype=np.int64, count=len(candidates))
+                similarity = (self._signatures[rows] == signature).mean(axis=1)
+                self.counters["compared"] += len(rows)
+                best = int(np.argmax(similarity))
+                if similarity[best] >= self.threshold:
+                    canonical = self._ids[rows[best]]
+                    self.links[email_id] = canonical
+                    self._unsaved_links.append((email_id, canonical))
+                    self.counters["duplicates"] += 1
+                    return canonical
+            self._register(email_id, signature)
+            self.counters["canonical"] += 1
+            return None
+
+    def duplicates_of(self, email_id: str) -> list:
+        """Ids of the emails linked to email_id as near-duplicates."""
+        with self._lock:
+            return [duplicate for duplicate, canonical in self.links.items() if canonical == email_id]
+
+    def stats(self) -> dict:
+        with self._lock:
+            checked = self.counters["checked"]
+            return {
+                **self.counters,
+                "duplicate_rate": round(self.counters["duplicates"] / checked, 4) if checked else 0.0,
+                "indexed_signatures": len(self._ids),
+                "linked": len(self.links),
+                "threshold": self.threshold,
+                "bands": self.bands,
+                "rows": self.rows,
+            }
@@ -0,0 +1,114 @@
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Continuously refilling bucket: holds at most capacity units and regains capacity units per minute.
+    The level may go negative when usage is charged after the fact (e.g. completion tokens).
+    """
+
+    def __init__(self, capacity: float, per_minute: float):
+        self.capacity = capacity
+        self.rate = per_minute / 60.0
+        self.level = capacity
+        self._updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def available(self) -> float:
+        self._refill()
+        return self.level
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until amount units are available (0 if they are now)."""
+        self._refill()
+        return max(0.0, (amount - self.level) / self.rate)
+
+    def charge(self, amount: float) -> None:
+        self._refill()
+        self.level -= amount
+
+
+class Reservation:
+    def __init__(self, tokens: int):
+        self.tokens = tokens
+
+
+class RateScheduler:
+    """
+    Provider quota scheduler with separate tokens-per-minute and requests-per-minute buckets.
+    acquire() blocks until both buckets have room, serving callers first-come first-served,
+    and gives up with TimeoutError at the deadline instead of dropping the request outright.
+    settle() charges the difference between the reserved and the actual tokens once the
+    completion is known. One scheduler can be shared by every session in the process.
+    """
+
+    def __init__(self, tokens_per_minute: int = 6000, requests_per_minute: int = 30):
+        self.tokens = TokenBucket(tokens_per_minute, tokens_per_minute)
+        self.requests = TokenBucket(requests_per_minute, requests_per_minute)
+        self._condition = threading.Condition()
+        self._next_ticket = 0
+        self._serving = 0
+        self._done = set()
+
+    def acquire(self, tokens: int, timeout: float = None) -> Reservation:
+        """Wait for room for one request of `tokens` tokens; raise TimeoutError after `timeout` seconds."""
+        # A request larger than the bucket could never fit; let it through once the bucket is full
+        tokens = min(tokens, self.tokens.capacity)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            ticket = self._next_ticket
+            self._next_ticket += 1
+            try:
+                while True:
+                    wait = None
+                    if ticket == self._serving:
+                        wait = max(self.tokens.wait_time(tokens), self.requests.wait_time(1))
+                        if wait == 0:
+                            self.tokens.charge(tokens)
+                            self.requests.charge(1)
+                            return Reservation(tokens)
+                    if deadline is not None:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0 or (wait is not None and wait > remaining):
+                            raise TimeoutError(f"No capacity for {tokens} tokens within {timeout}s")
+                        wait = remaining if wait is None else wait
+                    self._condition.wait(wait)
+            finally:
+                # Served or gave up: either way the queue moves past this ticket
+                self._done.add(ticket)
+                while self._serving in self._done:
+                    self._done.discard(self._serving)
+                    self._serving += 1
+                self._condition.notify_all()
+
+    def settle(self, reservation: Reservation, actual_tokens: int) -> None:
+        """Charge (or refund) the difference between the reserved and the actual tokens of a finished request."""
+        with self._condition:
+            self.tokens.charge(actual_tokens - reservation.tokens)
+            reservation.tokens = actual_tokens
+            self._condition.notify_all()
+
+    def status(self) -> dict:
+        with self._condition:
+            return {
+                "tokens_available": int(self.tokens.available()),
+                "requests_available": int(self.requests.available()),
+                "queued": self._next_ticket - self._serving,
+            }
+
+
+_SHARED = {}
+_SHARED_LOCK = threading.Lock()
+
+
+def shared_scheduler(name: str, tokens_per_minute: int, requests_per_minute: int) -> RateScheduler:
+    """Return the process-wide scheduler for a provider/model quota, creating it on first use."""
+    with _SHARED_LOCK:
+        if name not in _SHARED:
+            _SHARED[name] = RateScheduler(tokens_per_minute, requests_per_minute)
+        return _SHARED[name]
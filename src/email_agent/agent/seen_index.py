@@ -0,0 +1,103 @@
+import json
+import os
+import threading
+from pathlib import Path
+from typing import Iterable
+
+
+class SeenIdIndex:
+    """
+    Set of email ids that are already indexed, persisted as an append-only log (one id per line).
+    - Membership checks are O(1) against an in-memory set
+    - add_many appends only the new ids with a single write + fsync
+    - discard_many appends "-<id>" lines for ids whose emails were deleted from the index
+    - compact rewrites the log through a temp file and os.replace, so a crash never leaves it half-written;
+      it runs on its own once the log has more than compact_ratio lines per live id
+    A legacy {"id": [...]} JSON file is migrated on first load. Writes are serialized by a lock, since the
+    pipeline records ids while apply_deletions discards them.
+    """
+
+    def __init__(self, path: Path, legacy_json: Path = None, compact_ratio: float = 2.0):
+        self.path = Path(path)
+        self.compact_ratio = compact_ratio
+        self._ids = set()
+        self._log_lines = 0
+        self._lock = threading.RLock()
+        if self.path.exists():
+            self._load()
+        elif legacy_json is not None and Path(legacy_json).exists():
+            legacy = json.loads(Path(legacy_json).read_text(encoding="utf-8"))
+            self._ids.update(legacy.get("id", []))
+            self.compact()
+
+    def _load(self) -> None:
+        data = self.path.read_text(encoding="utf-8")
+        lines = data.split("\n")
+        # The last element is "" for a clean log; anything else is a write torn by a crash
+        torn = lines.pop() != ""
+        for line in lines:
+            if line.startswith("-"):
+                self._ids.discard(line[1:])
+            elif line:
+                self._ids.add(line)
+        self._log_lines = len(lines)
+        if torn or self._outgrown():
+            self.compact()
+
+    def _outgrown(self) -> bool:
+        return self._log_lines > self.compact_ratio * max(len(self._ids), 1)
+
+    def __contains__(self, email_id: str) -> bool:
+        return email_id in self._ids
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def add_many(self, email_ids: Iterable[str]) -> list[str]:
+        """Record ids as seen and return the ones that were new. Cost is proportional to the new ids."""
+        new_ids = []
+        with self._lock:
+            for email_id in email_ids:
+                if email_id not in self._ids:
+                    self._ids.add(email_id)
+                    new_ids.append(email_id)
+            self._append(new_ids)
+        return new_ids
+
+    def discard_many(self, email_ids: Iterable[str]) -> int:
+        """
+        Forget ids of emails deleted from the index, so the log does not keep them forever. Compacts the
+        log once it outgrows the live ids. Returns the number of ids removed.
+        """
+        with self._lock:
+            removed = [email_id for email_id in dict.fromkeys(email_ids) if email_id in self._ids]
+            if not removed:
+                return 0
+            self._ids.difference_update(removed)
+            # The removal lines would take the log past the ratio: rewrite it instead of appending them
+            if self._log_lines + len(removed) > self.compact_ratio * max(len(self._ids), 1):
+                self.compact()
+            else:
+                self._append(f"-{email_id}" for email_id in removed)
+        return len(removed)
+
+    def _append(self, lines: Iterable[str]) -> None:
+        data = "".join(f"{line}\n" for line in lines)
+        if not data:
+            return
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        self._log_lines += data.count("\n")
+
+    def compact(self) -> None:
+        """Rewrite the log with each live id once, atomically."""
+        with self._lock:
+            tmp_path = self.path.with_suffix(self.path.suffix + ".tmp")
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write("".join(f"{email_id}\n" for email_id in sorted(self._ids)))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+            self._log_lines = len(self._ids)
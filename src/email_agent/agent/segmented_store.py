@@ -0,0 +1,713 @@
+import json
+import os
+import pickle
+import shutil
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Iterator, List
+
+import faiss
+import numpy as np
+from langchain_core.documents import Document
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+from langchain_core.embeddings import Embeddings
+
+from .index_factory import build_vectorstore, describe_index, make_index, set_search_params, too_few_to_train
+from .metadata_index import search_index
+
+MANIFEST = "manifest.json"
+SEGMENTS = "segments"
+# Positions of deleted chunks, one per line; compaction drops their rows
+TOMBSTONES = "tombstones.log"
+# Global positions of a segment's rows, written only when compaction dropped some of them
+POSITIONS = "positions.npy"
+# The single FAISS index (save_local) used before segments; adopted as the first segment on load
+_LEGACY_FILES = ("index.faiss", "index.pkl")
+# Index types that store vectors as they were added, so reconstructing them loses nothing
+_EXACT_INDEXES = (faiss.IndexFlat, faiss.IndexIVFFlat, faiss.IndexHNSWFlat)
+
+
+def _fsync_dir(path) -> None:
+    """Make renames in path durable. Directories cannot be opened for fsync on Windows."""
+    if os.name == "nt":
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _fsync_tree(path) -> None:
+    for file in Path(path).iterdir():
+        with open(file, "rb") as f:
+            os.fsync(f.fileno())
+    _fsync_dir(path)
+
+
+def _merge_hits(parts: list, k: int) -> List[List[int]]:
+    """Merge per-segment (distances, positions) arrays into the k nearest positions per query."""
+    distances = np.concatenate([part[0] for part in parts], axis=1)
+    positions = np.concatenate([part[1] for part in parts], axis=1)
+    distances = np.where(positions == -1, np.inf, distances)
+    order = np.argsort(distances, axis=1, kind="stable")[:, :k]
+    return [[int(position) for position in row if position != -1] for row in np.take_along_axis(positions, order, axis=1)]
+
+
+def _to_local(positions: np.ndarray, ids: np.ndarray) -> np.ndarray:
+    """Row numbers of the sorted global ids that are rows of a segment with the given (sorted) positions."""
+    rows = np.searchsorted(positions, ids)
+    inside = rows < len(positions)
+    rows, ids = rows[inside], ids[inside]
+    return rows[positions[rows] == ids]
+
+
+class _Segment:
+    """
+    A saved FAISS store with the global positions of its rows (sorted). span is the number of positions
+    it covers, including rows compaction dropped, so the positions of later segments never move.
+    """
+    __slots__ = ("name", "store", "positions", "span")
+
+    def __init__(self, name: str, store: FAISS, positions: np.ndarray, span: int = None):
+        self.name = name
+        self.store = store
+        self.positions = positions
+        self.span = len(positions) if span is None else span
+
+    @property
+    def ntotal(self) -> int:
+        return self.store.index.ntotal
+
+
+class SegmentedVectorStore:
+    """
+    Append-only FAISS vector store in the LSM style, kept in one directory:
+    - segments/seg-NNNNNN: immutable LangChain FAISS stores (index + docstore), each holding a run of consecutive positions,
+      with one pickled side index per entry of side_indexes (e.g. BM25 and threads) built from the segment's chunks only
+    - manifest.json: the segments in position order; a write becomes visible only when the manifest is replaced
+    - the tail: chunks added since the last save, in memory
+    save() writes the tail as a new segment and then the manifest (temp file, fsync, os.replace), so a checkpoint
+    costs the size of what was added, not of the mailbox, and a crash at any point leaves the previous manifest
+    and its segments intact. Side indexes are written into the segment directory before it is renamed into place,
+    so they are never behind or ahead of the vectors; side_index(name) merges them on load. Searches fan out
+    over the segments and the tail and merge the hits by distance. Once there are more than max_segments
+    segments, a background thread merges the fan_in adjacent segments with the fewest vectors (and their side
+    indexes) into one segment of the configured index type. Merges keep the order, so positions, which the
+    metadata, BM25 and thread indexes refer to, never change.
+    delete(positions) records tombstones (tombstones.log): searches skip those rows, and merges drop them,
+    keeping the surviving rows at their positions (positions.npy in the merged segment). After a compaction the
+    log is rewritten with only the tombstones of rows that saved segments still hold.
+    add_embeddings and save are called by one writer at a time; searches may run alongside compaction.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        embeddings: Embeddings,
+        index_config: dict = None,
+        side_indexes: dict = None,
+        max_segments: int = 8,
+        fan_in: int = 4,
+    ):
+        self.path = str(path)
+        self.embeddings = embeddings
+        # file name -> class with from_documents(positions, documents, vectors) and merge(indexes) classmethods
+        self.side_indexes = side_indexes or {}
+        self.index_config = {"index_type": "flat", "nprobe": None, "ef_search": None, **(index_config or {})}
+        self.max_segments = max_segments
+        self.fan_in = max(2, fan_in)
+        self._state = ((), None)  # (sealed segments, tail FAISS store or None), replaced as a whole
+        self._deleted = (frozenset(), np.zeros(0, dtype=np.int64))  # tombstoned positions, as a set and sorted
+        self._unsaved_tombstones = set()  # tombstones of tail positions, logged once the tail is saved
+        self._next_segment = 0
+        self._lock = threading.Lock()  # segment names, state swaps and manifest writes
+        self._tombstone_lock = threading.Lock()  # appends to and rewrites of tombstones.log
+        self._compaction_lock = threading.Lock()
+        self._compaction = None
+        self._warned_untrained = False
+        self.counters = {"saves": 0, "segments_written": 0, "compactions": 0, "last_save_seconds": 0.0}
+
+    @property
+    def embedding_function(self) -> Embeddings:
+        return self.embeddings
+
+    @property
+    def ntotal(self) -> int:
+        """Vectors stored, deleted ones that no merge has dropped yet included."""
+        segments, tail = self._state
+        return sum(segment.ntotal for segment in segments) + (tail.index.ntotal if tail is not None else 0)
+
+    @property
+    def saved_positions(self) -> int:
+        """Positions below this are in saved segments."""
+        return sum(segment.span for segment in self._state[0])
+
+    @property
+    def next_position(self) -> int:
+        tail = self._state[1]
+        return self.saved_positions + (tail.index.ntotal if tail is not None else 0)
+
+    def __len__(self) -> int:
+        return self.ntotal
+
+    @classmethod
+    def build(
+        cls, path: str, documents: List[Document], embeddings: Embeddings, index_config: dict = None, vectors=None, **options
+    ) -> "SegmentedVectorStore":
+        """A new store whose first segment is an index of the configured type, trained on documents (embedded unless vectors are given)."""
+        store = cls(path, embeddings, index_config, **options)
+        config = store.index_config
+        tail = build_vectorstore(documents, embeddings, config["index_type"], config["nprobe"], config["ef_search"], vectors=vectors)
+        store._state = ((), tail)
+        return store
+
+    @classmethod
+    def load(cls, path: str, embeddings: Embeddings, index_config: dict = None, **options) -> "SegmentedVectorStore":
+        """
+        Open the store saved in path, or return None if there is none. A directory holding a single FAISS
+        index from before segments is adopted as the first segment (its files are hard-linked, not copied).
+        Files a crashed save or compaction left behind are removed.
+        """
+        store = cls(path, embeddings, index_config, **options)
+        manifest_path = Path(path, MANIFEST)
+        if not manifest_path.exists():
+            if not all(Path(path, name).exists() for name in _LEGACY_FILES):
+                return None
+            store._adopt_legacy()
+        manifest = json.loads(manifest_path.read_text())
+        segments, start = [], 0
+        for entry in manifest["segments"]:
+            segment_path = Path(path, SEGMENTS, entry["name"])
+            # Note: allow_dangerous_deserialization=True is used because we trust our own vectorstore files
+            faiss_store = FAISS.load_local(str(segment_path), embeddings, allow_dangerous_deserialization=True)
+            span = entry.get("span", entry["ntotal"])
+            if (segment_path / POSITIONS).exists():
+                positions = np.load(segment_path / POSITIONS)
+            else:
+                positions = np.arange(start, start + entry["ntotal"], dtype=np.int64)
+            segment = _Segment(entry["name"], faiss_store, positions, span)
+            if segment.ntotal != entry["ntotal"] or len(positions) != entry["ntotal"]:
+                raise ValueError(f"Segment {entry['name']} has {segment.ntotal} vectors, the manifest says {entry['ntotal']}")
+            segments.append(segment)
+            start += span
+        store._state = (tuple(segments), None)
+        store._load_tombstones()
+        store._next_segment = manifest["next_segment"]
+        store._remove_unlisted()
+        store.set_search_params(store.index_config["nprobe"], store.index_config["ef_search"])
+        store._warn_if_untrained()
+        return store
+
+    def _adopt_legacy(self) -> None:
+        name = self._allocate_name()
+        staging = Path(self.path, SEGMENTS, name + ".tmp")
+        shutil.rmtree(staging, ignore_errors=True)
+        staging.mkdir(parents=True)
+        for file in _LEGACY_FILES:
+            try:
+                os.link(Path(self.path, file), staging / file)
+            except OSError:
+                shutil.copy2(Path(self.path, file), staging / file)
+        ntotal = faiss.read_index(str(staging / "index.faiss")).ntotal
+        self._install(staging, name)
+        self._write_manifest([{"name": name, "ntotal": ntotal}])
+        for file in _LEGACY_FILES:
+            Path(self.path, file).unlink()
+        print(f"Converted '{self.path}' to a segmented store ({ntotal} vectors in {name}).")
+
+    def _remove_unlisted(self) -> None:
+        """Delete segment directories the manifest does not list: unfinished writes and merged-away segments."""
+        listed = {segment.name for segment in self._state[0]}
+        segments_path = Path(self.path, SEGMENTS)
+        for entry in segments_path.iterdir() if segments_path.exists() else ():
+            if entry.name not in listed:
+                shutil.rmtree(entry, ignore_errors=True)
+        for file in (MANIFEST + ".tmp", *_LEGACY_FILES):
+            Path(self.path, file).unlink(missing_ok=True)
+
+    def _allocate_name(self) -> str:
+        with self._lock:
+            self._next_segment += 1
+            return f"seg-{self._next_segment - 1:06d}"
+
+    def _install(self, staging: Path, name: str) -> None:
+        """Make a fully written staging directory the segment name (fsync, then rename)."""
+        _fsync_tree(staging)
+        final = Path(self.path, SEGMENTS, name)
+        # Only an unlisted leftover of a crashed write can have this name
+        shutil.rmtree(final, ignore_errors=True)
+        os.replace(staging, final)
+        _fsync_dir(final.parent)
+
+    def _write_segment(self, store: FAISS, side: dict, positions: np.ndarray, span: int = None) -> _Segment:
+        name = self._allocate_name()
+        staging = Path(self.path, SEGMENTS, name + ".tmp")
+        shutil.rmtree(staging, ignore_errors=True)
+        store.save_local(str(staging))
+        for file_name, index in side.items():
+            with open(staging / file_name, "wb") as f:
+                pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+        if span is not None and span != len(positions):
+            np.save(staging / POSITIONS, positions)
+        self._install(staging, name)
+        self.counters["segments_written"] += 1
+        return _Segment(name, store, positions, span)
+
+    def _write_manifest(self, entries: list) -> None:
+        """Atomically replace the manifest: temp file, fsync, os.replace, fsync of the directory."""
+        manifest = {"version": 1, "next_segment": self._next_segment, "segments": entries}
+        tmp_path = Path(self.path, MANIFEST + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, Path(self.path, MANIFEST))
+        _fsync_dir(self.path)
+
+    @staticmethod
+    def _entries(segments) -> list:
+        return [
+            {"name": segment.name, "ntotal": segment.ntotal, **({"span": segment.span} if segment.span != segment.ntotal else {})}
+            for segment in segments
+        ]
+
+    def _runs(self) -> tuple:
+        """(FAISS stores, the positions of their rows, their first positions) of the segments and the tail, as of now."""
+        segments, tail = self._state
+        stores = [segment.store for segment in segments]
+        maps = [segment.positions for segment in segments]
+        starts = list(np.cumsum([0] + [segment.span for segment in segments]))
+        if tail is not None:
+            stores.append(tail)
+            maps.append(np.arange(starts[-1], starts[-1] + tail.index.ntotal, dtype=np.int64))
+        else:
+            starts.pop()
+        return stores, maps, starts
+
+    def add_embeddings(self, texts: List[str], vectors, metadatas: List[dict]) -> int:
+        """Append embedded texts to the in-memory tail. Returns the position of the first one."""
+        start = self.next_position
+        vectors = np.asarray(vectors, dtype=np.float32)
+        with self._lock:
+            segments, tail = self._state
+            if tail is None:
+                # New segments are exact and cheap to write; compaction rebuilds them as the configured index type
+                tail = FAISS(self.embeddings, faiss.IndexFlatL2(vectors.shape[1]), InMemoryDocstore(), {})
+                self._state = (segments, tail)
+        tail.add_embeddings(zip(texts, vectors.tolist()), metadatas=metadatas)
+        return start
+
+    def save(self) -> None:
+        """Write the tail as a new segment and publish it in the manifest; starts a compaction if there are too many segments."""
+        start_time = time.perf_counter()
+        Path(self.path, SEGMENTS).mkdir(parents=True, exist_ok=True)
+        segments, tail = self._state
+        if tail is not None and tail.index.ntotal:
+            start = sum(segment.span for segment in segments)
+            positions = np.arange(start, start + tail.index.ntotal, dtype=np.int64)
+            segment = self._write_segment(tail, self._side_for(positions, tail), positions)
+            with self._lock:
+                # Compaction may have replaced segments meanwhile, but never the tail
+                segments = self._state[0] + (segment,)
+                self._write_manifest(self._entries(segments))
+                self._state = (segments, None)
+            # Tombstones of the tail's positions only mean something once those positions are saved
+            self._log_tombstones(self._unsaved_tombstones)
+            self._unsaved_tombstones = set()
+        elif not Path(self.path, MANIFEST).exists():
+            with self._lock:
+                self._write_manifest(self._entries(self._state[0]))
+        self.counters["saves"] += 1
+        self.counters["last_save_seconds"] = round(time.perf_counter() - start_time, 4)
+        if len(self._state[0]) > self.max_segments:
+            self.compact_in_background()
+        self._warn_if_untrained()
+
+    def segment_factories(self) -> List[str]:
+        """The faiss.index_factory descriptions of the saved segments' indexes, in order."""
+        return [describe_index(segment.store.index) for segment in self._state[0]]
+
+    def _warn_if_untrained(self) -> None:
+        """
+        Say once when an IVF store still has no trained segment although it now holds enough vectors:
+        segments built while there were too few fell back to flat indexes, and compaction only retrains
+        the runs it merges.
+        """
+        segments = self._state[0]
+        index_type = self.index_config["index_type"]
+        if self._warned_untrained or not segments or too_few_to_train(index_type, self.ntotal):
+            return
+        if index_type.startswith("ivf") and all(factory == "Flat" for factory in self.segment_factories()):
+            self._warned_untrained = True
+            print(
+                f"The index holds {self.ntotal} vectors, enough to train {index_type}, but all its segments are flat. "
+                f"Run `python -m src.email_agent.agent.index_factory migrate {index_type}` to rebuild it."
+            )
+
+    @staticmethod
+    def _documents(store: FAISS) -> List[Document]:
+        return [store.docstore.search(store.index_to_docstore_id[i]) for i in range(store.index.ntotal)]
+
+    def _side_for(self, positions, store: FAISS, documents: List[Document] = None, vectors: np.ndarray = None) -> dict:
+        """The side indexes of a segment's chunks, which sit at the given positions."""
+        if not self.side_indexes:
+            return {}
+        documents = self._documents(store) if documents is None else documents
+        vectors = self._vectors(store) if vectors is None else vectors
+        return {name: cls.from_documents(positions, documents, vectors) for name, cls in self.side_indexes.items()}
+
+    def _segment_side(self, segment: _Segment, name: str):
+        """A segment's side index from its directory; built and added there if the segment predates it."""
+        path = Path(self.path, SEGMENTS, segment.name, name)
+        if path.exists():
+            with open(path, "rb") as f:
+                return pickle.load(f)
+        index = self.side_indexes[name].from_documents(segment.positions, self._documents(segment.store), self._vectors(segment.store))
+        tmp_path = path.with_name(name + ".tmp")
+        with open(tmp_path, "wb") as f:
+            pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        return index
+
+    def side_index(self, name: str):
+        """Side index name over all saved segments (the in-memory tail is not included)."""
+        return self.side_indexes[name].merge([self._segment_side(segment, name) for segment in self._state[0]])
+
+    def iter_documents(self) -> Iterator[tuple]:
+        """Yield (position, Document) for every stored chunk, in position order."""
+        stores, maps, _ = self._runs()
+        for store, rows in zip(stores, maps):
+            for offset in range(store.index.ntotal):
+                yield int(rows[offset]), store.docstore.search(store.index_to_docstore_id[offset])
+
+    def documents_at(self, positions: List[int]) -> List[Document]:
+        stores, maps, starts = self._runs()
+        starts = np.asarray(starts)
+        documents = []
+        for position in positions:
+            i = int(np.searchsorted(starts, position, side="right")) - 1
+            store, rows = stores[i], maps[i]
+            documents.append(store.docstore.search(store.index_to_docstore_id[int(np.searchsorted(rows, position))]))
+        return documents
+
+    def _vectors(self, store: FAISS) -> np.ndarray:
+        """
+        Vectors of one FAISS store. Indexes that keep them exactly (flat, IVF-flat, HNSW) give them back.
+        Quantized ones (PQ, SQ8) are served from the embedding cache where it has them, so that merging
+        segments does not quantize vectors a second time; the rest are reconstructed, or re-embedded if
+        the index cannot reconstruct at all.
+        """
+        index = store.index
+        try:
+            vectors = index.reconstruct_n(0, index.ntotal)
+        except RuntimeError:
+            vectors = None
+            if faiss.try_extract_index_ivf(index) is not None:
+                # IVF without a direct map: build one on a copy, the segment may be searched meanwhile
+                index = faiss.clone_index(index)
+                faiss.extract_index_ivf(index).make_direct_map()
+                vectors = index.reconstruct_n(0, index.ntotal)
+        if vectors is not None and isinstance(faiss.downcast_index(store.index), _EXACT_INDEXES):
+            return vectors
+        texts = [document.page_content for document in self._documents(store)]
+        lookup = getattr(self.embeddings, "cached_vectors", None)
+        cached = lookup(texts) if lookup is not None else [None] * len(texts)
+        missing = [i for i, vector in enumerate(cached) if vector is None]
+        if vectors is None and missing:
+            for i, vector in zip(missing, self.embeddings.embed_documents([texts[i] for i in missing])):
+                cached[i] = vector
+        return np.asarray([vector if vector is not None else vectors[i] for i, vector in enumerate(cached)], dtype=np.float32)
+
+    def reconstruct_all(self) -> np.ndarray:
+        """Vectors of all stored chunks, in position order. Raises RuntimeError if a segment's index cannot reconstruct them."""
+        stores, _, _ = self._runs()
+        return np.vstack([store.index.reconstruct_n(0, store.index.ntotal) for store in stores])
+
+    def search(self, query_vectors, k: int, candidates: List[set] = None, exclude: np.ndarray = None) -> List[List[int]]:
+        """
+        Positions of the k nearest chunks per query, searched in every segment and merged by distance.
+        Queries without a candidate filter share one multi-query search per segment; filtered ones only
+        search the segments that hold their candidates, over those candidates (see search_index).
+        Deleted positions are never returned, and the sorted positions in exclude are left out of the
+        unfiltered searches.
+        """
+        query_vectors = np.asarray(query_vectors, dtype=np.float32)
+        candidates = candidates or [None] * len(query_vectors)
+        stores, maps, _ = self._runs()
+        deleted_set, deleted = self._deleted
+        if exclude is not None and len(exclude):
+            deleted = np.union1d(deleted, exclude)
+        results = [[] for _ in query_vectors]
+        unfiltered = [i for i, positions in enumerate(candidates) if positions is None]
+        if unfiltered and stores:
+            parts = []
+            for store, rows in zip(stores, maps):
+                if not len(rows):
+                    continue
+                distances, found = search_index(store.index, query_vectors[unfiltered], k, exclude=_to_local(rows, deleted))
+                parts.append((distances, np.where(found == -1, -1, rows[np.maximum(found, 0)])))
+            for i, hits in zip(unfiltered, _merge_hits(parts, k) if parts else ()):
+                results[i] = hits
+        for i, positions in enumerate(candidates):
+            if not positions:
+                continue
+            ids = np.fromiter(sorted(positions - deleted_set if deleted_set else positions), dtype=np.int64)
+            parts = []
+            for store, rows in zip(stores, maps):
+                local = _to_local(rows, ids)
+                if len(local):
+                    distances, found = search_index(store.index, query_vectors[i:i + 1], k, local)
+                    parts.append((distances, np.where(found == -1, -1, rows[np.maximum(found, 0)])))
+            if parts:
+                results[i] = _merge_hits(parts, k)[0]
+        return results
+
+    def delete(self, positions) -> int:
+        """
+        Tombstone chunk positions: searches skip them from now on and merges drop their rows. Tombstones of
+        saved positions are logged (fsynced) before returning; those of the tail when it is saved.
+        Returns the number of newly deleted positions.
+        """
+        new = set(positions) - self._deleted[0]
+        if not new:
+            return 0
+        with self._lock:
+            deleted = self._deleted[0] | new
+            self._deleted = (deleted, np.fromiter(sorted(deleted), dtype=np.int64, count=len(deleted)))
+        saved = self.saved_positions
+        self._log_tombstones(position for position in new if position < saved)
+        self._unsaved_tombstones.update(position for position in new if position >= saved)
+        return len(new)
+
+    def is_deleted(self, position: int) -> bool:
+        return position in self._deleted[0]
+
+    def _load_tombstones(self) -> None:
+        path = Path(self.path, TOMBSTONES)
+        if not path.exists():
+            return
+        lines = path.read_text(encoding="utf-8").split("\n")
+        # The last element is "" for a clean log; anything else is a write torn by a crash
+        if lines.pop() != "":
+            tmp_path = Path(self.path, TOMBSTONES + ".tmp")
+            tmp_path.write_text("".join(f"{line}\n" for line in lines), encoding="utf-8")
+            os.replace(tmp_path, path)
+        deleted = frozenset(int(line) for line in lines if line)
+        self._deleted = (deleted, np.fromiter(sorted(deleted), dtype=np.int64, count=len(deleted)))
+
+    def _log_tombstones(self, positions) -> None:
+        lines = "".join(f"{position}\n" for position in sorted(positions))
+        if not lines:
+            return
+        with self._tombstone_lock, open(Path(self.path, TOMBSTONES), "a", encoding="utf-8") as f:
+            f.write(lines)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _rewrite_tombstones(self) -> None:
+        """
+        Rewrite tombstones.log (temp file, fsync, os.replace) with the tombstones of rows that saved segments
+        still hold. Merges drop deleted rows for good, so their tombstones would only grow the log. The
+        in-memory tombstones are kept, since the metadata and BM25 indexes of this process still list those rows.
+        """
+        with self._tombstone_lock:
+            segments, deleted = self._state[0], self._deleted[1]
+            held = np.concatenate([segment.positions for segment in segments]) if segments else np.zeros(0, dtype=np.int64)
+            kept = deleted[np.isin(deleted, held)]
+            tmp_path = Path(self.path, TOMBSTONES + ".tmp")
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write("".join(f"{position}\n" for position in kept.tolist()))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, Path(self.path, TOMBSTONES))
+            _fsync_dir(self.path)
+
+    def set_search_params(self, nprobe: int = None, ef_search: int = None) -> None:
+        """Apply nprobe / efSearch to every segment, and to the segments compaction builds later."""
+        self.index_config["nprobe"], self.index_config["ef_search"] = nprobe, ef_search
+        for store in self._runs()[0]:
+            set_search_params(store.index, nprobe, ef_search)
+
+    def compact(self, index_type: str = None, full: bool = False, **params) -> int:
+        """
+        Merge segments on the calling thread until at most max_segments remain, or all of them into one
+        with full=True. Merged segments are rebuilt as index_type (the store's index type by default), and
+        tombstones of the rows they dropped leave tombstones.log. Returns the number of merges.
+        """
+        index_type = index_type or self.index_config["index_type"]
+        merges = 0
+        with self._compaction_lock:
+            while True:
+                segments = self._state[0]
+                if full:
+                    if not segments:
+                        break
+                    run = segments
+                elif len(segments) > self.max_segments:
+                    width = min(self.fan_in, len(segments))
+                    sizes = [segment.ntotal for segment in segments]
+                    first = min(range(len(segments) - width + 1), key=lambda i: sum(sizes[i:i + width]))
+                    run = segments[first:first + width]
+                else:
+                    break
+                self._merge(run, index_type, **params)
+                merges += 1
+                if full:
+                    break
+            if merges and self._deleted[0]:
+                self._rewrite_tombstones()
+        return merges
+
+    def _merge(self, run: tuple, index_type: str, **params) -> None:
+        start_time = time.perf_counter()
+        deleted = self._deleted[1]
+        keep = [~np.isin(segment.positions, deleted) for segment in run]
+        positions = np.concatenate([segment.positions[rows] for segment, rows in zip(run, keep)])
+        vectors = np.vstack([self._vectors(segment.store)[rows] for segment, rows in zip(run, keep)])
+        docstore_ids = [segment.store.index_to_docstore_id[i] for segment, rows in zip(run, keep) for i in np.flatnonzero(rows).tolist()]
+        documents = {}
+        for segment in run:
+            documents.update(segment.store.docstore._dict)
+        documents = {docstore_id: documents[docstore_id] for docstore_id in docstore_ids}
+        if all(rows.all() for rows in keep):
+            side = {name: cls.merge([self._segment_side(segment, name) for segment in run]) for name, cls in self.side_indexes.items()}
+        else:
+            # Deleted chunks leave the BM25 and thread indexes with their rows
+            side = self._side_for(positions, None, [documents[docstore_id] for docstore_id in docstore_ids], vectors)
+        if len(vectors):
+            index = make_index(index_type, vectors, **params)
+            index.add(vectors)
+        else:
+            index = faiss.IndexFlatL2(run[0].store.index.d)
+        set_search_params(index, self.index_config["nprobe"], self.index_config["ef_search"])
+        merged = self._write_segment(
+            FAISS(self.embeddings, index, InMemoryDocstore(documents), dict(enumerate(docstore_ids))),
+            side,
+            positions,
+            sum(segment.span for segment in run),
+        )
+        with self._lock:
+            segments, tail = self._state
+            # Saves only append, so the run is still in place, just maybe followed by new segments
+            first = next(i for i, segment in enumerate(segments) if segment is run[0])
+            segments = segments[:first] + (merged,) + segments[first + len(run):]
+            self._write_manifest(self._entries(segments))
+            self._state = (segments, tail)
+        for segment in run:
+            shutil.rmtree(Path(self.path, SEGMENTS, segment.name), ignore_errors=True)
+        self.counters["compactions"] += 1
+        print(f"Compacted {len(run)} segments ({len(vectors)} vectors) into {merged.name} in {time.perf_counter() - start_time:.2f}s")
+
+    def compact_in_background(self) -> None:
+        """Start compact() on a daemon thread unless one is running. A process exit mid-merge loses nothing."""
+        if self._compaction is not None and self._compaction.is_alive():
+            return
+        self._compaction = threading.Thread(target=self._compact_logged, name="vectorstore-compaction", daemon=True)
+        self._compaction.start()
+
+    def _compact_logged(self) -> None:
+        try:
+            self.compact()
+        except Exception as e:
+            print(f"Error compacting vectorstore segments: {e}")
+
+    def wait_for_compaction(self) -> None:
+        if self._compaction is not None:
+            self._compaction.join()
+
+    def stats(self) -> dict:
+        segments, tail = self._state
+        return {
+            **self.counters,
+            "vectors": self.ntotal,
+            "deleted": len(self._deleted[0]),
+            "segments": len(segments),
+            "largest_segment": max((segment.ntotal for segment in segments), default=0),
+            "indexes": sorted(set(self.segment_factories())),
+            "unsaved": tail.index.ntotal if tail is not None else 0,
+        }
+
+
+def benchmark(path: str, sizes: tuple = (10_000, 50_000, 200_000), batch: int = 100, dim: int = 384) -> None:
+    """
+    Time one index checkpoint of batch new chunks on top of n indexed ones, side indexes included.
+    Before: save_local of the whole FAISS store plus whole pickles of the BM25, thread and near-duplicate
+    indexes. Now: SegmentedVectorStore.save, which writes the new segment with its BM25 and thread indexes
+    and the manifest, plus an append to the near-duplicate log.
+    """
+    import random
+
+    from .chunker import _header
+    from .lexical_index import LEXICAL_INDEX, BM25Index
+    from .near_duplicates import NearDuplicateIndex
+    from .thread_index import THREAD_INDEX, ThreadIndex
+
+    rng = np.random.default_rng(0)
+    words = [f"word{i}" for i in range(5000)]
+    for n in sizes:
+        vectors = rng.normal(size=(n + batch, dim)).astype(np.float32)
+        word_rng = random.Random(n)
+        metadatas = [
+            {"id": f"{i:016x}", "thread_id": f"{i // 4:016x}", "subject": f"Report {i // 4}", "sender": f"user{i % 500}@columbia.edu", "date": "Mon, 1 Jan 2024"}
+            for i in range(n + batch)
+        ]
+        bodies = [" ".join(word_rng.choices(words, k=40)) + f"\nTicket INC-{i:06d} needs review." for i in range(n + batch)]
+        texts = [_header(metadata["subject"], metadata["sender"], metadata["date"]) + body for metadata, body in zip(metadatas, bodies)]
+        documents = [Document(page_content=text, metadata=metadata) for text, metadata in zip(texts, metadatas)]
+        lexical, threads, near_duplicates = BM25Index(), ThreadIndex(), NearDuplicateIndex()
+        lexical.add(0, documents)
+        threads.add(documents, vectors)
+        for metadata, body in zip(metadatas[:n], bodies[:n]):
+            near_duplicates.check(metadata["id"], body)
+
+        segmented_path = Path(path, f"segmented-{n}")
+        store = SegmentedVectorStore(segmented_path, None, side_indexes={LEXICAL_INDEX: BM25Index, THREAD_INDEX: ThreadIndex})
+        for first in range(0, n, 10_000):
+            # In slices: add_embeddings makes Python lists of the vectors
+            last = min(first + 10_000, n)
+            store.add_embeddings(texts[first:last], vectors[first:last], metadatas[first:last])
+        store.save()
+        near_duplicates.save(segmented_path)
+        store.add_embeddings(texts[n:], vectors[n:], metadatas[n:])
+        for metadata, body in zip(metadatas[n:], bodies[n:]):
+            near_duplicates.check(metadata["id"], body)
+
+        whole_path = Path(path, f"whole-{n}")
+        whole = FAISS(None, faiss.IndexFlatL2(dim), InMemoryDocstore(), {})
+        for first in range(0, n + batch, 10_000):
+            last = first + 10_000
+            whole.add_embeddings(zip(texts[first:last], vectors[first:last].tolist()), metadatas=metadatas[first:last])
+        start_time = time.perf_counter()
+        whole.save_local(str(whole_path))
+        faiss_time = time.perf_counter() - start_time
+        for name, index in ((LEXICAL_INDEX, lexical), (THREAD_INDEX, threads), ("near_duplicates.pkl", near_duplicates)):
+            with open(whole_path / name, "wb") as f:
+                pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+        whole_time = time.perf_counter() - start_time
+        whole_bytes = sum(file.stat().st_size for file in whole_path.iterdir())
+        del whole
+        shutil.rmtree(whole_path)
+
+        before = sum(file.stat().st_size for file in segmented_path.rglob("*") if file.is_file())
+        start_time = time.perf_counter()
+        store.save()
+        near_duplicates.save(segmented_path)
+        segmented_time = time.perf_counter() - start_time
+        written = sum(file.stat().st_size for file in segmented_path.rglob("*") if file.is_file()) - before
+        print(
+            f"n={n}: whole save {whole_time * 1000:.0f} ms ({faiss_time * 1000:.0f} ms FAISS, {whole_bytes / 2**20:.1f} MiB), "
+            f"segmented save {segmented_time * 1000:.1f} ms ({written / 2**10:.0f} KiB) for {batch} new chunks"
+        )
+        del store, lexical, threads, near_duplicates, documents
+        shutil.rmtree(segmented_path)
+
+
+if __name__ == "__main__":
+    # python -m src.email_agent.agent.segmented_store --benchmark [DIR]
+    if "--benchmark" in sys.argv:
+        arguments = [argument for argument in sys.argv[1:] if argument != "--benchmark"]
+        benchmark(arguments[0] if arguments else os.getenv("CONFIG_DIR") or ".")
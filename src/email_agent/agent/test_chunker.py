@@ -0,0 +1,47 @@
+import re
+
+from ..utils.email_sample import EmailSample
+from .chunker import EmailChunker, _header
+
+
+class WordTokenizer:
+    """One token per word, with the offsets a fast Hugging Face tokenizer returns."""
+
+    def __call__(self, text, add_special_tokens=False, return_offsets_mapping=False):
+        spans = [match.span() for match in re.finditer(r"\S+", text)]
+        encoding = {"input_ids": list(range(len(spans)))}
+        if return_offsets_mapping:
+            encoding["offset_mapping"] = spans
+        return encoding
+
+
+def _email(content: str) -> EmailSample:
+    return EmailSample(
+        id="a", thread_id="t", subject="Lab schedule", sender="Alice <alice@columbia.edu>", date="Mon, 1 Jul 2024 10:00:00 +0000", content=content
+    )
+
+
+def test_short_body_is_one_chunk_with_header_and_metadata():
+    [document] = EmailChunker(WordTokenizer()).chunk(_email("See you at 3pm."))
+    assert document.page_content == _header("Lab schedule", "Alice <alice@columbia.edu>", "Mon, 1 Jul 2024 10:00:00 +0000") + "See you at 3pm."
+    assert document.metadata["date_ts"] == 1719828000 and document.metadata["n_chunks"] == 1
+
+
+def test_chunks_fit_the_window_and_overlap():
+    tokenizer = WordTokenizer()
+    chunker = EmailChunker(tokenizer, max_tokens=40, overlap=4)
+    documents = chunker.chunk(_email(" ".join(f"w{i}" for i in range(100))))
+    bodies = [document.page_content.split("\n")[-1] for document in documents]
+    assert all(len(tokenizer(document.page_content)["input_ids"]) <= 40 - 2 for document in documents)
+    assert bodies[0].split()[-4:] == bodies[1].split()[:4]
+    assert bodies[-1].endswith("w99")
+
+
+def test_overlap_is_capped_at_a_quarter_of_the_window():
+    header = _header("Lab schedule", "Alice <alice@columbia.edu>", "Mon, 1 Jul 2024 10:00:00 +0000")
+    budget = 64 - len(WordTokenizer()(header)["input_ids"]) - 2
+    # An uncapped overlap of 48 would step one token at a time and cut 152 chunks
+    chunker = EmailChunker(WordTokenizer(), max_tokens=64, overlap=budget - 1)
+    documents = chunker.chunk(_email(" ".join(f"w{i}" for i in range(200))))
+    step = budget - budget // 4
+    assert len(documents) == -(-(200 - budget) // step) + 1 == 6
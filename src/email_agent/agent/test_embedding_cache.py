@@ -0,0 +1,46 @@
+import numpy as np
+
+from .embedding_cache import EmbeddingCache, text_key
+
+
+def _cache(tmp_path) -> EmbeddingCache:
+    return EmbeddingCache(tmp_path, "model")
+
+
+def test_vectors_round_trip(tmp_path):
+    cache = _cache(tmp_path)
+    cache.put_many([text_key("a"), text_key("b")], [[1.0, 2.0], [3.0, 4.0]])
+    found = _cache(tmp_path).get_many([text_key("b"), text_key("missing")])
+    assert list(found) == [text_key("b")]
+    np.testing.assert_array_equal(found[text_key("b")], [3.0, 4.0])
+
+
+def test_orphaned_vector_rows_are_truncated(tmp_path):
+    cache = _cache(tmp_path)
+    cache.put_many(["k1", "k2"], [[1.0, 1.0], [2.0, 2.0]])
+    # A crash after writing a vector but before its key
+    with open(cache._vectors_path, "ab") as f:
+        f.write(np.asarray([[9.0, 9.0]], dtype=np.float32).tobytes())
+    reopened = _cache(tmp_path)
+    assert len(reopened) == 2
+    reopened.put_many(["k3"], [[3.0, 3.0]])
+    np.testing.assert_array_equal(_cache(tmp_path).get_many(["k3"])["k3"], [3.0, 3.0])
+
+
+def test_torn_key_is_dropped(tmp_path):
+    cache = _cache(tmp_path)
+    cache.put_many(["k1"], [[1.0, 1.0]])
+    with open(cache._keys_path, "a", encoding="utf-8") as f:
+        f.write("k2-torn")
+    reopened = _cache(tmp_path)
+    assert len(reopened) == 1
+    reopened.put_many(["k2"], [[2.0, 2.0]])
+    assert cache._keys_path.read_text(encoding="utf-8") == "k1\nk2\n"
+    np.testing.assert_array_equal(_cache(tmp_path).get_many(["k2"])["k2"], [2.0, 2.0])
+
+
+def test_vectors_without_dim_file_are_discarded(tmp_path):
+    cache = _cache(tmp_path)
+    cache._vectors_path.write_bytes(np.zeros(4, dtype=np.float32).tobytes())
+    reopened = _cache(tmp_path)
+    assert len(reopened) == 0 and cache._vectors_path.stat().st_size == 0
@@ -0,0 +1,25 @@
+import numpy as np
+
+from .index_factory import describe_index, factory_string, make_index, too_few_to_train
+
+
+def _vectors(n: int, dim: int = 16) -> np.ndarray:
+    return np.random.default_rng(0).normal(size=(n, dim)).astype(np.float32)
+
+
+def test_ivf_falls_back_to_flat_below_the_training_minimum():
+    assert too_few_to_train("ivf_flat", 300, nlist=64) and not too_few_to_train("hnsw", 300, nlist=64)
+    # Enough for IVF5 but not for the 256 codes of each PQ sub-quantizer
+    assert not too_few_to_train("ivf_flat", 200, nlist=5) and too_few_to_train("ivf_pq", 200, nlist=5)
+    assert factory_string("ivf_pq", 384, 200) == "Flat"
+    assert factory_string("ivf_pq", 384, 100000) == "IVF1264,PQ48x8"
+
+
+def test_describe_index_names_what_was_built():
+    vectors = _vectors(2000)
+    assert describe_index(make_index("flat", vectors)) == "Flat"
+    assert describe_index(make_index("hnsw", vectors, hnsw_m=16)) == "HNSW16,Flat"
+    assert describe_index(make_index("ivf_flat", vectors, nlist=8)) == "IVF8,Flat"
+    assert describe_index(make_index("ivf_sq8", vectors, nlist=8)) == "IVF8,SQ8"
+    # A requested IVF type that could not be trained is recorded as the flat index actually used
+    assert describe_index(make_index("ivf_pq", _vectors(100))) == "Flat"
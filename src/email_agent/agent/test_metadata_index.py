@@ -0,0 +1,48 @@
+from datetime import datetime, timezone
+
+from langchain_core.documents import Document
+
+from .metadata_index import MetadataIndex, parse_query_filters
+
+NOW = datetime(2024, 7, 10, 15, 0, tzinfo=timezone.utc)  # a Wednesday
+
+
+def _chunk(email_id: str, sender: str, date_ts: int, **extra) -> Document:
+    metadata = {"id": email_id, "thread_id": f"t{email_id}", "sender": sender, "date_ts": date_ts, **extra}
+    return Document(page_content="", metadata=metadata)
+
+
+SENDERS = {"john smith <jsmith@columbia.edu>": {0}, "registrar <registrar@columbia.edu>": {1}}
+
+
+def test_query_filters():
+    filters = parse_query_filters("emails from John this week", now=NOW, senders=SENDERS)
+    assert filters["sender"] == "john" and filters["start"] == datetime(2024, 7, 8, tzinfo=timezone.utc)
+    assert "sender" not in parse_query_filters("anything from last week", now=NOW, senders=SENDERS)
+    assert parse_query_filters("what happened in the past 3 days", now=NOW)["start"] == datetime(2024, 7, 7, tzinfo=timezone.utc)
+
+
+def test_only_addresses_known_senders_and_from_colon_become_sender_filters():
+    assert parse_query_filters("notes from students about the exam", senders=SENDERS) == {}
+    assert parse_query_filters("notes from students forwarded from registrar", senders=SENDERS) == {"sender": "registrar"}
+    assert parse_query_filters("anything from jsmith@columbia.edu?")["sender"] == "jsmith@columbia.edu"
+    assert parse_query_filters("from:students exam notes")["sender"] == "students"
+
+
+def test_candidates_intersect_sender_and_dates_added_out_of_order():
+    index = MetadataIndex()
+    index.add(0, [_chunk("a", "Alice <alice@columbia.edu>", 300), _chunk("b", "Bob <bob@columbia.edu>", 100)])
+    index.add(2, [_chunk("c", "Alice <alice@columbia.edu>", 200), _chunk("c", "Alice <alice@columbia.edu>", 200)])
+    assert index.candidates(sender="alice") == {0, 2, 3}
+    assert index.candidates(start=150, end=300) == {2, 3}
+    assert index.candidates(sender="alice", start=250) == {0}
+    assert index.positions_of(["c"]) == {2, 3}
+    assert index.candidates() is None
+
+
+def test_near_duplicate_chunks_are_tracked():
+    index = MetadataIndex()
+    index.add(0, [_chunk("a", "List <list@columbia.edu>", 100), _chunk("b", "List <list@columbia.edu>", 100, duplicate_of="a")])
+    assert index.duplicate_positions().tolist() == [1]
+    index.add(2, [_chunk("c", "List <list@columbia.edu>", 100, duplicate_of="a")])
+    assert index.duplicate_positions().tolist() == [1, 2]
@@ -0,0 +1,48 @@
+from pathlib import Path
+
+from .near_duplicates import NEAR_DUPLICATES_LOG, NearDuplicateIndex
+
+DIGEST = " ".join(f"Seminar {i} on quantum materials meets in room {300 + i} at noon." for i in range(8))
+
+
+def _variant(text: str) -> str:
+    # A mailing-list copy of the same digest with a different footer
+    return text + " Unsubscribe from this list at any time."
+
+
+def test_near_identical_emails_are_linked_to_the_first():
+    index = NearDuplicateIndex()
+    assert index.check("a", DIGEST) is None
+    assert index.check("b", _variant(DIGEST)) == "a"
+    assert index.check("c", "Thanks, see you then!") is None
+    assert index.duplicates_of("a") == ["b"]
+    assert index.stats()["too_short"] == 1
+    # Re-checking a canonical email after an interrupted run indexes it again instead of linking it to itself
+    assert index.check("a", DIGEST) is None
+
+
+def test_log_records_are_replayed_after_the_snapshot(tmp_path):
+    index = NearDuplicateIndex()
+    index.check("a", DIGEST)
+    index.save(str(tmp_path))
+    index.check("b", _variant(DIGEST))
+    index.check("c", " ".join(f"Budget line {i} is approved for the fiscal year." for i in range(5)))
+    index.save(str(tmp_path))
+    assert Path(tmp_path, NEAR_DUPLICATES_LOG).stat().st_size > 0
+    loaded = NearDuplicateIndex.load(str(tmp_path))
+    assert len(loaded) == 2 and loaded.links == {"b": "a"}
+
+
+def test_torn_log_record_is_cut_off(tmp_path):
+    index = NearDuplicateIndex()
+    index.check("a", DIGEST)
+    index.save(str(tmp_path))
+    index.check("b", _variant(DIGEST))
+    index.save(str(tmp_path))
+    log_path = Path(tmp_path, NEAR_DUPLICATES_LOG)
+    good = log_path.stat().st_size
+    with open(log_path, "ab") as f:
+        f.write(b"\x80\x05torn")
+    loaded = NearDuplicateIndex.load(str(tmp_path))
+    assert loaded.links == {"b": "a"}
+    assert log_path.stat().st_size == good
@@ -0,0 +1,46 @@
+import threading
+
+from .base_agent import BaseAgent
+from .rate_limiter import RateScheduler
+
+
+class WordCounter:
+    def count(self, text: str) -> int:
+        return len(text.split())
+
+
+def _agent(scheduler: RateScheduler) -> BaseAgent:
+    # Only the rate limiting attributes; the model and index are not needed
+    agent = BaseAgent.__new__(BaseAgent)
+    agent.rate_scheduler = scheduler
+    agent.token_counter = WordCounter()
+    agent.expected_completion_tokens = 100
+    agent.rate_limit_timeout = 5
+    return agent
+
+
+def test_settle_refunds_the_unused_reservation():
+    scheduler = RateScheduler(tokens_per_minute=1000, requests_per_minute=10)
+    reservation = scheduler.acquire(600)
+    scheduler.settle(reservation, 200)
+    assert 790 <= scheduler.status()["tokens_available"] <= 800
+
+
+def test_concurrent_turns_settle_their_own_reservations():
+    scheduler = RateScheduler(tokens_per_minute=100000, requests_per_minute=100)
+    agent = _agent(scheduler)
+    reservations = {}
+    both_reserved = threading.Barrier(2)
+
+    def turn(prompt_tokens: int) -> None:
+        reservation = agent._check_token_limit("", prompt_tokens)
+        both_reserved.wait()
+        agent._settle_token_usage(reservation, prompt_tokens, "four words of answer")
+        reservations[prompt_tokens] = reservation
+
+    threads = [threading.Thread(target=turn, args=(prompt_tokens,)) for prompt_tokens in (50, 5000)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert reservations[50].tokens == 54 and reservations[5000].tokens == 5004
@@ -0,0 +1,47 @@
+import json
+
+from .seen_index import SeenIdIndex
+
+
+def test_only_new_ids_are_appended(tmp_path):
+    index = SeenIdIndex(tmp_path / "seen.log")
+    assert index.add_many(["a", "b"]) == ["a", "b"]
+    assert index.add_many(["b", "c"]) == ["c"]
+    assert (tmp_path / "seen.log").read_text() == "a\nb\nc\n"
+    assert "c" in SeenIdIndex(tmp_path / "seen.log")
+
+
+def test_torn_tail_is_dropped_and_rewritten(tmp_path):
+    (tmp_path / "seen.log").write_text("a\nb\nc")
+    index = SeenIdIndex(tmp_path / "seen.log")
+    # The id whose line was cut short was never saved, so it is indexed again
+    assert "c" not in index and len(index) == 2
+    assert (tmp_path / "seen.log").read_text() == "a\nb\n"
+
+
+def test_legacy_json_is_migrated(tmp_path):
+    (tmp_path / "seen.json").write_text(json.dumps({"id": ["b", "a"]}))
+    index = SeenIdIndex(tmp_path / "seen.log", legacy_json=tmp_path / "seen.json")
+    assert "a" in index and "b" in index
+    assert (tmp_path / "seen.log").read_text() == "a\nb\n"
+
+
+def test_discarded_ids_stay_discarded_after_a_restart(tmp_path):
+    index = SeenIdIndex(tmp_path / "seen.log")
+    index.add_many(["a", "b", "c", "d"])
+    assert index.discard_many(["b", "x"]) == 1
+    assert (tmp_path / "seen.log").read_text() == "a\nb\nc\nd\n-b\n"
+    reopened = SeenIdIndex(tmp_path / "seen.log")
+    assert "b" not in reopened and len(reopened) == 3
+
+
+def test_log_is_compacted_once_it_outgrows_the_live_ids(tmp_path):
+    index = SeenIdIndex(tmp_path / "seen.log")
+    index.add_many([f"m{i}" for i in range(10)])
+    index.discard_many([f"m{i}" for i in range(3)])
+    assert len((tmp_path / "seen.log").read_text().splitlines()) == 13
+    # 13 lines + 4 removals > 2 x 3 live ids: the log is rewritten with the live ids only
+    index.discard_many([f"m{i}" for i in range(3, 7)])
+    assert (tmp_path / "seen.log").read_text() == "m7\nm8\nm9\n"
+    # A deleted email that is delivered again is indexed again
+    assert index.add_many(["m0"]) == ["m0"]
@@ -0,0 +1,136 @@
+import hashlib
+from pathlib import Path
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+from .lexical_index import LEXICAL_INDEX, BM25Index
+from .segmented_store import MANIFEST, SEGMENTS, TOMBSTONES, SegmentedVectorStore
+from .thread_index import THREAD_INDEX, ThreadIndex
+
+DIM = 8
+
+
+class HashEmbeddings(Embeddings):
+    """Deterministic vectors derived from the text, so that searching a text finds its own chunk."""
+
+    def embed_documents(self, texts):
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text):
+        seed = int.from_bytes(hashlib.sha1(text.encode("utf-8")).digest()[:4], "little")
+        return np.random.default_rng(seed).normal(size=DIM).tolist()
+
+
+def _texts(start: int, n: int) -> list:
+    return [f"chunk {i} keyword{i}" for i in range(start, start + n)]
+
+
+def _metadatas(texts: list) -> list:
+    # The metadata the chunker writes, which the thread index reads
+    return [
+        {"id": text.split()[1], "thread_id": f"t{int(text.split()[1]) % 3}", "subject": "", "sender": "a@columbia.edu", "date": ""}
+        for text in texts
+    ]
+
+
+def _open(path, **options) -> SegmentedVectorStore:
+    options = {"side_indexes": {LEXICAL_INDEX: BM25Index, THREAD_INDEX: ThreadIndex}, "max_segments": 100, **options}
+    return SegmentedVectorStore.load(str(path), HashEmbeddings(), **options)
+
+
+def _build(path, n_segments: int = 3, per_segment: int = 10) -> SegmentedVectorStore:
+    texts = _texts(0, per_segment)
+    documents = [Document(page_content=text, metadata=metadata) for text, metadata in zip(texts, _metadatas(texts))]
+    store = SegmentedVectorStore.build(
+        str(path), documents, HashEmbeddings(), side_indexes={LEXICAL_INDEX: BM25Index, THREAD_INDEX: ThreadIndex}, max_segments=100
+    )
+    store.save()
+    for s in range(1, n_segments):
+        _append(store, _texts(s * per_segment, per_segment))
+        store.save()
+    return store
+
+
+def _append(store: SegmentedVectorStore, texts: list) -> int:
+    return store.add_embeddings(texts, HashEmbeddings().embed_documents(texts), _metadatas(texts))
+
+
+def _nearest(store: SegmentedVectorStore, text: str, k: int = 1) -> list:
+    return store.search([HashEmbeddings().embed_query(text)], k)[0]
+
+
+def test_segments_survive_reload_and_positions_continue(tmp_path):
+    store = _build(tmp_path)
+    reopened = _open(tmp_path)
+    assert reopened.ntotal == 30 and reopened.stats()["segments"] == 3
+    assert _nearest(reopened, "chunk 17 keyword17") == [17]
+    assert _append(reopened, _texts(30, 2)) == 30
+    assert reopened.side_index(LEXICAL_INDEX).search("keyword25", 1)[0][0] == 25
+    assert store.stats()["unsaved"] == 0
+
+
+def test_deleted_positions_are_never_returned(tmp_path):
+    store = _build(tmp_path)
+    assert store.delete([17]) == 1
+    assert 17 not in _nearest(store, "chunk 17 keyword17", k=5)
+    filtered = store.search([HashEmbeddings().embed_query("chunk 17 keyword17")], 5, [{16, 17}])[0]
+    assert filtered == [16]
+    # Tombstones are logged, so they hold after a restart
+    assert 17 not in _nearest(_open(tmp_path), "chunk 17 keyword17", k=5)
+
+
+def test_tombstones_of_unsaved_chunks_are_logged_with_the_save(tmp_path):
+    store = _build(tmp_path, n_segments=1)
+    start = _append(store, _texts(10, 5))
+    store.delete([start + 1])
+    store.save()
+    assert _open(tmp_path).is_deleted(start + 1)
+
+
+def test_compaction_drops_deleted_rows_and_keeps_positions(tmp_path):
+    store = _build(tmp_path)
+    store.delete([3, 17, 25])
+    store.compact(full=True)
+    reopened = _open(tmp_path)
+    assert reopened.ntotal == 27 and reopened.stats()["segments"] == 1
+    assert reopened.documents_at([18])[0].page_content == "chunk 18 keyword18"
+    assert _nearest(reopened, "chunk 29 keyword29") == [29]
+    lexical = reopened.side_index(LEXICAL_INDEX)
+    assert 17 not in lexical.doc_lengths and lexical.search("keyword18", 1)[0][0] == 18
+    # New chunks go after the span of the dropped rows, never onto a deleted position
+    assert _append(reopened, _texts(30, 1)) == 30
+
+
+def test_compaction_rewrites_the_tombstone_log_without_dropped_rows(tmp_path):
+    store = _build(tmp_path, n_segments=4, per_segment=5)
+    store.delete([1, 7, 17])
+    # Merges the first three segments, which drops rows 1 and 7; segment 4 still holds row 17
+    store.max_segments, store.fan_in = 2, 3
+    store.compact()
+    assert Path(tmp_path, TOMBSTONES).read_text() == "17\n"
+    reopened = _open(tmp_path)
+    assert reopened.ntotal == 18 and 17 not in _nearest(reopened, "chunk 17 keyword17", k=5)
+    reopened.compact(full=True)
+    assert Path(tmp_path, TOMBSTONES).read_text() == ""
+    assert _open(tmp_path).ntotal == 17
+
+
+def test_background_compaction_merges_side_indexes(tmp_path):
+    store = _build(tmp_path, n_segments=6, per_segment=5)
+    store.max_segments, store.fan_in = 2, 3
+    store.compact()
+    assert store.stats()["segments"] <= 2
+    lexical = _open(tmp_path).side_index(LEXICAL_INDEX)
+    assert len(lexical) == 30 and lexical.search("keyword4", 1)[0][0] == 4
+
+
+def test_leftovers_of_a_crashed_write_are_removed(tmp_path):
+    _build(tmp_path, n_segments=2)
+    leftover = Path(tmp_path, SEGMENTS, "seg-000099.tmp")
+    leftover.mkdir()
+    Path(tmp_path, MANIFEST + ".tmp").write_text("{")
+    reopened = _open(tmp_path)
+    assert reopened.ntotal == 20
+    assert not leftover.exists() and not Path(tmp_path, MANIFEST + ".tmp").exists()
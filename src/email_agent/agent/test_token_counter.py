@@ -0,0 +1,14 @@
+from .token_counter import TokenCounter, tokenizer_for_model
+
+
+def test_tokenizer_follows_the_configured_model():
+    assert tokenizer_for_model("llama3-8b-8192") == "meta-llama/Meta-Llama-3-8B-Instruct"
+    assert tokenizer_for_model("llama-3.1-8b-instant") == "meta-llama/Llama-3.1-8B-Instruct"
+    assert tokenizer_for_model("deepseek-chat") == "deepseek-ai/DeepSeek-V3"
+    assert tokenizer_for_model("my-org/my-model") == "my-org/my-model"
+
+
+def test_counts_approximately_without_a_loadable_tokenizer():
+    assert TokenCounter().count("a" * 40) == 10
+    counter = TokenCounter("/nonexistent/tokenizer")
+    assert counter.count("a" * 40) == 10 and counter.approximate
@@ -0,0 +1,216 @@
+import hashlib
+import re
+import threading
+from typing import TYPE_CHECKING, List
+
+import numpy as np
+from langchain_core.documents import Document
+
+from .chunker import _header
+
+if TYPE_CHECKING:
+    from .segmented_store import SegmentedVectorStore
+
+THREAD_INDEX = "threads.pkl"
+# Lines shorter than this ("Thanks,", "Hi all,") are kept even when the thread already has them
+_MIN_LINE_LENGTH = 24
+_SPACES = re.compile(r"\s+")
+
+
+def _line_key(line: str) -> int:
+    """Stable 64-bit key of a normalized line (persisted, so not Python's per-process hash)."""
+    normalized = _SPACES.sub(" ", line).strip().lower()
+    return int.from_bytes(hashlib.blake2b(normalized.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+class _Thread:
+    __slots__ = ("lines", "vector_sum", "n_chunks", "message_ids", "subject", "participants")
+
+    def __init__(self):
+        self.lines = set()
+        self.vector_sum = None
+        self.n_chunks = 0
+        self.message_ids = set()
+        self.subject = ""
+        self.participants = []
+
+
+class ThreadIndex:
+    """
+    Per-thread state kept next to the FAISS index, keyed by Gmail thread id:
+    - the lines already indexed for the thread, so that a reply is indexed with only the text it adds
+      (new_text), not with the paragraphs earlier messages already contributed
+    - a thread vector, the mean of the thread's chunk embeddings, plus subject, participants and message count
+    diversify uses the thread vectors to spread retrieved emails over distinct threads (MMR over threads,
+    with a cap on emails per thread). Lines seen by new_text stay pending until their chunks are added,
+    so a crash before the index is saved does not drop text from the next run. Each vectorstore segment
+    is saved with the threads of its own chunks (from_documents), and the segment states are merged on load.
+    """
+
+    def __init__(self):
+        self.threads = {}
+        self._pending = {}  # thread id -> line keys handed out by new_text but not indexed yet
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.threads)
+
+    @classmethod
+    def from_vectorstore(cls, vectorstore: "SegmentedVectorStore", embeddings) -> "ThreadIndex":
+        """Rebuild from the docstore (for indexes saved before threads were tracked)."""
+        documents = [document for _, document in vectorstore.iter_documents()]
+        try:
+            vectors = vectorstore.reconstruct_all()
+        except RuntimeError:
+            # Index types without stored vectors (IVF without a direct map); the embedding cache has them
+            vectors = embeddings.embed_documents([document.page_content for document in documents])
+        index = cls()
+        index.add(documents, vectors)
+        return index
+
+    @classmethod
+    def from_documents(cls, positions, documents: List[Document], vectors) -> "ThreadIndex":
+        """Threads of one vectorstore segment's chunks (positions are unused: threads are not keyed by position)."""
+        index = cls()
+        index.add(documents, vectors)
+        return index
+
+    @classmethod
+    def merge(cls, indexes: List["ThreadIndex"]) -> "ThreadIndex":
+        """Combine the thread state of several segments, in position order."""
+        merged = cls()
+        for index in indexes:
+            for thread_id, part in index.threads.items():
+                thread = merged.threads.get(thread_id)
+                if thread is None:
+                    thread = merged.threads[thread_id] = _Thread()
+                    thread.subject = part.subject
+                thread.lines |= part.lines
+                if part.vector_sum is not None:
+                    thread.vector_sum = part.vector_sum.copy() if thread.vector_sum is None else thread.vector_sum + part.vector_sum
+                thread.n_chunks += part.n_chunks
+                thread.message_ids |= part.message_ids
+                thread.participants.extend(sender for sender in part.participants if sender not in thread.participants)
+        return merged
+
+    def __getstate__(self) -> dict:
+        return {"threads": self.threads}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__init__()
+        self.threads = state["threads"]
+
+    def new_text(self, thread_id: str, content: str) -> str:
+        """
+        The lines of content that its thread has not had yet (short lines are always kept).
+        Returns None if content has text but all of it is already in the thread.
+        """
+        if not content.strip():
+            return content
+        kept = []
+        has_long = has_new = False
+        with self._lock:
+            thread = self.threads.get(thread_id)
+            indexed = thread.lines if thread else ()
+            pending = self._pending.setdefault(thread_id, set())
+            for line in content.split("\n"):
+                if len(line.strip()) < _MIN_LINE_LENGTH:
+                    kept.append(line)
+                    continue
+                has_long = True
+                key = _line_key(line)
+                if key in indexed or key in pending:
+                    continue
+                pending.add(key)
+                kept.append(line)
+                has_new = True
+        if has_long and not has_new:
+            return None
+        return "\n".join(kept).strip()
+
+    def discard_pending(self, thread_ids) -> None:
+        """Forget the lines new_text handed out for these threads that were never indexed, e.g. after a failed update."""
+        with self._lock:
+            for thread_id in thread_ids:
+                self._pending.pop(thread_id, None)
+
+    def add(self, documents: List[Document], vectors) -> None:
+        """Record indexed chunks (and their embeddings) in their threads. Documents without a thread id are skipped."""
+        with self._lock:
+            for document, vector in zip(documents, vectors):
+                metadata = document.metadata
+                thread_id = metadata.get("thread_id")
+                if thread_id is None:
+                    continue
+                thread = self.threads.get(thread_id)
+                if thread is None:
+                    thread = self.threads[thread_id] = _Thread()
+                    thread.subject = metadata["subject"]
+                body = document.page_content[len(_header(metadata["subject"], metadata["sender"], metadata["date"])):]
+                keys = {_line_key(line) for line in body.split("\n") if len(line.strip()) >= _MIN_LINE_LENGTH}
+                thread.lines.update(keys)
+                self._pending.get(thread_id, set()).difference_update(keys)
+                vector = np.asarray(vector, dtype=np.float32)
+                thread.vector_sum = vector.copy() if thread.vector_sum is None else thread.vector_sum + vector
+                thread.n_chunks += 1
+                thread.message_ids.add(metadata["id"])
+                if metadata["sender"] not in thread.participants:
+                    thread.participants.append(metadata["sender"])
+
+    def vector(self, thread_id: str) -> np.ndarray:
+        """Unit-length mean chunk embedding of the thread, or None if it is not indexed."""
+        thread = self.threads.get(thread_id)
+        if thread is None or thread.vector_sum is None:
+            return None
+        norm = np.linalg.norm(thread.vector_sum)
+        return thread.vector_sum / norm if norm else thread.vector_sum
+
+    def describe(self, thread_id: str) -> dict:
+        thread = self.threads.get(thread_id)
+        if thread is None:
+            return None
+        return {
+            "subject": thread.subject,
+            "participants": list(thread.participants),
+            "messages": len(thread.message_ids),
+            "chunks": thread.n_chunks,
+        }
+
+    def diversify(self, emails: List[List[Document]], k: int, per_thread: int = 2, diversity: float = 0.3) -> List[List[Document]]:
+        """
+        Pick k of the ranked emails (each a list of chunks) by maximal marginal relevance over threads:
+        relevance falls linearly with the rank, and an email is penalized by diversity times the highest
+        similarity of its thread vector to the threads already picked (1 for the same thread). At most
+        per_thread emails come from one thread. Emails without a thread id count as threads of their own.
+        """
+        if len(emails) <= 1 or (diversity <= 0 and per_thread >= k):
+            return emails[:k]
+        thread_ids = [email[0].metadata.get("thread_id") or f"__email_{i}" for i, email in enumerate(emails)]
+        distinct = list(dict.fromkeys(thread_ids))
+        vectors = [self.vector(thread_id) for thread_id in distinct]
+        dimension = next((len(vector) for vector in vectors if vector is not None), 0)
+        matrix = np.array([vector if vector is not None else np.zeros(dimension, dtype=np.float32) for vector in vectors])
+        similarity = matrix @ matrix.T if dimension else np.zeros((len(distinct), len(distinct)), dtype=np.float32)
+        np.fill_diagonal(similarity, 1.0)
+        column = {thread_id: i for i, thread_id in enumerate(distinct)}
+
+        picked, counts = [], {}
+        # Highest similarity of each distinct thread to any picked thread
+        closest = np.full(len(distinct), -np.inf, dtype=np.float32)
+        remaining = list(range(len(emails)))
+        while remaining and len(picked) < k:
+            best, best_score = None, -np.inf
+            for i in remaining:
+                if counts.get(thread_ids[i], 0) >= per_thread:
+                    continue
+                penalty = max(0.0, float(closest[column[thread_ids[i]]])) if picked else 0.0
+                score = (1 - diversity) * (1 - i / len(emails)) - diversity * penalty
+                if score > best_score:
+                    best, best_score = i, score
+            if best is None:
+                break
+            remaining.remove(best)
+            picked.append(best)
+            counts[thread_ids[best]] = counts.get(thread_ids[best], 0) + 1
+            closest = np.maximum(closest, similarity[column[thread_ids[best]]])
+        return [emails[i] for i in sorted(picked)]
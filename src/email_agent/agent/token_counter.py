@@ -0,0 +1,81 @@
+import math
+import threading
+from typing import Iterable
+
+from .query_cache import LRUCache
+
+# Roughly 4 characters per token for English BPE vocabularies
+_CHARS_PER_TOKEN = 4
+# Hugging Face repos with the tokenizers of the configured chat models (LLAMA3_8B / MODEL_DEEPSEEK1), by name fragment
+_MODEL_TOKENIZERS = (
+    ("llama-3.1", "meta-llama/Llama-3.1-8B-Instruct"),
+    ("llama-3.3", "meta-llama/Llama-3.3-70B-Instruct"),
+    ("llama3", "meta-llama/Meta-Llama-3-8B-Instruct"),
+    ("llama-3", "meta-llama/Meta-Llama-3-8B-Instruct"),
+    ("deepseek", "deepseek-ai/DeepSeek-V3"),
+)
+
+
+def tokenizer_for_model(model_name: str) -> str:
+    """
+    The Hugging Face tokenizer of a chat model, e.g. "llama3-8b-8192" -> "meta-llama/Meta-Llama-3-8B-Instruct".
+    Names of unknown families are returned as they are, in case they are Hugging Face repos themselves.
+    """
+    lowered = (model_name or "").lower()
+    return next((repo for fragment, repo in _MODEL_TOKENIZERS if fragment in lowered), model_name)
+
+
+class TokenCounter:
+    """
+    Token counting for prompt budgeting, standing in for ChatGroq.get_num_tokens.
+    - The tokenizer is loaded once, on first use, and shared by every caller
+    - count_segment memoizes counts of text that recurs across turns (system prompt, emails)
+    - approximate=True skips the tokenizer and estimates from the character length
+    tokenizer_name should be the tokenizer of the model that is billed (see tokenizer_for_model); a tokenizer
+    of another family miscounts by tens of percent. Without one, or if it cannot be loaded (e.g. a gated repo
+    without a Hugging Face token), the counter falls back to the approximate mode.
+    """
+
+    def __init__(self, tokenizer_name: str = None, approximate: bool = False, cache_size: int = 8192):
+        self.tokenizer_name = tokenizer_name
+        self.approximate = approximate or not tokenizer_name
+        self._tokenizer = None
+        self._lock = threading.Lock()
+        self._segments = LRUCache(cache_size, ttl=math.inf)
+
+    @property
+    def tokenizer(self):
+        if self._tokenizer is None and not self.approximate:
+            with self._lock:
+                if self._tokenizer is None and not self.approximate:
+                    try:
+                        from transformers import AutoTokenizer
+
+                        self._tokenizer = AutoTokenizer.from_pretrained(self.tokenizer_name)
+                    except Exception as e:
+                        print(f"Could not load tokenizer '{self.tokenizer_name}' ({e}), counting tokens approximately.")
+                        self.approximate = True
+        return self._tokenizer
+
+    def count(self, text: str) -> int:
+        """Count the tokens of text without caching (for text seen once, e.g. a question or a reply)."""
+        if not text:
+            return 0
+        tokenizer = self.tokenizer
+        if tokenizer is None:
+            return math.ceil(len(text) / _CHARS_PER_TOKEN)
+        return len(tokenizer.encode(text, add_special_tokens=False, verbose=False))
+
+    def count_segment(self, text: str) -> int:
+        """Count the tokens of a prompt segment that is likely to come back, memoized by its text."""
+        tokens = self._segments.get(text)
+        if tokens is None:
+            tokens = self.count(text)
+            self._segments.put(text, tokens)
+        return tokens
+
+    def count_many(self, segments: Iterable[str]) -> int:
+        return sum(self.count_segment(segment) for segment in segments)
+
+    def stats(self) -> dict:
+        return {"approximate": self.approximate, **self._segments.stats()}
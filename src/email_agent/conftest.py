@@ -0,0 +1,5 @@
+import os
+import tempfile
+
+# Modules read CONFIG_DIR at import time; tests never touch a real config directory
+os.environ.setdefault("CONFIG_DIR", tempfile.mkdtemp(prefix="email_agent_test_"))
@@ -1,12 +1,49 @@
+import argparse
+import json
+
 from .agent.base_agent import BaseAgent
-from .utils import get_email_samples, fetch_save_emails
+from .pipeline import ingest_mailbox
+from .utils.email_fetcher import sync_settings
 
-def main():
-    fetch_save_emails()
-    email_samples = get_email_samples()
+def main(max_results: int = None, query: str = None):
+    # Ask for the sync settings before anything runs in the background: the chat prompt owns stdin from then on
+    max_results, query = sync_settings(max_results, query, interactive=True)
+    # The agent loads its models and index on a background thread; the mailbox syncs on another, and
+    # new emails stream through download, parsing, embedding and indexing while the prompt is already up
     agent = BaseAgent()
-    agent.chat_loop(email_samples)
+    agent.chat_loop(ingest=lambda agent: ingest_mailbox(agent, max_results=max_results, query=query))
     print("Quit.")
 
+def batch(questions_path: str, answers_path: str, concurrency: int = 4, sync: bool = True, max_results: int = None, query: str = None):
+    """
+    Answer every question in a JSONL file ({"question": ...} per line, other fields are kept)
+    and write one JSON line per question with the answer, latency and token usage.
+    Never prompts: a first sync uses max_results / query, SYNC_MAX_RESULTS / SYNC_QUERY or the defaults.
+    """
+    with open(questions_path, "r", encoding="utf-8") as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    agent = BaseAgent(stream=False, quiet=True)
+    if sync:
+        max_results, query = sync_settings(max_results, query)
+        ingest_mailbox(agent, max_results=max_results, query=query)
+    results = agent.answer_batch([record["question"] for record in records], max_concurrency=concurrency)
+    with open(answers_path, "w", encoding="utf-8") as f:
+        for record, result in zip(records, results):
+            f.write(json.dumps({**record, **result}, ensure_ascii=False) + "\n")
+    print(f"Wrote {len(results)} answers to {answers_path}")
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Email assistant: interactive chat, or batch answers with `batch`.")
+    parser.add_argument("--max-results", type=int, help="emails to fetch on a first (full) sync")
+    parser.add_argument("--query", help="Gmail query for a first (full) sync")
+    subparsers = parser.add_subparsers(dest="command")
+    batch_parser = subparsers.add_parser("batch", help="answer questions from a JSONL file")
+    batch_parser.add_argument("questions", help="JSONL file with a \"question\" field per line")
+    batch_parser.add_argument("answers", help="JSONL file to write the answers to")
+    batch_parser.add_argument("--concurrency", type=int, default=4, help="LLM calls in flight at once")
+    batch_parser.add_argument("--no-sync", action="store_true", help="answer from the local index without syncing Gmail")
+    args = parser.parse_args()
+    if args.command == "batch":
+        batch(args.questions, args.answers, concurrency=args.concurrency, sync=not args.no_sync, max_results=args.max_results, query=args.query)
+    else:
+        main(args.max_results, args.query)
\ No newline at end of file
@@ -0,0 +1,221 @@
+import queue
+import threading
+import time
+from itertools import chain
+from typing import Callable, Iterable, Iterator
+
+from googleapiclient.discovery import build
+
+from .agent.base_agent import BaseAgent
+from .utils.credential import main as get_creds
+from .utils.email_fetcher import save_sync_state, sync
+from .utils.email_batch import EmailBatch
+from .utils.email_parser import GMAIL_BATCH_LIMIT, build_email_batch, iter_downloaded_batches
+from .utils.email_store import EmailStore
+
+_DONE = object()
+
+
+class IngestPipeline:
+    """
+    Fetch -> parse -> embed -> index, each stage on its own thread with a bounded queue in between:
+    - fetch: Gmail batch downloads, at most fetch_workers batches in flight
+    - parse: raw messages -> a columnar EmailBatch, written to the email store batch by batch
+    - embed: chunk and embed a batch (fills the embedding cache; the model runs outside the GIL)
+    - index: append to the FAISS / metadata / BM25 indexes, on the caller's thread
+    A full queue blocks the stage feeding it, so memory is bounded by the queue sizes, not the mailbox.
+    Downloads start while the agent is still warming up; parsing waits for it. The index is saved
+    every checkpoint_every batches and only then are those emails marked as indexed; after an
+    interruption, emails already stored but not indexed are indexed first on the next run.
+    """
+
+    def __init__(
+        self,
+        agent: BaseAgent,
+        store: EmailStore = None,
+        queue_size: int = 4,
+        fetch_workers: int = 4,
+        batch_size: int = GMAIL_BATCH_LIMIT,
+        checkpoint_every: int = 10,
+    ):
+        self.agent = agent
+        self.store = store or agent.email_store
+        self.queue_size = queue_size
+        self.fetch_workers = fetch_workers
+        self.batch_size = batch_size
+        self.checkpoint_every = checkpoint_every
+        self.busy = {"fetch": 0.0, "parse": 0.0, "embed": 0.0, "index": 0.0}
+        self.counts = {"fetched": 0, "parsed": 0, "resumed": 0, "indexed": 0}
+        self._stop = threading.Event()
+        self._error = None
+        self._unindexed = None
+        self._ready_lock = threading.Lock()
+
+    def _put(self, outbox: queue.Queue, item) -> bool:
+        """Blocking put that gives up once another stage has failed."""
+        while not self._stop.is_set():
+            try:
+                outbox.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _drain(self, inbox: queue.Queue) -> Iterator:
+        while not self._stop.is_set():
+            try:
+                item = inbox.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is _DONE:
+                return
+            yield item
+
+    def _timed(self, name: str, items: Iterable) -> Iterator:
+        """Iterate items, counting the time spent producing them as busy time of stage name."""
+        items = iter(items)
+        while True:
+            start_time = time.perf_counter()
+            try:
+                item = next(items)
+            except StopIteration:
+                return
+            finally:
+                self.busy[name] += time.perf_counter() - start_time
+            yield item
+
+    def _stage(self, name: str, items: Iterable, work: Callable, outbox: queue.Queue) -> None:
+        """Thread body: pass work(item) on for every item; on failure stop the whole pipeline."""
+        try:
+            for item in items:
+                start_time = time.perf_counter()
+                result = work(item)
+                self.busy[name] += time.perf_counter() - start_time
+                if result and not self._put(outbox, result):
+                    break
+        except Exception as e:
+            self._error = self._error or e
+            self._stop.set()
+        finally:
+            self._put(outbox, _DONE)
+
+    def _unindexed_ids(self) -> list:
+        """
+        Wait for the agent's warm-up (which may rebuild the index from the store), then snapshot the
+        stored emails that are still not indexed. Runs once, before the parse stage stores anything.
+        """
+        with self._ready_lock:
+            if self._unindexed is None:
+                self.agent.wait_until_ready()
+                self.agent.apply_deletions()
+                self._unindexed = [email_id for email_id in self.store.ids() if email_id not in self.agent.seen_ids]
+                print(f"[PIPELINE] {len(self._unindexed)} stored emails to index")
+            return self._unindexed
+
+    def _parse(self, batch: list) -> EmailBatch:
+        self._unindexed_ids()
+        email_batch = build_email_batch(batch)
+        self.store.add_many(email_batch)
+        self.counts["fetched"] += len(batch)
+        self.counts["parsed"] += len(email_batch)
+        return email_batch
+
+    def _embed(self, email_batch: EmailBatch) -> tuple:
+        documents = self.agent.chunk_emails(email_batch)
+        # Vectors land in the embedding cache, so the index stage only looks them up
+        self.agent.embed_documents(documents)
+        return documents, email_batch.ids()
+
+    def _unindexed_batches(self) -> Iterator[EmailBatch]:
+        email_ids = self._unindexed_ids()
+        for i in range(0, len(email_ids), self.batch_size):
+            email_batch = EmailBatch.from_samples(self.store.get_many(email_ids[i:i + self.batch_size]))
+            self.counts["resumed"] += len(email_batch)
+            yield email_batch
+
+    def _checkpoint(self, email_ids: list) -> None:
+        start_time = time.perf_counter()
+        self.agent.save_index()
+        self.agent.seen_ids.add_many(email_ids)
+        self.busy["index"] += time.perf_counter() - start_time
+        self.counts["indexed"] += len(email_ids)
+        print(f"[PIPELINE] checkpoint: {self.counts['indexed']} emails indexed")
+        email_ids.clear()
+
+    def run(self, service_factory: Callable[[], build], emails_id_threading: list, deleted_ids: list = ()) -> dict:
+        """Download, store and index the listed emails that are not stored yet. Returns the stage counts."""
+        start_time = time.perf_counter()
+        self.store.delete(deleted_ids)
+        missing_ids = set(self.store.missing_ids([email["id"] for email in emails_id_threading]))
+        to_fetch = [email for email in emails_id_threading if email["id"] in missing_ids]
+        print(f"[PIPELINE] {len(to_fetch)} emails to download")
+
+        parse_inbox = queue.Queue(maxsize=self.queue_size)
+        embed_inbox = queue.Queue(maxsize=self.queue_size)
+        index_inbox = queue.Queue(maxsize=self.queue_size)
+        downloads = iter_downloaded_batches(service_factory, to_fetch, self.batch_size, self.fetch_workers) if to_fetch else []
+        threads = [
+            threading.Thread(target=self._stage, args=("fetch", self._timed("fetch", downloads), list, parse_inbox)),
+            threading.Thread(target=self._stage, args=("parse", self._drain(parse_inbox), self._parse, embed_inbox)),
+            threading.Thread(
+                target=self._stage,
+                args=("embed", chain(self._unindexed_batches(), self._drain(embed_inbox)), self._embed, index_inbox),
+            ),
+        ]
+        for thread in threads:
+            thread.start()
+
+        pending_ids = []
+        batches = 0
+        try:
+            for documents, email_ids in self._drain(index_inbox):
+                batch_start = time.perf_counter()
+                self.agent.index_documents(documents, save=False)
+                self.busy["index"] += time.perf_counter() - batch_start
+                pending_ids.extend(email_ids)
+                batches += 1
+                if batches % self.checkpoint_every == 0:
+                    self._checkpoint(pending_ids)
+        except BaseException as e:
+            self._error = self._error or e
+            self._stop.set()
+        for thread in threads:
+            thread.join()
+        if self._error is not None:
+            raise self._error
+        if pending_ids:
+            self._checkpoint(pending_ids)
+
+        elapsed = time.perf_counter() - start_time
+        busy = ", ".join(f"{name} {seconds:.1f}s" for name, seconds in self.busy.items())
+        print(
+            f"[PIPELINE] downloaded {self.counts['fetched']}, parsed {self.counts['parsed']}, "
+            f"indexed {self.counts['indexed']} emails in {elapsed:.2f}s (busy: {busy})"
+        )
+        print(f"[PIPELINE] near-duplicates: {self.agent.near_duplicates.stats()}")
+        return dict(self.counts)
+
+
+def ingest_mailbox(agent: BaseAgent, max_workers: int = 4, max_results: int = None, query: str = None) -> dict:
+    """
+    Sync the mailbox and stream the new emails into the store and the index. Never prompts: a first
+    (full) sync uses max_results and query, resolved by the caller with email_fetcher.sync_settings.
+    The sync's added messages are queued in the store's pending table and its deletions applied before
+    the new historyId is saved; the pipeline then downloads everything pending, so messages from an
+    interrupted run or a failed download are fetched on a later run instead of being lost.
+    """
+    creds = get_creds()
+    service = build("gmail", "v1", credentials=creds)
+    store = agent.email_store
+    added, deleted, state = sync(service, max_results, query, known_ids=store.ids())
+    store.add_pending(added)
+    store.delete(deleted)
+    save_sync_state(state)
+    pending = store.pending()
+    print(f"Found {len(added)} new emails matching your criteria ({len(pending)} to download)")
+    pipeline = IngestPipeline(agent, fetch_workers=max_workers)
+    counts = pipeline.run(lambda: build("gmail", "v1", credentials=creds), pending)
+    left = len(store.pending())
+    if left:
+        print(f"{left} emails could not be downloaded; they are retried on the next sync")
+    return counts
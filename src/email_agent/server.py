@@ -0,0 +1,154 @@
+import argparse
+import asyncio
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+
+from .agent.base_agent import BaseAgent
+from .agent.query_cache import LRUCache
+from .utils.email_sample import EmailSample
+
+
+class LatencyRecorder:
+    """Latencies of the last `window` requests per endpoint, reported as percentiles in milliseconds."""
+
+    def __init__(self, window: int = 10000):
+        self.window = window
+        self._latencies = {}
+
+    def record(self, endpoint: str, seconds: float) -> None:
+        self._latencies.setdefault(endpoint, deque(maxlen=self.window)).append(seconds * 1000)
+
+    def percentiles(self) -> dict:
+        report = {}
+        for endpoint, latencies in self._latencies.items():
+            ordered = sorted(latencies)
+            report[endpoint] = {
+                "count": len(ordered),
+                **{f"p{p}": round(ordered[min(len(ordered) - 1, len(ordered) * p // 100)], 2) for p in (50, 90, 99)},
+                "max": round(ordered[-1], 2),
+            }
+        return report
+
+
+def create_app(agent: BaseAgent, query_workers: int = 8, max_sessions: int = 1000, session_ttl: float = 3600) -> web.Application:
+    """
+    HTTP API over one warm BaseAgent:
+    - POST /query {"question", "session_id"?}: answer with the session's conversation memory
+    - POST /ingest {"emails": [EmailSample fields, ...]}: store and index new emails; each needs an "id"
+    - GET /metrics: latency percentiles per endpoint, cache, rate limit, near-duplicate and vectorstore segment counters
+    - GET /health: whether the models and index have finished loading
+    Queries run on a pool of query_workers threads and share the retriever; ingestion runs on its
+    own thread, and searches only pause for the in-memory index append.
+    """
+    query_executor = ThreadPoolExecutor(max_workers=query_workers, thread_name_prefix="query")
+    ingest_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ingest")
+    sessions = LRUCache(max_sessions, session_ttl)
+    latencies = LatencyRecorder()
+
+    @web.middleware
+    async def record_latency(request, handler):
+        start_time = time.perf_counter()
+        try:
+            return await handler(request)
+        finally:
+            latencies.record(request.path, time.perf_counter() - start_time)
+
+    def run_query(question: str, session: dict) -> dict:
+        agent.wait_until_ready()
+        # Turns of one session are answered in order, so each sees the previous one in its memory
+        with session["lock"]:
+            if session["memory"] is None:
+                session["memory"] = agent.new_session_memory()
+            return agent.answer(question, session["memory"])
+
+    def run_ingest(emails: list) -> int:
+        agent.wait_until_ready()
+        agent.email_store.add_many(emails)
+        return agent.index_emails(emails)
+
+    async def read_json(request) -> dict:
+        try:
+            body = await request.json()
+        except ValueError:
+            raise web.HTTPBadRequest(text="Request body must be JSON")
+        if not isinstance(body, dict):
+            raise web.HTTPBadRequest(text="Request body must be a JSON object")
+        return body
+
+    async def query(request):
+        body = await read_json(request)
+        question = body.get("question")
+        if not isinstance(question, str) or not question.strip():
+            raise web.HTTPBadRequest(text="'question' is required")
+        session_id = body.get("session_id") or uuid.uuid4().hex
+        session = sessions.get(session_id)
+        if session is None:
+            session = {"lock": threading.Lock(), "memory": None}
+        # Re-inserting refreshes the session's time-to-live
+        sessions.put(session_id, session)
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(query_executor, run_query, question, session)
+        except RuntimeError as e:
+            return web.json_response({"error": str(e)}, status=503)
+        return web.json_response({"session_id": session_id, **result})
+
+    async def ingest(request):
+        body = await read_json(request)
+        try:
+            emails = [EmailSample(**email) for email in body.get("emails", [])]
+        except TypeError as e:
+            raise web.HTTPBadRequest(text=f"Invalid email: {e}")
+        # The id keys the store, the seen ids and the index; without one every such email would be stored as ""
+        missing = [i for i, email in enumerate(emails) if not isinstance(email.id, str) or not email.id]
+        if missing:
+            raise web.HTTPBadRequest(text=f"Emails at {missing} have no 'id'")
+        try:
+            indexed = await asyncio.get_running_loop().run_in_executor(ingest_executor, run_ingest, emails)
+        except RuntimeError as e:
+            return web.json_response({"error": str(e)}, status=503)
+        return web.json_response({"received": len(emails), "indexed": indexed})
+
+    async def metrics(request):
+        return web.json_response({
+            "latency_ms": latencies.percentiles(),
+            "sessions": len(sessions),
+            "rate_limit": agent.rate_scheduler.status(),
+            "retrieval_cache": agent.retrieval_cache.stats(),
+            "query_vector_cache": agent.query_vector_cache.stats(),
+            "near_duplicates": agent.near_duplicates.stats() if hasattr(agent, "near_duplicates") else None,
+            "vectorstore": agent.rag_retriever.stats() if agent.rag_retriever is not None else None,
+        })
+
+    async def health(request):
+        return web.json_response({"ready": agent.ready}, status=200 if agent.ready else 503)
+
+    async def shutdown(app):
+        query_executor.shutdown(wait=False, cancel_futures=True)
+        ingest_executor.shutdown(wait=True)
+
+    app = web.Application(middlewares=[record_latency])
+    app.add_routes([
+        web.post("/query", query),
+        web.post("/ingest", ingest),
+        web.get("/metrics", metrics),
+        web.get("/health", health),
+    ])
+    app.on_cleanup.append(shutdown)
+    return app
+
+
+if __name__ == "__main__":
+    # python -m src.email_agent.server [--host HOST] [--port PORT] [--workers N]
+    # LLM_BACKEND=stub serves canned answers without a Groq key, for local testing
+    parser = argparse.ArgumentParser(description="Serve /query and /ingest from one warm agent process.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=8, help="queries answered at once")
+    args = parser.parse_args()
+    # The server accepts connections while the models and index load; queries wait for the warm-up
+    web.run_app(create_app(BaseAgent(stream=False, quiet=True), query_workers=args.workers), host=args.host, port=args.port)
@@ -0,0 +1,52 @@
+import asyncio
+
+from aiohttp.test_utils import TestClient, TestServer
+
+from .server import create_app
+
+
+class FakeStore:
+    def __init__(self):
+        self.emails = []
+
+    def add_many(self, emails):
+        self.emails.extend(emails)
+        return len(emails)
+
+
+class FakeAgent:
+    """The parts of BaseAgent that /ingest uses."""
+
+    ready = True
+
+    def __init__(self):
+        self.email_store = FakeStore()
+
+    def wait_until_ready(self):
+        pass
+
+    def index_emails(self, emails):
+        return len(emails)
+
+
+def _post_ingest(agent: FakeAgent, emails: list) -> tuple:
+    async def post():
+        async with TestClient(TestServer(create_app(agent))) as client:
+            response = await client.post("/ingest", json={"emails": emails})
+            return response.status, await response.text()
+
+    return asyncio.run(post())
+
+
+def test_ingest_rejects_emails_without_an_id():
+    agent = FakeAgent()
+    status, text = _post_ingest(agent, [{"id": "a", "thread_id": "t"}, {"thread_id": "t", "content": "no id"}, {"id": ""}])
+    assert status == 400 and "[1, 2]" in text
+    assert agent.email_store.emails == []
+
+
+def test_ingest_stores_and_indexes_emails():
+    agent = FakeAgent()
+    status, text = _post_ingest(agent, [{"id": "a", "thread_id": "t", "content": "See you at 3pm."}])
+    assert status == 200 and '"indexed": 1' in text
+    assert [email.id for email in agent.email_store.emails] == ["a"]
@@ -1,19 +1,44 @@
-# 只导入没有外部依赖的模块
+# 只导入没有外部依赖的模块; Gmail 相关模块在第一次访问时才导入
+from importlib import import_module
+
 from .email_sample import EmailSample
-from .email_fetcher import main as fetch_save_emails, save_emails_id_threading
-from .email_parser import get_email_content_list, modify_content, main as get_email_samples
-from .credential import main as get_creds
+
+# 公共名称 -> (模块, 属性)
+_LAZY = {
+    "EmailBatch": (".email_batch", "EmailBatch"),
+    "EmailStore": (".email_store", "EmailStore"),
+    "fetch_save_emails": (".email_fetcher", "main"),
+    "save_emails_id_threading": (".email_fetcher", "save_emails_id_threading"),
+    "get_email_content_list": (".email_parser", "get_email_content_list"),
+    "modify_content": (".email_parser", "modify_content"),
+    "normalize_body": (".email_body", "normalize_body"),
+    "get_creds": (".credential", "main"),
+    "get_email_samples": (".email_parser", "main"),
+}
 
 # 定义包的公共接口
 __all__ = [
     "EmailSample",
+    "EmailBatch",
+    "EmailStore",
     "fetch_save_emails",
     "save_emails_id_threading",
     "get_email_content_list",
     "modify_content",
+    "normalize_body",
     "get_creds",
     "get_email_samples"
 ]
 
+
+def __getattr__(name: str):
+    if name not in _LAZY:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    module_name, attribute = _LAZY[name]
+    value = getattr(import_module(module_name, __name__), attribute)
+    globals()[name] = value
+    return value
+
+
 if __name__ == "__main__":
-    pass
\ No newline at end of file
+    pass
@@ -0,0 +1,251 @@
+import sys
+import time
+import tracemalloc
+from array import array
+from typing import Iterable, Iterator
+
+from .email_sample import EmailSample, content_stats
+
+# Free-text columns: UTF-8 bytes in one buffer per column, row i is data[offsets[i]:offsets[i + 1]]
+_TEXT_COLUMNS = ("id", "subject", "receiver", "date", "content")
+# Columns with few distinct values: a table of interned strings plus one code per row
+_DICT_COLUMNS = ("thread_id", "sender")
+COLUMNS = ("id", "thread_id", "subject", "sender", "receiver", "date", "content")
+
+
+class _TextColumn:
+    __slots__ = ("data", "offsets")
+
+    def __init__(self):
+        self.data = bytearray()
+        self.offsets = array("Q", [0])
+
+    def append(self, value: str) -> None:
+        self.data += value.encode("utf-8")
+        self.offsets.append(len(self.data))
+
+    def __getitem__(self, i: int) -> str:
+        return self.data[self.offsets[i]:self.offsets[i + 1]].decode("utf-8")
+
+    def values(self, start: int, stop: int) -> list[str]:
+        """Rows start..stop-1, decoding the block at once when it is pure ASCII (byte offsets = str offsets)."""
+        offsets = self.offsets
+        base = offsets[start]
+        block = self.data[base:offsets[stop]]
+        if block.isascii():
+            text = block.decode("ascii")
+            return [text[offsets[i] - base:offsets[i + 1] - base] for i in range(start, stop)]
+        return [self[i] for i in range(start, stop)]
+
+    @property
+    def nbytes(self) -> int:
+        return len(self.data) + self.offsets.itemsize * len(self.offsets)
+
+
+class _DictColumn:
+    __slots__ = ("values", "codes", "_lookup")
+
+    def __init__(self):
+        self.values = []
+        self.codes = array("I")
+        self._lookup = {}
+
+    def append(self, value: str) -> None:
+        code = self._lookup.get(value)
+        if code is None:
+            code = self._lookup[value] = len(self.values)
+            self.values.append(sys.intern(value))
+        self.codes.append(code)
+
+    def __getitem__(self, i: int) -> str:
+        return self.values[self.codes[i]]
+
+    def values_between(self, start: int, stop: int) -> list[str]:
+        values = self.values
+        return [values[code] for code in self.codes[start:stop]]
+
+    @property
+    def nbytes(self) -> int:
+        return sum(len(value.encode("utf-8")) for value in self.values) + self.codes.itemsize * len(self.codes)
+
+
+class EmailBatch:
+    """
+    Column-oriented batch of emails, for moving many emails between the parser, the store and the indexer.
+    - id / subject / receiver / date / content: one UTF-8 buffer plus an offsets array per column
+    - thread_id / sender: dictionary-encoded, each distinct value interned once and one code per row
+    - word_count / sentence_count: computed per row on first access, -1 until then
+    Rows are decoded on access: iter_rows yields plain tuples of the requested columns, while
+    indexing or iterating the batch builds EmailSamples for code that wants objects.
+    """
+
+    __slots__ = ("_columns", "_word_counts", "_sentence_counts")
+
+    def __init__(self):
+        self._columns = {name: _TextColumn() for name in _TEXT_COLUMNS}
+        self._columns.update({name: _DictColumn() for name in _DICT_COLUMNS})
+        self._word_counts = array("i")
+        self._sentence_counts = array("i")
+
+    @classmethod
+    def from_samples(cls, email_samples: Iterable[EmailSample]) -> "EmailBatch":
+        batch = cls()
+        for email in email_samples:
+            batch.append(email.id, email.thread_id, email.subject, email.sender, email.receiver, email.date, email.content)
+        return batch
+
+    def append(
+        self,
+        id: str,
+        thread_id: str = "",
+        subject: str = "",
+        sender: str = "",
+        receiver: str = "",
+        date: str = "",
+        content: str = "",
+    ) -> None:
+        columns = self._columns
+        columns["id"].append(id)
+        columns["thread_id"].append(thread_id or "")
+        columns["subject"].append(subject or "")
+        columns["sender"].append(sender or "")
+        columns["receiver"].append(receiver or "")
+        columns["date"].append(date or "")
+        columns["content"].append(content or "")
+        self._word_counts.append(-1)
+        self._sentence_counts.append(-1)
+
+    def __len__(self) -> int:
+        return len(self._word_counts)
+
+    def _stats(self, i: int) -> tuple:
+        if self._word_counts[i] < 0:
+            self._word_counts[i], self._sentence_counts[i] = content_stats(self._columns["content"][i])
+        return self._word_counts[i], self._sentence_counts[i]
+
+    def value(self, name: str, i: int):
+        """Value of column name in row i (word_count and sentence_count included)."""
+        if name == "word_count":
+            return self._stats(i)[0]
+        if name == "sentence_count":
+            return self._stats(i)[1]
+        return self._columns[name][i]
+
+    def column(self, name: str, start: int = 0, stop: int = None) -> list:
+        """Values of column name for rows start..stop-1 (to the end by default)."""
+        stop = len(self) if stop is None else stop
+        if name in ("word_count", "sentence_count"):
+            return [self.value(name, i) for i in range(start, stop)]
+        column = self._columns[name]
+        if isinstance(column, _DictColumn):
+            return column.values_between(start, stop)
+        return column.values(start, stop)
+
+    def iter_rows(self, *names: str, block_size: int = 1024) -> Iterator[tuple]:
+        """
+        Yield a tuple of the named columns per row (all of COLUMNS if none are named).
+        Columns are decoded block_size rows at a time, so only one block is ever materialized.
+        """
+        names = names or COLUMNS
+        for start in range(0, len(self), block_size):
+            stop = min(start + block_size, len(self))
+            yield from zip(*(self.column(name, start, stop) for name in names))
+
+    def ids(self) -> list[str]:
+        return self.column("id")
+
+    @property
+    def senders(self) -> list[str]:
+        """Distinct senders, in order of first appearance."""
+        return list(self._columns["sender"].values)
+
+    def __getitem__(self, i: int) -> EmailSample:
+        if not -len(self) <= i < len(self):
+            raise IndexError("EmailBatch index out of range")
+        i %= len(self)
+        word_count, sentence_count = self._stats(i)
+        return EmailSample(**{name: self._columns[name][i] for name in COLUMNS}, word_count=word_count, sentence_count=sentence_count)
+
+    def __iter__(self) -> Iterator[EmailSample]:
+        for i in range(len(self)):
+            yield self[i]
+
+    @property
+    def nbytes(self) -> int:
+        """Size of the column buffers (excluding the small fixed per-column overhead)."""
+        counts = self._word_counts.itemsize * len(self) * 2
+        return sum(column.nbytes for column in self._columns.values()) + counts
+
+
+def _synthetic_rows(n: int) -> Iterator[tuple]:
+    """n fake emails: 2,000 senders, threads of 4, bodies of about 600 characters."""
+    body = "Hi team,\nThe weekly report is attached. Numbers are up again this week. " * 8
+    for i in range(n):
+        yield (
+            f"18f{i:013x}",
+            f"18f{i // 4:013x}",
+            f"Weekly report #{i}",
+            f"Sender {i % 2000} <sender{i % 2000}@example.com>",
+            "me@example.com",
+            "Mon, 1 Jul 2024 10:00:00 +0000",
+            f"{body}Ref {i}.",
+        )
+
+
+def benchmark(sizes: tuple = (100_000, 1_000_000)) -> None:
+    """
+    Memory and throughput of n emails held as slotted EmailSamples vs one EmailBatch, against the
+    previous EmailSample layout (__dict__ per instance, stats computed with three splits on creation).
+    Memory is what tracemalloc sees allocated once built; the scan reads every id, sender and content.
+    """
+
+    class DictEmailSample:
+        def __init__(self, id, thread_id, subject, sender, receiver, date, content):
+            self.id, self.thread_id, self.subject, self.sender = id, thread_id, subject, sender
+            self.receiver, self.date, self.content = receiver, date, content
+            self.word_count = len(content.split())
+            self.sentence_count = (len(content.split(".")) + len(content.split("\n"))) // 2
+
+    def build_objects(cls, n):
+        return [cls(*row) for row in _synthetic_rows(n)]
+
+    def build_batch(n):
+        batch = EmailBatch()
+        for row in _synthetic_rows(n):
+            batch.append(*row)
+        return batch
+
+    def scan_objects(emails):
+        return sum(len(email.id) + len(email.sender) + len(email.content) for email in emails)
+
+    def scan_batch(batch):
+        return sum(len(i) + len(s) + len(c) for i, s, c in batch.iter_rows("id", "sender", "content"))
+
+    layouts = (
+        ("DICT", lambda n: build_objects(DictEmailSample, n), scan_objects),
+        ("SLOTTED", lambda n: build_objects(EmailSample, n), scan_objects),
+        ("BATCH", build_batch, scan_batch),
+    )
+    for n in sizes:
+        for name, build, scan in layouts:
+            start_time = time.perf_counter()
+            emails = build(n)
+            build_time = time.perf_counter() - start_time
+            start_time = time.perf_counter()
+            scan(emails)
+            scan_time = time.perf_counter() - start_time
+            del emails
+            # Measured in a second build, tracemalloc slows allocation down too much to time it
+            tracemalloc.start()
+            emails = build(n)
+            size = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            del emails
+            print(
+                f"[{name}] n={n}: {size / 2**20:.0f} MiB ({size / n:.0f} B/email), "
+                f"build {n / build_time:,.0f} emails/s, scan {n / scan_time:,.0f} emails/s"
+            )
+
+if __name__ == "__main__":
+    if "--benchmark" in sys.argv:
+        benchmark()
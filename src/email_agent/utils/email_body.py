@@ -0,0 +1,268 @@
+import base64
+import codecs
+import html
+import json
+import re
+import statistics
+import sys
+from pathlib import Path
+
+# Quoted reply history: everything after one of these markers is the conversation so far. Forwarded and
+# "Original Message" blocks are kept: the forwarded text is usually not in the mailbox anywhere else.
+_QUOTE_START = re.compile(r"^\s*(?:On .{0,200}wrote:|From: .+\n\s*Sent: )", re.IGNORECASE | re.MULTILINE)
+_FORWARDED = re.compile(r"-{2,}\s*(?:Original|Forwarded) Message\s*-{2,}", re.IGNORECASE)
+# Signatures: the RFC 3676 "-- " delimiter and the usual mobile client lines
+_SIGNATURE_START = re.compile(
+    r"^-- ?$|^(?:Sent from my \w+|Get Outlook for \w+|Sent from (?:Mail|Yahoo Mail|Outlook) for \w+).*$",
+    re.IGNORECASE | re.MULTILINE,
+)
+# A "-- " line followed by more non-blank lines than this is body text, not a signature delimiter
+_SIGNATURE_MAX_LINES = 6
+# Legal footers and mailing-list boilerplate; cut from the start of the paragraph that opens one
+_FOOTER_START = re.compile(
+    r"^[ \t*_\[]*(?:CONFIDENTIALITY NOTICE|DISCLAIMER|NOTICE: This|"
+    r"This (?:e-?mail|message|communication)(?: and any (?:files|attachments)[^.\n]*)? (?:is|are|may|contains?) (?:confidential|privileged|intended)|"
+    r"The information (?:contained )?in this (?:e-?mail|message|communication)|"
+    r"If you (?:are not the intended recipient|have received this (?:e-?mail|message|communication) in error)|"
+    r"To unsubscribe|You (?:are )?receiv(?:ed|ing) this (?:e-?mail|message) because|Unsubscribe from this list)",
+    re.IGNORECASE | re.MULTILINE,
+)
+# "External sender" banners that some mail gateways put at the top of every message
+_BANNER = re.compile(
+    r"\A\s*(?:\[EXTERNAL\]|(?:CAUTION|WARNING|EXTERNAL)\b[^\n]{0,60}\b(?:outside|external)\b)[^\n]*(?:\n[^\n]+)*\n\s*\n",
+    re.IGNORECASE,
+)
+
+# HTML: quoted history containers (Gmail, Apple Mail / Thunderbird, Outlook)
+_HTML_QUOTE_START = re.compile(
+    r'<(?:div|blockquote)[^>]*class="?gmail_quote|<blockquote[^>]*type="?cite|<div[^>]*id="?(?:appendonsend|divRplyFwdMsg)',
+    re.IGNORECASE,
+)
+_HTML_DROP = re.compile(r"<(script|style|head|title)\b.*?</\1\s*>|<!--.*?-->", re.IGNORECASE | re.DOTALL)
+_HTML_BREAK = re.compile(r"<(?:br|hr|/?p|/div|/tr|/h[1-6]|/table|/ul|/ol|/blockquote)\b[^>]*>", re.IGNORECASE)
+_HTML_ITEM = re.compile(r"<li\b[^>]*>", re.IGNORECASE)
+_HTML_CELL = re.compile(r"</t[dh]\s*>", re.IGNORECASE)
+_HTML_TAG = re.compile(r"<[^>]*>")
+_SPACES = re.compile(r"[ \t\f\v\xa0]+")
+_BLANK_LINES = re.compile(r"\n\s*\n+")
+_CHARSET = re.compile(r'charset\s*=\s*"?([^";\s]+)', re.IGNORECASE)
+
+
+def _cut(text: str, pattern: re.Pattern) -> str:
+    """Cut text at the first match of pattern, unless nothing would be left before it."""
+    match = pattern.search(text)
+    if match and text[:match.start()].strip():
+        return text[:match.start()]
+    return text
+
+
+def strip_quoted(text: str) -> str:
+    """
+    Drop quoted reply history: '>' lines and everything after an 'On ... wrote:' / Outlook 'From: ... Sent:'
+    header. Forwarded messages are kept, and nothing is dropped if no text of the sender's own would be left.
+    """
+    match = _QUOTE_START.search(text)
+    if match:
+        before = text[:match.start()]
+        if not before.strip():
+            # Nothing but quoted history (e.g. a reply that only quotes); better indexed than lost
+            return text.strip()
+        # An Outlook header right under a forwarded / original message marker starts the forwarded message
+        if not _FORWARDED.search(before.rstrip()[-80:]):
+            text = before
+    unquoted = "\n".join(line for line in text.split("\n") if not line.lstrip().startswith(">")).strip()
+    return unquoted or text.strip()
+
+
+def _per_message(text: str, cut) -> str:
+    """
+    Apply cut to the sender's own text and to each forwarded / original message block separately, so that
+    cutting a signature or footer never drops the forwarded messages after it.
+    """
+    parts, start = [], 0
+    for marker in [*_FORWARDED.finditer(text), None]:
+        end = marker.start() if marker else len(text)
+        parts.append(cut(text[start:end]))
+        start = end
+    return "".join(parts)
+
+
+def _is_signature(text: str, match: re.Match) -> bool:
+    """
+    Whether a _SIGNATURE_START match opens a signature. Mobile client lines always do; a '-- ' line only
+    when a short block follows it and it does not come right after a line that introduces what follows
+    ("Agenda:").
+    """
+    if not match.group(0).startswith("-"):
+        return True
+    if text[:match.start()].rstrip().endswith(":"):
+        return False
+    return sum(1 for line in text[match.end():].split("\n") if line.strip()) <= _SIGNATURE_MAX_LINES
+
+
+def _cut_signature(text: str) -> str:
+    for match in _SIGNATURE_START.finditer(text):
+        if text[:match.start()].strip() and _is_signature(text, match):
+            return text[:match.start()]
+    return text
+
+
+def strip_signature(text: str) -> str:
+    """
+    Drop the signature block ('-- ' delimiter, 'Sent from my iPhone' and the like) and what follows it,
+    up to the next forwarded message, which is kept.
+    """
+    return _per_message(text, _cut_signature).rstrip()
+
+
+def strip_footer(text: str) -> str:
+    """
+    Drop legal disclaimers and unsubscribe boilerplate at the end of the message and of each forwarded
+    message, and a leading 'external sender' banner.
+    """
+    text = _BANNER.sub("", text, count=1)
+    return _per_message(text, lambda part: _cut(part, _FOOTER_START)).rstrip()
+
+
+def html_to_text(markup: str) -> str:
+    """
+    Convert an HTML body to plain text with a few regular expressions (no DOM): quoted history (but not a
+    forwarded message), head/script/style and comments are dropped, block elements become line breaks and entities are unescaped.
+    """
+    match = _HTML_QUOTE_START.search(markup)
+    # Gmail wraps forwarded messages in the same gmail_quote container as quoted replies
+    forwarded = match and _FORWARDED.search(_HTML_TAG.sub("", markup[match.start():match.start() + 1000]))
+    if match and not forwarded and _HTML_TAG.sub("", markup[:match.start()]).strip():
+        markup = markup[:match.start()]
+    markup = _HTML_DROP.sub("", markup)
+    markup = _HTML_BREAK.sub("\n", markup)
+    markup = _HTML_ITEM.sub("\n- ", markup)
+    markup = _HTML_CELL.sub(" ", markup)
+    text = html.unescape(_HTML_TAG.sub("", markup))
+    lines = (_SPACES.sub(" ", line).strip() for line in text.split("\n"))
+    return _BLANK_LINES.sub("\n\n", "\n".join(lines)).strip()
+
+
+def decode_part_data(data: str, charset: str = None) -> str:
+    """
+    Decode a Gmail API part body (base64url of the part's bytes) in its declared charset.
+    Undeclared, unknown or ASCII-labelled parts are tried as UTF-8 first and then as Windows-1252,
+    the usual encoding of mislabelled mail.
+    """
+    raw = base64.urlsafe_b64decode(data + "=" * ((4 - len(data) % 4) % 4))
+    if charset:
+        try:
+            name = codecs.lookup(charset).name
+        except LookupError:
+            name = None
+        if name and name != "ascii":
+            return raw.decode(name, errors="replace")
+    try:
+        return raw.decode("utf-8")
+    except UnicodeDecodeError:
+        return raw.decode("cp1252", errors="replace")
+
+
+def _part_headers(part: dict) -> dict:
+    return {header["name"].lower(): header["value"] for header in part.get("headers", [])}
+
+
+def select_body(payload: dict) -> str:
+    """
+    Text of a Gmail message payload: the first text/plain part, else the first text/html part converted
+    to text, else the first non-empty body of any kind (e.g. a part without a MIME type). Attachments
+    are skipped. Returns None if the message has no body.
+    """
+    plain = markup = other = None
+    stack = [payload]
+    while stack:
+        part = stack.pop()
+        stack.extend(reversed(part.get("parts", [])))
+        data = part.get("body", {}).get("data")
+        if not data:
+            continue
+        headers = _part_headers(part)
+        if part.get("filename") or headers.get("content-disposition", "").lower().startswith("attachment"):
+            continue
+        mime_type = part.get("mimeType", "").lower()
+        if mime_type == "text/plain" and plain is None:
+            charset = _CHARSET.search(headers.get("content-type", ""))
+            plain = decode_part_data(data, charset and charset.group(1))
+        elif mime_type == "text/html" and markup is None:
+            charset = _CHARSET.search(headers.get("content-type", ""))
+            markup = decode_part_data(data, charset and charset.group(1))
+        elif not mime_type and other is None:
+            other = decode_part_data(data)
+    if plain and plain.strip():
+        return plain
+    if markup and markup.strip():
+        return html_to_text(markup)
+    return other or plain or None
+
+
+def normalize_body(text: str) -> str:
+    """Body text as indexed: quoted history, signature and footers removed, blank lines collapsed."""
+    text = text.replace("\r\n", "\n").replace("\r", "\n")
+    text = strip_footer(strip_signature(strip_quoted(text)))
+    return _BLANK_LINES.sub("\n", text).strip()
+
+
+def _legacy_body(payload: dict) -> str:
+    """The body as it was indexed before: the first non-empty part of any type, read as UTF-8."""
+    stack = [payload]
+    while stack:
+        part = stack.pop()
+        data = part.get("body", {}).get("data")
+        if data:
+            raw = base64.urlsafe_b64decode(data + "=" * ((4 - len(data) % 4) % 4))
+            return re.sub(r"[\n\r]+", "\n", raw.decode("utf-8", errors="replace").strip())
+        stack.extend(reversed(part.get("parts", [])))
+    return None
+
+
+def savings_report(messages: list, token_counter=None) -> list:
+    """
+    Compare the indexed body of each raw Gmail message before (first part, collapsed newlines) and
+    after normalization. Prints per-email and total bytes/tokens saved; returns the per-email rows.
+    """
+    if token_counter is None:
+        from ..agent.token_counter import TokenCounter
+
+        token_counter = TokenCounter(approximate=True)
+    rows = []
+    for message in messages:
+        before = _legacy_body(message.get("payload", {})) or ""
+        after = normalize_body(select_body(message.get("payload", {})) or "")
+        row = {
+            "id": message.get("id"),
+            "bytes_before": len(before.encode("utf-8")),
+            "bytes_after": len(after.encode("utf-8")),
+            "tokens_before": token_counter.count(before),
+            "tokens_after": token_counter.count(after),
+        }
+        rows.append(row)
+        print(
+            f"[{row['id']}] bytes {row['bytes_before']} -> {row['bytes_after']}, "
+            f"tokens {row['tokens_before']} -> {row['tokens_after']}"
+        )
+    if rows:
+        totals = {key: sum(row[key] for row in rows) for key in rows[0] if key != "id"}
+        for unit in ("bytes", "tokens"):
+            before, after = totals[f"{unit}_before"], totals[f"{unit}_after"]
+            saved = [row[f"{unit}_before"] - row[f"{unit}_after"] for row in rows]
+            print(
+                f"[TOTAL] {unit}: {before} -> {after} ({1 - after / max(1, before):.0%} saved), "
+                f"mean {statistics.mean(saved):.0f} / median {statistics.median(saved):.0f} saved per email"
+            )
+    return rows
+
+
+if __name__ == "__main__":
+    # python -m src.email_agent.utils.email_body [messages.json]: a JSON list of raw Gmail messages
+    if len(sys.argv) > 1:
+        corpus = json.loads(Path(sys.argv[1]).read_text(encoding="utf-8"))
+    else:
+        from .fake_gmail import sample_corpus
+
+        corpus = sample_corpus()
+    savings_report(corpus)
@@ -1,13 +1,21 @@
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 from .credential import main as get_creds
+from .email_store import EmailStore
 from dotenv import load_dotenv
 import json
 import os
+import time
 from pathlib import Path
 
 load_dotenv(dotenv_path="./.env")
 CONFIG_DIR = Path(os.getenv("CONFIG_DIR"))
 EMAILS_ID_THREADING = CONFIG_DIR / "emails_id_threading.json"
+EMAILS_DELETED = CONFIG_DIR / "emails_deleted.json"
+SYNC_STATE = CONFIG_DIR / "sync_state.json"
+# Messages added with any of these labels are not handed to the parser
+SKIPPED_LABELS = {"SPAM", "TRASH", "DRAFT"}
+DEFAULT_QUERY = "from:*@columbia.edu -subject:Spam"
 
 
 def get_items() -> list:
@@ -70,25 +78,173 @@ def fetch_emails(service, max_results=10, query="from:*@columbia.edu"):
     return all_messages[:max_results]
 
 
+def load_sync_state() -> dict:
+    """
+    Load the last sync state ({"history_id", "query", "max_results", "synced_at"}), or {} if there is none.
+    """
+    if not SYNC_STATE.exists():
+        return {}
+    return json.loads(SYNC_STATE.read_text(encoding="utf-8"))
+
+
+def save_sync_state(state: dict) -> None:
+    tmp_path = SYNC_STATE.with_suffix(".tmp")
+    tmp_path.write_text(json.dumps(state, ensure_ascii=False, indent=2))
+    os.replace(tmp_path, SYNC_STATE)
+
+
+def save_deleted_ids(message_ids: list) -> None:
+    EMAILS_DELETED.write_text(json.dumps(message_ids, ensure_ascii=False, indent=2))
+
+
+def get_history_id(service) -> str:
+    """
+    Get the current historyId of the mailbox.
+    """
+    return service.users().getProfile(userId="me").execute()["historyId"]
+
+
+def fetch_history(service, start_history_id: str) -> tuple[list, list, str]:
+    """
+    List the messages added and deleted since start_history_id.
+    Returns (added [{"id", "threadId"}], deleted ids, latest historyId).
+    Raises HttpError 404 when start_history_id is too old for Gmail to answer.
+    """
+    added, deleted = {}, set()
+    history_id = start_history_id
+    page_token = None
+    while True:
+        response = (
+            service.users()
+            .history()
+            .list(
+                userId="me",
+                startHistoryId=start_history_id,
+                historyTypes=["messageAdded", "messageDeleted"],
+                pageToken=page_token,
+            )
+            .execute()
+        )
+        for record in response.get("history", []):
+            for item in record.get("messagesAdded", []):
+                message = item["message"]
+                if SKIPPED_LABELS.isdisjoint(message.get("labelIds", [])):
+                    added[message["id"]] = {"id": message["id"], "threadId": message["threadId"]}
+            for item in record.get("messagesDeleted", []):
+                message_id = item["message"]["id"]
+                deleted.add(message_id)
+                added.pop(message_id, None)
+        history_id = response.get("historyId", history_id)
+        page_token = response.get("nextPageToken")
+        if not page_token:
+            break
+    return list(added.values()), sorted(deleted), history_id
+
+
+def list_message_ids(service, query: str) -> set:
+    """
+    Ids of every message matching query, paging through the whole listing (ids only, 500 per request).
+    """
+    ids = set()
+    page_token = None
+    while True:
+        response = service.users().messages().list(userId="me", maxResults=500, q=query, pageToken=page_token).execute()
+        ids.update(message["id"] for message in response.get("messages", []))
+        page_token = response.get("nextPageToken")
+        if not page_token:
+            return ids
+
+
+def filter_added(service, added: list, query: str, max_results: int = None, since: int = None) -> list:
+    """
+    Keep the added messages that match the saved query, at most max_results of them (the newest, as in
+    a full sync). Gmail history does not apply queries, so the ids are intersected with a listing of the
+    query restricted to messages received after since (epoch seconds), when it is known.
+    """
+    if not added:
+        return []
+    # A day of slack for messages delivered with an older Date than the last sync
+    matching = list_message_ids(service, f"{query} after:{since - 86400}" if since else query)
+    added = [message for message in added if message["id"] in matching]
+    # History lists messages oldest first
+    return added[-max_results:] if max_results else added
+
+
+def sync_settings(max_results: int = None, query: str = None, interactive: bool = False) -> tuple[int, str]:
+    """
+    The number of emails and the query for a full sync: the given values, else SYNC_MAX_RESULTS /
+    SYNC_QUERY, else the saved sync state, else (with interactive=True) the user is asked, else 10 and
+    DEFAULT_QUERY. Call it on the main thread; sync itself never prompts, since it may run in the background.
+    """
+    state = load_sync_state()
+    max_results = max_results or int(os.getenv("SYNC_MAX_RESULTS") or 0) or state.get("max_results")
+    query = query or os.getenv("SYNC_QUERY") or state.get("query")
+    if interactive and max_results is None:
+        max_results = int(input("Enter the number of emails to fetch: ") or 10)
+    if interactive and query is None:
+        query = input("Enter the query for fetching emails: ")
+    return max_results or 10, query or DEFAULT_QUERY
+
+
+def sync(service, max_results: int = None, query: str = None, known_ids: list = None) -> tuple[list, list, dict]:
+    """
+    Sync the mailbox and return (added, deleted, state) since the last run. state holds the new historyId;
+    the caller saves it with save_sync_state only once added and deleted are recorded durably, so a
+    crash before then syncs the same changes again instead of losing them.
+    Uses users.history.list from the stored historyId, keeping only added messages that match the saved
+    query and max_results; falls back to a full listing when there is no sync state or Gmail reports the
+    historyId as expired. On that fallback, known_ids (the ids already stored) that no longer match the
+    query are returned as deleted, since the history that recorded their deletion is gone. The full sync
+    uses max_results and query, defaulting as in sync_settings without prompting.
+    """
+    state = load_sync_state()
+    started_at = int(time.time())
+    if state.get("history_id"):
+        try:
+            added, deleted, history_id = fetch_history(service, state["history_id"])
+            new = len(added)
+            added = filter_added(service, added, state.get("query") or DEFAULT_QUERY, state.get("max_results"), state.get("synced_at"))
+            print(
+                f"Incremental sync: {len(added)} added ({new - len(added)} skipped by the query or max_results), "
+                f"{len(deleted)} deleted since history {state['history_id']}"
+            )
+            return added, deleted, {**state, "history_id": history_id, "synced_at": started_at}
+        except HttpError as e:
+            if e.resp.status != 404:
+                raise
+            print(f"History {state['history_id']} expired, running a full sync")
+    max_results, query = sync_settings(max_results, query)
+    print(f"Fetching {max_results} emails matching query: '{query}'")
+    # Read the historyId before listing so that nothing arriving mid-listing is missed
+    history_id = get_history_id(service)
+    added = fetch_emails(service, max_results, query)
+    deleted = []
+    if known_ids:
+        deleted = sorted(set(known_ids) - list_message_ids(service, query))
+        print(f"Full sync: {len(deleted)} stored emails are no longer in the mailbox")
+    return added, deleted, {"history_id": history_id, "query": query, "max_results": max_results, "synced_at": started_at}
+
+
 def main() -> None:
     """
-    Fetch emails from Gmail and save the IDs and thread IDs to a JSON file.
+    Sync emails from Gmail and save the IDs and thread IDs of new emails to a JSON file.
+    After the first run only messages added since the last sync are listed.
     """
     service = build("gmail", "v1", credentials=get_creds())
-    
-    max_results = int(input("Enter the number of emails to fetch: ")) or 10
-    query = input("Enter the query for fetching emails: ") or "from:*@columbia.edu -subject:Spam"
-    
-    print(f"Fetching {max_results} emails matching query: '{query}'")
-    
-    results = fetch_emails(service, max_results, query)
-    
-    print(f"Found {len(results)} emails matching your criteria")
-    
-    if results:
-        save_emails_id_threading(results)
-    else:
-        print("No emails found")
+    store = EmailStore()
+    try:
+        max_results, query = sync_settings(interactive=True)
+        results, deleted, state = sync(service, max_results, query, known_ids=store.ids())
+    finally:
+        store.close()
+
+    print(f"Found {len(results)} new emails matching your criteria")
+
+    save_emails_id_threading(results)
+    save_deleted_ids(deleted)
+    save_sync_state(state)
+    if not results:
+        print("No new emails found")
 
 
 if __name__ == "__main__":
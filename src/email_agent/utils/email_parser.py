@@ -3,16 +3,28 @@ from .credential import main as get_creds
 from dotenv import load_dotenv
 import json
 import os
+import sys
 import base64
-from jsonpath_ng.ext import parse
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Iterable, Iterator
 from pathlib import Path
+from .email_batch import EmailBatch
+from .email_body import normalize_body, select_body
 from .email_sample import EmailSample
+from .email_store import EmailStore
 import re
 
 load_dotenv(dotenv_path="./.env")
 CONFIG_DIR = Path(os.getenv("CONFIG_DIR"))
 EMAILS_ID_THREADING = CONFIG_DIR / "emails_id_threading.json"
 EMAILS_DECODED_CONTENT = CONFIG_DIR / "email_decoded_content.json"
+EMAILS_DELETED = CONFIG_DIR / "emails_deleted.json"
+
+GMAIL_BATCH_LIMIT = 100  # max sub-requests Gmail accepts in one batch call
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
 
 
 def get_email_id_threading() -> list:
@@ -22,43 +34,241 @@ def get_email_id_threading() -> list:
     return json.loads(EMAILS_ID_THREADING.read_text(encoding="utf-8"))
 
 
-def get_email_content_list(service: build, emails_id_threading: list) -> list[EmailSample]:
+def get_deleted_ids() -> list:
+    """
+    Get the IDs of emails deleted from the mailbox since the last sync.
+    """
+    if not EMAILS_DELETED.exists():
+        return []
+    return json.loads(EMAILS_DELETED.read_text(encoding="utf-8"))
+
+
+def _status_of(exception: Exception) -> int:
+    return getattr(getattr(exception, "resp", None), "status", None)
+
+
+def _backoff(attempt: int, base_delay: float) -> None:
+    time.sleep(base_delay * 2 ** attempt * (1 + random.random()))
+
+
+def _download_batch(
+    service: build,
+    message_ids: list[str],
+    message_format: str,
+    max_retries: int,
+    base_delay: float,
+) -> dict:
+    """
+    Download up to GMAIL_BATCH_LIMIT messages with one batch call.
+    Messages failing with 429/5xx are retried with exponential backoff; the rest are kept.
+    """
+    results = {}
+    pending = message_ids
+    for attempt in range(max_retries + 1):
+        retry = set()
+
+        def callback(request_id, response, exception):
+            if exception is None:
+                results[request_id] = response
+            elif _status_of(exception) in RETRYABLE_STATUS and attempt < max_retries:
+                retry.add(request_id)
+            else:
+                print(f"[Email {request_id}]: download failed: {exception}")
+                results[request_id] = None
+
+        batch = service.new_batch_http_request(callback=callback)
+        for message_id in pending:
+            batch.add(
+                service.users().messages().get(userId="me", id=message_id, format=message_format),
+                request_id=message_id,
+            )
+        try:
+            batch.execute()
+        except Exception as e:
+            # The whole batch call failed, e.g. the batch endpoint itself returned 429
+            if _status_of(e) not in RETRYABLE_STATUS or attempt == max_retries:
+                raise
+            retry = set(pending)
+        pending = [message_id for message_id in pending if message_id in retry]
+        if not pending:
+            break
+        _backoff(attempt, base_delay)
+    return results
+
+
+def download_messages(
+    service_factory: Callable[[], build],
+    message_ids: list[str],
+    batch_size: int = GMAIL_BATCH_LIMIT,
+    max_workers: int = 4,
+    max_retries: int = 5,
+    base_delay: float = 0.5,
+    message_format: str = "full",
+) -> list[dict]:
+    """
+    Download messages through the Gmail batch endpoint, keeping up to max_workers batches in flight.
+    service_factory is called once per worker thread, since the httplib2 transport is not thread-safe.
+    Returns the raw messages in the order of message_ids; messages that could not be fetched are None.
+    """
+    batch_size = max(1, min(batch_size, GMAIL_BATCH_LIMIT))
+    unique_ids = list(dict.fromkeys(message_ids))
+    chunks = [unique_ids[i:i + batch_size] for i in range(0, len(unique_ids), batch_size)]
+    local = threading.local()
+
+    def worker(chunk: list[str]) -> dict:
+        if not hasattr(local, "service"):
+            local.service = service_factory()
+        return _download_batch(local.service, chunk, message_format, max_retries, base_delay)
+
+    start_time = time.perf_counter()
+    results = {}
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        for chunk_results in executor.map(worker, chunks):
+            results.update(chunk_results)
+    elapsed = time.perf_counter() - start_time
+    downloaded = sum(1 for message in results.values() if message is not None)
+    print(
+        f"[DOWNLOAD] {downloaded}/{len(unique_ids)} messages in {elapsed:.2f}s "
+        f"({downloaded / elapsed if elapsed > 0 else 0:.1f} msg/s)"
+    )
+    return [results.get(message_id) for message_id in message_ids]
+
+
+def iter_downloaded_batches(
+    service_factory: Callable[[], build],
+    emails_id_threading: list,
+    batch_size: int = GMAIL_BATCH_LIMIT,
+    max_workers: int = 4,
+    max_retries: int = 5,
+    base_delay: float = 0.5,
+) -> Iterator[list[tuple[dict, dict]]]:
+    """
+    Streaming form of download_messages: yield [(email, raw message), ...] per batch as soon as it
+    arrives, keeping at most max_workers batches in flight. A slow consumer holds back new downloads,
+    so at most max_workers + 1 batches are ever in memory. Messages that could not be fetched are skipped.
+    """
+    batch_size = max(1, min(batch_size, GMAIL_BATCH_LIMIT))
+    emails = list({email["id"]: email for email in emails_id_threading}.values())
+    chunks = iter([emails[i:i + batch_size] for i in range(0, len(emails), batch_size)])
+    local = threading.local()
+
+    def worker(chunk: list[dict]) -> list[tuple[dict, dict]]:
+        if not hasattr(local, "service"):
+            local.service = service_factory()
+        results = _download_batch(local.service, [email["id"] for email in chunk], "full", max_retries, base_delay)
+        return [(email, results[email["id"]]) for email in chunk if results.get(email["id"]) is not None]
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        in_flight = set()
+        for chunk in chunks:
+            in_flight.add(executor.submit(worker, chunk))
+            if len(in_flight) == max(1, max_workers):
+                break
+        while in_flight:
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+                chunk = next(chunks, None)
+                if chunk is not None:
+                    in_flight.add(executor.submit(worker, chunk))
+
+
+def _decode_body(data: str) -> str:
+    return base64.urlsafe_b64decode(data + "=" * ((4 - len(data) % 4) % 4)).decode("utf-8")
+
+
+def extract_message(results: dict) -> dict:
+    """
+    Extract sender, receiver, date, subject and body from a raw Gmail message in one pass.
+    Headers are read into a dict (first occurrence wins, names are case-insensitive) and
+    the body is chosen by select_body: text/plain preferred, HTML converted to text, charsets decoded.
+    Missing headers come back as "" and a missing body as None.
+    """
+    payload = results.get("payload", {})
+    headers = {}
+    for header in payload.get("headers", []):
+        headers.setdefault(header["name"].lower(), header["value"])
+    body = select_body(payload)
+    return {
+        "sender": headers.get("from", ""),
+        "receiver": headers.get("to", ""),
+        "date": headers.get("date", ""),
+        "subject": headers.get("subject", ""),
+        "body": body,
+    }
+
+
+def build_email_sample(email: dict, results: dict) -> EmailSample:
+    """
+    Build an EmailSample from a raw Gmail message. Returns None if the message has no body.
+    """
+    fields = extract_message(results)
+    if not fields["body"]:
+        return None
+    email_sample = EmailSample(
+        id=email["id"],
+        thread_id=email["threadId"],
+        sender=fields["sender"],
+        receiver=fields["receiver"],
+        date=fields["date"],
+        subject=fields["subject"],
+    )
+    email_sample.set_content(modify_content(normalize_body(fields["body"])))
+    return email_sample
+
+
+def build_email_batch(messages: Iterable[tuple]) -> EmailBatch:
+    """
+    Build an EmailBatch from (listing entry, raw Gmail message) pairs, skipping messages without a body.
+    """
+    batch = EmailBatch()
+    for email, results in messages:
+        fields = extract_message(results)
+        if not fields["body"]:
+            continue
+        batch.append(
+            email["id"],
+            email["threadId"],
+            fields["subject"],
+            fields["sender"],
+            fields["receiver"],
+            fields["date"],
+            modify_content(normalize_body(fields["body"])),
+        )
+    return batch
+
+
+def get_email_content_list(
+    service: build,
+    emails_id_threading: list,
+    service_factory: Callable[[], build] = None,
+    max_workers: int = 4,
+    batch_size: int = GMAIL_BATCH_LIMIT,
+) -> list[EmailSample]:
     """
     Get the email content from the Gmail API.
+    Messages are downloaded in batches; pass service_factory to run several batches concurrently,
+    otherwise the given service is used from a single worker.
     """
-    expression = parse("$.payload..body.data")
+    if service_factory is None:
+        service_factory = lambda: service
+        max_workers = 1
+    messages = download_messages(
+        service_factory,
+        [email["id"] for email in emails_id_threading],
+        batch_size=batch_size,
+        max_workers=max_workers,
+    )
     email_samples = []
-    for email in emails_id_threading:
+    for email, results in zip(emails_id_threading, messages):
+        if results is None:
+            continue
         print(
             f"[Email {email['id']}]: ID: {email['id']}, Thread ID: {email['threadId']} FOUNDED!"
         )
-        results = service.users().messages().get(userId="me", id=email["id"]).execute()
-        email_sample = EmailSample(
-            id=email["id"],
-            thread_id=email["threadId"],
-            sender=parse("$.payload.headers[?(@.name == 'From')].value")
-            .find(results)[0]
-            .value,
-            receiver=parse("$.payload.headers[?(@.name == 'To')].value")
-            .find(results)[0]
-            .value,
-            date=parse("$.payload.headers[?(@.name == 'Date')].value")
-            .find(results)[0]
-            .value,
-            subject=parse("$.payload.headers[?(@.name == 'Subject')].value")
-            .find(results)[0]
-            .value,
-        )
-        content = next((item for item in expression.find(results) if item.value), None)
-        if content:
-            content = base64.urlsafe_b64decode(
-                content.value + "=" * ((4 - len(content.value) % 4) % 4)
-            ).decode("utf-8")
-            email_sample.set_content(modify_content(content))
+        email_sample = build_email_sample(email, results)
+        if email_sample:
             email_samples.append(email_sample)
-            # print(email_sample.get_content())
-            # print("--------------------------------")
-            # break
     return email_samples
 
 def modify_content(content: str) -> str:
@@ -68,13 +278,28 @@ def modify_content(content: str) -> str:
     content = re.sub(r"[\n\r]+", r"\n", content.strip())
     return content
 
-def main() -> list[EmailSample]:
+def main(store: EmailStore = None) -> list[EmailSample]:
     """
-    Parse the emails from the JSON file and save the parsed emails to a JSON file.
+    Parse the emails listed in the JSON file, downloading only those not already in the email store.
+    Newly parsed emails are saved to the store and emails deleted from the mailbox are removed from it.
     """
-    service = build("gmail", "v1", credentials=get_creds())
+    store = store or EmailStore()
+    store.delete(get_deleted_ids())
     emails_id_threading = get_email_id_threading()
-    email_samples = get_email_content_list(service, emails_id_threading)
+    email_ids = [email["id"] for email in emails_id_threading]
+    missing_ids = set(store.missing_ids(email_ids))
+    print(f"{len(email_ids) - len(missing_ids)} emails found in the store, {len(missing_ids)} to download")
+    if missing_ids:
+        creds = get_creds()
+        service = build("gmail", "v1", credentials=creds)
+        store.add_many(
+            get_email_content_list(
+                service,
+                [email for email in emails_id_threading if email["id"] in missing_ids],
+                service_factory=lambda: build("gmail", "v1", credentials=creds),
+            )
+        )
+    email_samples = store.get_many(email_ids)
     # for email_sample in email_samples:
     #     print(email_sample)
     #     print("--------------------------------")
@@ -98,9 +323,59 @@ def main() -> list[EmailSample]:
 #     #     print(match.value)
 
 
+def benchmark_download(n: int = 500, latency: float = 0.02, max_workers: int = 4) -> None:
+    """
+    Compare one-request-per-message downloads with batched, concurrent downloads
+    against a local fake Gmail service.
+    """
+    from .fake_gmail import FakeGmailService
+
+    service = FakeGmailService.from_sample(n, latency=latency, per_message_latency=latency / 50)
+    message_ids = list(service.messages)
+    start_time = time.perf_counter()
+    for message_id in message_ids:
+        service.users().messages().get(userId="me", id=message_id).execute()
+    elapsed = time.perf_counter() - start_time
+    print(f"[SEQUENTIAL] {n} messages in {elapsed:.2f}s ({n / elapsed:.1f} msg/s)")
+    for workers in (1, max_workers):
+        print(f"[BATCHED] workers={workers}")
+        download_messages(lambda: service, message_ids, max_workers=workers)
+
+
+def benchmark_extraction(n: int = 200) -> None:
+    """
+    Compare the single-pass extractor with the previous per-message jsonpath expressions.
+    """
+    from jsonpath_ng.ext import parse
+
+    message = json.loads(EMAILS_DECODED_CONTENT.read_text(encoding="utf-8"))
+
+    def extract_with_jsonpath(results: dict) -> dict:
+        fields = {
+            key: parse(f"$.payload.headers[?(@.name == '{name}')].value").find(results)[0].value
+            for key, name in (("sender", "From"), ("receiver", "To"), ("date", "Date"), ("subject", "Subject"))
+        }
+        content = next((item for item in parse("$.payload..body.data").find(results) if item.value), None)
+        fields["body"] = _decode_body(content.value) if content else None
+        return fields
+
+    # Headers must agree; the body differs since extract_message converts the HTML part to text
+    expected, fields = extract_with_jsonpath(message), extract_message(message)
+    assert all(expected[key] == fields[key] for key in ("sender", "receiver", "date", "subject"))
+    for name, extractor in (("JSONPATH", extract_with_jsonpath), ("SINGLE-PASS", extract_message)):
+        start_time = time.perf_counter()
+        for _ in range(n):
+            extractor(message)
+        elapsed = time.perf_counter() - start_time
+        print(f"[{name}] {n} messages in {elapsed:.3f}s ({elapsed / n * 1e6:.1f} us/message)")
+
+
 if __name__ == "__main__":
     # test_jsonpath_ng()
     # Convert "=" to binary representation
-    email_samples = main()
-    print(len(email_samples))
-    pass
+    if "--benchmark" in sys.argv:
+        benchmark_download()
+        benchmark_extraction()
+    else:
+        email_samples = main()
+        print(len(email_samples))
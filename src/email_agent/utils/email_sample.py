@@ -1,4 +1,27 @@
+# Marks word/sentence counts that have not been computed yet
+_UNSET = object()
+
+
+def content_stats(content: str) -> tuple:
+    """
+    (word count, sentence count) of content. Words are whitespace-separated runs; sentences are
+    the average of the '.'- and newline-separated pieces, as before. Separators are counted in
+    place instead of splitting the content into lists.
+    """
+    if len(content) == 0:
+        return 0, 0
+    return len(content.split()), (content.count(".") + content.count("\n") + 2) // 2
+
+
 class EmailSample:
+    """
+    One parsed email. Slotted (no per-instance __dict__); word_count and sentence_count are
+    computed on first access and reset by set_content. Equality and hashing use id and thread_id.
+    For many emails at once, see EmailBatch.
+    """
+
+    __slots__ = ("id", "thread_id", "subject", "sender", "receiver", "date", "content", "_word_count", "_sentence_count")
+
     def __init__(
         self,
         id: str = "",
@@ -19,23 +42,49 @@ class EmailSample:
         self.date = date
         self.content = content
         if (word_count is None or sentence_count is None) and len(content) > 0:
-            self.word_count, self.sentence_count = self.content_stats()
+            self._word_count = self._sentence_count = _UNSET
         else:
-            self.word_count = word_count
-            self.sentence_count = sentence_count
+            self._word_count = word_count
+            self._sentence_count = sentence_count
+
+    def _compute_stats(self) -> None:
+        self._word_count, self._sentence_count = content_stats(self.content)
+
+    @property
+    def word_count(self) -> int:
+        if self._word_count is _UNSET:
+            self._compute_stats()
+        return self._word_count
+
+    @word_count.setter
+    def word_count(self, value: int):
+        self._word_count = value
+
+    @property
+    def sentence_count(self) -> int:
+        if self._sentence_count is _UNSET:
+            self._compute_stats()
+        return self._sentence_count
+
+    @sentence_count.setter
+    def sentence_count(self, value: int):
+        self._sentence_count = value
 
     def __str__(self):
         return f"【Id】: {self.id}\n【Thread ID】: {self.thread_id}\n【Subject】: {self.subject}\n【Sender】: {self.sender}\n【Receiver】: {self.receiver}\n【Date】: {self.date}\n【Content】: {self.content}\n【Word Count】: {self.word_count}\n【Sentence Count】: {self.sentence_count}"
 
     def __repr__(self):
         return f"EmailSample(id={self.id}, thread_id={self.thread_id}, subject={self.subject}, sender={self.sender}, receiver={self.receiver}, date={self.date}, content={self.content}, word_count={self.word_count}, sentence_count={self.sentence_count})"
-    
+
     def __eq__(self, other):
         return self.id == other.id and self.thread_id == other.thread_id
 
+    def __hash__(self):
+        return hash((self.id, self.thread_id))
+
     def set_content(self, content: str):
         self.content = content
-        self.word_count, self.sentence_count = self.content_stats()
+        self._word_count = self._sentence_count = _UNSET
 
     def set_subject(self, subject: str):
         self.subject = subject
@@ -71,10 +120,4 @@ class EmailSample:
         return self.thread_id
 
     def content_stats(self):
-        if len(self.content) == 0:
-            return 0, 0
-        word_count = len(self.content.split())
-        sentence_count = (
-            len(self.content.split(".")) + len(self.content.split("\n"))
-        ) // 2
-        return word_count, sentence_count
+        return content_stats(self.content)
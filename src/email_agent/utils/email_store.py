@@ -0,0 +1,233 @@
+import os
+import sqlite3
+import threading
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+from pathlib import Path
+from typing import Iterable, Iterator
+
+from dotenv import load_dotenv
+from .email_batch import EmailBatch
+from .email_sample import EmailSample
+
+load_dotenv(dotenv_path="./.env")
+CONFIG_DIR = Path(os.getenv("CONFIG_DIR"))
+EMAIL_STORE = CONFIG_DIR / "ljs_columbia_email_store.db"
+
+_COLUMNS = (
+    "id",
+    "thread_id",
+    "subject",
+    "sender",
+    "receiver",
+    "date",
+    "content",
+    "word_count",
+    "sentence_count",
+)
+_SELECT = f"SELECT {', '.join(_COLUMNS)} FROM emails"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS emails (
+    id TEXT PRIMARY KEY,
+    thread_id TEXT NOT NULL,
+    subject TEXT,
+    sender TEXT,
+    receiver TEXT,
+    date TEXT,
+    date_ts INTEGER,
+    content TEXT,
+    word_count INTEGER,
+    sentence_count INTEGER
+);
+CREATE INDEX IF NOT EXISTS emails_thread_id ON emails (thread_id);
+CREATE INDEX IF NOT EXISTS emails_sender ON emails (sender);
+CREATE INDEX IF NOT EXISTS emails_date_ts ON emails (date_ts);
+CREATE TABLE IF NOT EXISTS tombstones (id TEXT PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS pending (id TEXT PRIMARY KEY, thread_id TEXT NOT NULL);
+"""
+
+
+def parse_date(date: str) -> int:
+    """
+    Parse an RFC 2822 Date header into epoch seconds. Returns None if it cannot be parsed.
+    """
+    try:
+        return int(parsedate_to_datetime(date).timestamp())
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def _to_timestamp(value) -> int:
+    return int(value.timestamp()) if isinstance(value, datetime) else value
+
+
+class EmailStore:
+    """
+    On-disk store of parsed EmailSamples keyed by message id (SQLite in WAL mode).
+    - add_many: bulk insert/replace in one transaction (EmailSamples or an EmailBatch)
+    - get / get_many / by_thread / by_sender / by_date_range: indexed lookups
+    - missing_ids: ids that still have to be downloaded; ids: every stored id
+    - iter_emails: stream every stored email without loading the mailbox into memory
+    - delete: remove emails and leave a tombstone per id, which the agent applies to the index
+      (tombstones / clear_tombstones) so that deleted emails stop being retrieved
+    - add_pending / pending: messages a sync listed but that are not stored yet; storing an email
+      (or deleting it) clears its pending row, so downloads that failed or were interrupted are retried
+    """
+
+    def __init__(self, path: Path = EMAIL_STORE):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+
+    def close(self) -> None:
+        self._conn.close()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM emails").fetchone()[0]
+
+    def __contains__(self, email_id: str) -> bool:
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM emails WHERE id = ?", (email_id,)).fetchone() is not None
+
+    @staticmethod
+    def _to_row(email: EmailSample) -> tuple:
+        return (
+            email.id,
+            email.thread_id,
+            email.subject,
+            email.sender,
+            email.receiver,
+            email.date,
+            parse_date(email.date),
+            email.content,
+            email.word_count,
+            email.sentence_count,
+        )
+
+    @staticmethod
+    def _batch_rows(batch: EmailBatch) -> list[tuple]:
+        return [
+            (*row[:6], parse_date(row[5]), *row[6:])
+            for row in batch.iter_rows(*_COLUMNS)
+        ]
+
+    @staticmethod
+    def _to_email(row: tuple) -> EmailSample:
+        return EmailSample(**dict(zip(_COLUMNS, row)))
+
+    def add_many(self, emails: Iterable[EmailSample]) -> int:
+        """Insert or replace emails in a single transaction. Returns the number of rows written."""
+        if isinstance(emails, EmailBatch):
+            rows = self._batch_rows(emails)
+        else:
+            rows = [self._to_row(email) for email in emails]
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO emails "
+                "(id, thread_id, subject, sender, receiver, date, date_ts, content, word_count, sentence_count) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            self._conn.executemany("DELETE FROM pending WHERE id = ?", ((row[0],) for row in rows))
+        return len(rows)
+
+    def delete(self, email_ids: Iterable[str]) -> None:
+        """Delete emails and record a tombstone for each id, in one transaction."""
+        rows = [(email_id,) for email_id in email_ids]
+        with self._lock, self._conn:
+            self._conn.executemany("DELETE FROM emails WHERE id = ?", rows)
+            self._conn.executemany("DELETE FROM pending WHERE id = ?", rows)
+            self._conn.executemany("INSERT OR IGNORE INTO tombstones (id) VALUES (?)", rows)
+
+    def add_pending(self, messages: Iterable[dict]) -> None:
+        """Record listed messages ({"id", "threadId"}) to download, in one transaction."""
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO pending (id, thread_id) VALUES (?, ?)",
+                ((message["id"], message["threadId"]) for message in messages),
+            )
+
+    def pending(self) -> list[dict]:
+        """Messages listed by a sync and not stored yet, oldest first, as {"id", "threadId"}."""
+        with self._lock:
+            rows = self._conn.execute("SELECT id, thread_id FROM pending ORDER BY rowid").fetchall()
+        return [{"id": email_id, "threadId": thread_id} for email_id, thread_id in rows]
+
+    def tombstones(self) -> list[str]:
+        """Ids deleted since the tombstones were last cleared."""
+        with self._lock:
+            return [row[0] for row in self._conn.execute("SELECT id FROM tombstones")]
+
+    def clear_tombstones(self, email_ids: Iterable[str]) -> None:
+        """Forget tombstones once the index has recorded the deletions durably."""
+        with self._lock, self._conn:
+            self._conn.executemany("DELETE FROM tombstones WHERE id = ?", ((email_id,) for email_id in email_ids))
+
+    def _query(self, where: str, params: tuple) -> list[EmailSample]:
+        with self._lock:
+            rows = self._conn.execute(f"{_SELECT} WHERE {where}", params).fetchall()
+        return [self._to_email(row) for row in rows]
+
+    def get(self, email_id: str) -> EmailSample:
+        emails = self._query("id = ?", (email_id,))
+        return emails[0] if emails else None
+
+    def get_many(self, email_ids: list[str]) -> list[EmailSample]:
+        """Get emails by id, in the order of email_ids. Unknown ids are skipped."""
+        found = {}
+        for i in range(0, len(email_ids), 500):
+            chunk = email_ids[i:i + 500]
+            for email in self._query(f"id IN ({', '.join('?' * len(chunk))})", tuple(chunk)):
+                found[email.id] = email
+        return [found[email_id] for email_id in email_ids if email_id in found]
+
+    def ids(self) -> list[str]:
+        """Every stored message id."""
+        with self._lock:
+            return [row[0] for row in self._conn.execute("SELECT id FROM emails")]
+
+    def missing_ids(self, email_ids: list[str]) -> list[str]:
+        """Return the ids in email_ids that are not stored yet, keeping their order."""
+        stored = set()
+        for i in range(0, len(email_ids), 500):
+            chunk = email_ids[i:i + 500]
+            with self._lock:
+                rows = self._conn.execute(
+                    f"SELECT id FROM emails WHERE id IN ({', '.join('?' * len(chunk))})", tuple(chunk)
+                ).fetchall()
+            stored.update(row[0] for row in rows)
+        return [email_id for email_id in email_ids if email_id not in stored]
+
+    def by_thread(self, thread_id: str) -> list[EmailSample]:
+        return self._query("thread_id = ? ORDER BY date_ts", (thread_id,))
+
+    def by_sender(self, sender: str) -> list[EmailSample]:
+        """Emails whose From header contains sender (name or address), newest first."""
+        return self._query("sender LIKE ? ORDER BY date_ts DESC", (f"%{sender}%",))
+
+    def by_date_range(self, start=None, end=None) -> list[EmailSample]:
+        """Emails dated in [start, end); bounds are datetimes or epoch seconds, None is open."""
+        start, end = _to_timestamp(start), _to_timestamp(end)
+        return self._query(
+            "(? IS NULL OR date_ts >= ?) AND (? IS NULL OR date_ts < ?) ORDER BY date_ts",
+            (start, start, end, end),
+        )
+
+    def iter_emails(self, batch_size: int = 500) -> Iterator[EmailSample]:
+        """Stream every stored email in id order, batch_size rows at a time."""
+        last_id = ""
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    f"{_SELECT} WHERE id > ? ORDER BY id LIMIT ?", (last_id, batch_size)
+                ).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield self._to_email(row)
+            last_id = rows[-1][0]
@@ -0,0 +1,306 @@
+import base64
+import copy
+import fnmatch
+import json
+import random
+import threading
+import time
+from pathlib import Path
+
+import httplib2
+from googleapiclient.errors import HttpError
+from .email_parser import GMAIL_BATCH_LIMIT
+
+_SAMPLE_MESSAGE = Path(__file__).parent.parent / "config" / "email_decoded_content.json"
+
+
+def _http_error(status: int, message: str) -> HttpError:
+    return HttpError(httplib2.Response({"status": status}), message.encode("utf-8"))
+
+
+def _matches(message: dict, query: str) -> bool:
+    """
+    A small subset of Gmail search: space-separated from:, subject: and after: (epoch seconds) terms,
+    negated with a leading -. from: is a glob over the From header, subject: a substring of the subject.
+    Messages without internalDate match any after: term.
+    """
+    headers = {header["name"].lower(): header["value"].lower() for header in message.get("payload", {}).get("headers", [])}
+    for term in (query or "").split():
+        negated = term.startswith("-")
+        field, _, value = term.lstrip("-").partition(":")
+        value = value.lower()
+        if field == "from":
+            hit = fnmatch.fnmatch(headers.get("from", ""), f"*{value}*")
+        elif field == "subject":
+            hit = value in headers.get("subject", "")
+        elif field == "after":
+            hit = "internalDate" not in message or int(message["internalDate"]) // 1000 > int(value)
+        else:
+            continue
+        if hit == negated:
+            return False
+    return True
+
+
+class _FakeRequest:
+    def __init__(self, service: "FakeGmailService", handler, *args):
+        self._service = service
+        self._handler = handler
+        self._args = args
+
+    def _run(self) -> dict:
+        return self._handler(*self._args)
+
+    def execute(self) -> dict:
+        self._service._round_trip(1)
+        return self._run()
+
+
+class _FakeBatch:
+    def __init__(self, service: "FakeGmailService", callback=None):
+        self._service = service
+        self._callback = callback
+        self._requests = []
+
+    def add(self, request: _FakeRequest, callback=None, request_id: str = None) -> None:
+        if len(self._requests) >= GMAIL_BATCH_LIMIT:
+            raise ValueError(f"Batch exceeds {GMAIL_BATCH_LIMIT} requests")
+        request_id = request_id or str(len(self._requests))
+        if any(request_id == rid for rid, _, _ in self._requests):
+            raise KeyError(f"A request with this ID already exists: {request_id}")
+        self._requests.append((request_id, request, callback))
+
+    def execute(self) -> None:
+        self._service._round_trip(len(self._requests), batch=True)
+        for request_id, request, callback in self._requests:
+            callback = callback or self._callback
+            try:
+                response, exception = request._run(), None
+            except HttpError as e:
+                response, exception = None, e
+            if callback:
+                callback(request_id, response, exception)
+
+
+class _FakeMessages:
+    def __init__(self, service: "FakeGmailService"):
+        self._service = service
+
+    def get(self, userId: str, id: str, format: str = "full") -> _FakeRequest:
+        return _FakeRequest(self._service, self._service._get_message, id)
+
+    def list(self, userId: str, maxResults: int = 100, q: str = None, pageToken: str = None) -> _FakeRequest:
+        return _FakeRequest(self._service, self._service._list_messages, maxResults, pageToken, q)
+
+
+class _FakeHistory:
+    def __init__(self, service: "FakeGmailService"):
+        self._service = service
+
+    def list(
+        self,
+        userId: str,
+        startHistoryId: str,
+        historyTypes: list = None,
+        pageToken: str = None,
+        maxResults: int = 100,
+    ) -> _FakeRequest:
+        return _FakeRequest(self._service, self._service._list_history, startHistoryId, pageToken, maxResults)
+
+
+class _FakeUsers:
+    def __init__(self, service: "FakeGmailService"):
+        self._service = service
+
+    def messages(self) -> _FakeMessages:
+        return _FakeMessages(self._service)
+
+    def history(self) -> _FakeHistory:
+        return _FakeHistory(self._service)
+
+    def getProfile(self, userId: str) -> _FakeRequest:
+        return _FakeRequest(self._service, lambda: {"historyId": str(self._service.history_id)})
+
+
+class FakeGmailService:
+    """
+    In-process stand-in for the Gmail API client returned by googleapiclient.discovery.build.
+    Only the calls used by the fetcher and parser are implemented:
+    - users().messages().get / list (list understands from:, subject: and after: terms)
+    - users().history().list and users().getProfile
+    - new_batch_http_request
+    Every execute() sleeps `latency` to simulate a network round trip, and each message
+    fails with `fail_status` with probability `fail_rate` to exercise retries.
+    """
+
+    def __init__(
+        self,
+        messages: list[dict],
+        latency: float = 0.0,
+        per_message_latency: float = 0.0,
+        fail_rate: float = 0.0,
+        fail_status: int = 429,
+        seed: int = 0,
+    ):
+        self.messages = {message["id"]: message for message in messages}
+        self.latency = latency
+        self.per_message_latency = per_message_latency
+        self.fail_rate = fail_rate
+        self.fail_status = fail_status
+        self.round_trips = 0
+        self.batch_calls = 0
+        # Mailbox changes as (history id, "messagesAdded" | "messagesDeleted", message id, thread id)
+        self.history = []
+        self.history_id = 1
+        self.min_history_id = 1
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_sample(cls, n: int, **kwargs) -> "FakeGmailService":
+        """Build a fake mailbox of n copies of the bundled sample message with unique ids."""
+        sample = json.loads(_SAMPLE_MESSAGE.read_text(encoding="utf-8"))
+        messages = []
+        for i in range(n):
+            message = copy.deepcopy(sample)
+            message["id"] = f"{i:016x}"
+            message["threadId"] = f"{i // 3:016x}"
+            messages.append(message)
+        return cls(messages, **kwargs)
+
+    def users(self) -> _FakeUsers:
+        return _FakeUsers(self)
+
+    def new_batch_http_request(self, callback=None) -> _FakeBatch:
+        return _FakeBatch(self, callback)
+
+    def add_message(self, message: dict) -> None:
+        """Deliver a new message, recording it in the mailbox history."""
+        with self._lock:
+            self.messages[message["id"]] = message
+            self.history_id += 1
+            self.history.append((self.history_id, "messagesAdded", message["id"], message["threadId"]))
+
+    def delete_message(self, message_id: str) -> None:
+        with self._lock:
+            message = self.messages.pop(message_id)
+            self.history_id += 1
+            self.history.append((self.history_id, "messagesDeleted", message_id, message["threadId"]))
+
+    def expire_history(self) -> None:
+        """Drop all history records so older historyIds return 404, as Gmail does after about a week."""
+        with self._lock:
+            self.history = []
+            self.min_history_id = self.history_id
+
+    def _round_trip(self, n_messages: int, batch: bool = False) -> None:
+        with self._lock:
+            self.round_trips += 1
+            self.batch_calls += batch
+        time.sleep(self.latency + self.per_message_latency * n_messages)
+
+    def _get_message(self, message_id: str) -> dict:
+        with self._lock:
+            failed = self.fail_rate and self._random.random() < self.fail_rate
+        if failed:
+            raise _http_error(self.fail_status, f"Injected failure for {message_id}")
+        if message_id not in self.messages:
+            raise _http_error(404, f"Message {message_id} not found")
+        return self.messages[message_id]
+
+    def _list_messages(self, max_results: int, page_token: str = None, query: str = None) -> dict:
+        ids = [message_id for message_id, message in self.messages.items() if _matches(message, query)]
+        start = int(page_token or 0)
+        page = [
+            {"id": mid, "threadId": self.messages[mid]["threadId"]}
+            for mid in ids[start:start + max_results]
+        ]
+        response = {"messages": page, "resultSizeEstimate": len(page)}
+        if start + max_results < len(ids):
+            response["nextPageToken"] = str(start + max_results)
+        return response
+
+    def _list_history(self, start_history_id: str, page_token: str = None, max_results: int = 100) -> dict:
+        if int(start_history_id) < self.min_history_id:
+            raise _http_error(404, f"Requested entity was not found: history {start_history_id}")
+        records = [record for record in self.history if record[0] > int(start_history_id)]
+        start = int(page_token or 0)
+        page = [
+            {
+                "id": str(history_id),
+                change: [{"message": {"id": message_id, "threadId": thread_id, "labelIds": ["INBOX"]}}],
+            }
+            for history_id, change, message_id, thread_id in records[start:start + max_results]
+        ]
+        response = {"history": page, "historyId": str(self.history_id)}
+        if start + max_results < len(records):
+            response["nextPageToken"] = str(start + max_results)
+        return response
+
+
+def _part(mime_type: str, text: str, charset: str = "UTF-8") -> dict:
+    data = base64.urlsafe_b64encode(text.encode(charset)).decode("ascii").rstrip("=")
+    headers = [{"name": "Content-Type", "value": f"{mime_type}; charset={charset}"}]
+    return {"mimeType": mime_type, "filename": "", "headers": headers, "body": {"size": len(text), "data": data}}
+
+
+_TOPICS = ["budget review", "lab schedule", "grant report", "course staffing", "server migration"]
+_DISCLAIMER = (
+    "CONFIDENTIALITY NOTICE: This e-mail message, including any attachments, is for the sole use of the "
+    "intended recipient(s) and may contain confidential and privileged information. Any unauthorized review, "
+    "use, disclosure or distribution is prohibited. If you are not the intended recipient, please contact the "
+    "sender by reply e-mail and destroy all copies of the original message."
+)
+
+
+def sample_corpus(n_threads: int = 10, replies: int = 4, seed: int = 0) -> list[dict]:
+    """
+    Raw Gmail messages for exercising body normalization: reply threads whose messages quote the whole
+    thread so far, in four client styles (Gmail plain+HTML, Outlook HTML-only with a legal footer,
+    ISO-8859-1 plain text with a '-- ' signature, mobile 'Sent from my iPhone'), plus the bundled sample.
+    """
+    rng = random.Random(seed)
+    messages = [json.loads(_SAMPLE_MESSAGE.read_text(encoding="utf-8"))]
+    for t in range(n_threads):
+        topic = _TOPICS[t % len(_TOPICS)]
+        history = ""
+        for r in range(replies):
+            style = (t + r) % 4
+            sender = f"José Müller {r}" if style == 2 else f"Sender {rng.randrange(100)}"
+            body = "\n".join(
+                f"Point {i + 1} on the {topic}: item {rng.randrange(1000)} needs a decision by Friday."
+                for i in range(rng.randrange(2, 6))
+            )
+            date = f"Mon, {r + 1} Jul 2024 10:00:00 +0000"
+            if style == 0:
+                quoted = "\n".join("> " + line for line in history.split("\n")) if history else ""
+                plain = f"Hi all,\n{body}\n\nThanks,\n{sender}\n\nOn {date}, Previous <p@example.com> wrote:\n{quoted}"
+                markup = (
+                    f"<html><head><style>p {{ margin: 0 }}</style></head><body><div dir=\"ltr\"><p>Hi all,</p>"
+                    + "".join(f"<p>{line}</p>" for line in body.split("\n"))
+                    + f"<p>Thanks,<br>{sender}</p></div><div class=\"gmail_quote\"><blockquote>{history}</blockquote></div></body></html>"
+                )
+                payload = {"mimeType": "multipart/alternative", "parts": [_part("text/plain", plain), _part("text/html", markup)]}
+            elif style == 1:
+                markup = (
+                    "<html><head><meta charset=\"utf-8\"><style>.x { color: red }</style></head><body>"
+                    + "".join(f"<div>{line}&nbsp;</div>" for line in body.split("\n"))
+                    + f"<div>Best regards,<br>{sender}</div><p style=\"font-size:8pt\">{_DISCLAIMER}</p>"
+                    + f"<div id=\"divRplyFwdMsg\"><b>From:</b> Previous<br><b>Sent:</b> {date}<br>{history}</div></body></html>"
+                )
+                payload = {"mimeType": "text/html", "headers": [{"name": "Content-Type", "value": "text/html; charset=utf-8"}]}
+                payload["body"] = _part("text/html", markup)["body"]
+            elif style == 2:
+                plain = f"Bonjour à tous,\n{body}\n\n-- \n{sender}\nDépartement d'Économie\nTél. +33 1 23 45 67 89\n\n-----Original Message-----\n{history}"
+                payload = {"mimeType": "multipart/mixed", "parts": [_part("text/plain", plain, "ISO-8859-1")]}
+            else:
+                plain = f"{body}\n\nSent from my iPhone\n\nOn {date}, Previous wrote:\n\n{history}"
+                payload = {"mimeType": "multipart/alternative", "parts": [_part("text/plain", plain)]}
+            payload["headers"] = payload.get("headers", []) + [
+                {"name": "From", "value": f"{sender} <s{r}@example.com>"},
+                {"name": "Date", "value": date},
+                {"name": "Subject", "value": f"Re: {topic}"},
+            ]
+            messages.append({"id": f"c{t:04x}{r:04x}", "threadId": f"c{t:04x}", "payload": payload})
+            history = f"{body}\n{history}"
+    return messages
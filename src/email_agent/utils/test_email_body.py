@@ -0,0 +1,79 @@
+import base64
+
+from .email_body import decode_part_data, html_to_text, normalize_body, select_body, strip_signature
+from .fake_gmail import _DISCLAIMER, _part, sample_corpus
+
+FORWARD = (
+    "Subject: Re: budget\n\n"
+    "---------- Forwarded message ---------\n"
+    "From: Bob <bob@columbia.edu>\n"
+    "The committee approved the budget for next year."
+)
+
+
+def test_signature_is_stripped():
+    assert normalize_body("See you at 3pm.\n\n-- \nAlice Smith\nDept. of Physics\n") == "See you at 3pm."
+    assert normalize_body("On my way.\n\nSent from my iPhone") == "On my way."
+
+
+def test_signature_before_forwarded_message_keeps_the_forward():
+    body = normalize_body("FYI\n\n-- \nAlice\n\n" + FORWARD)
+    assert body.startswith("FYI\n")
+    assert "Alice" not in body
+    assert "The committee approved the budget for next year." in body
+
+
+def test_forwarded_message_keeps_its_text_after_its_own_signature():
+    body = strip_signature("FYI\n\n" + FORWARD + "\n-- \nBob\n")
+    assert body.endswith("The committee approved the budget for next year.")
+
+
+def test_dash_line_inside_body_is_not_a_signature():
+    assert normalize_body("Agenda:\n-- \nitem one") == "Agenda:\n-- \nitem one"
+    long_block = "\n".join(f"point {i}" for i in range(10))
+    assert normalize_body(f"Notes\n--\n{long_block}").endswith("point 9")
+
+
+def test_quoted_reply_history_is_dropped():
+    body = "Sounds good.\n\nOn Mon, 1 Jul 2024, Bob <bob@columbia.edu> wrote:\n> Shall we meet?\n> Bob"
+    assert normalize_body(body) == "Sounds good."
+
+
+def test_quote_only_reply_is_kept():
+    body = "On Mon, 1 Jul 2024, Bob <bob@columbia.edu> wrote:\n> Shall we meet on Friday?"
+    assert "Shall we meet on Friday?" in normalize_body(body)
+
+
+def test_original_message_block_is_kept():
+    body = "See below.\n\n-----Original Message-----\nFrom: Bob\nSent: Monday\nThe grant report is due."
+    assert normalize_body(body).endswith("The grant report is due.")
+
+
+def test_footer_is_dropped():
+    assert normalize_body(f"Room 301 is booked.\n\n{_DISCLAIMER}") == "Room 301 is booked."
+
+
+def test_html_quote_is_dropped_but_forward_is_kept():
+    reply = '<p>Agreed.</p><div class="gmail_quote">On Monday Bob wrote:<blockquote>old text</blockquote></div>'
+    assert html_to_text(reply) == "Agreed."
+    forward = '<p>FYI</p><div class="gmail_quote">---------- Forwarded message ---------<br>new text</div>'
+    assert "new text" in html_to_text(forward)
+
+
+def test_select_body_prefers_plain_text_and_skips_attachments():
+    attachment = {**_part("text/plain", "attached file"), "filename": "notes.txt"}
+    payload = {"mimeType": "multipart/mixed", "parts": [attachment, _part("text/html", "<p>html</p>"), _part("text/plain", "plain")]}
+    assert select_body(payload) == "plain"
+    assert select_body({"mimeType": "multipart/alternative", "parts": [_part("text/html", "<p>only <b>html</b></p>")]}) == "only html"
+
+
+def test_declared_and_mislabelled_charsets_are_decoded():
+    assert select_body(_part("text/plain", "Département d'Économie", "ISO-8859-1")) == "Département d'Économie"
+    mislabelled = base64.urlsafe_b64encode("café".encode("cp1252")).decode("ascii")
+    assert decode_part_data(mislabelled, "us-ascii") == "café"
+
+
+def test_sample_corpus_is_normalized():
+    bodies = [normalize_body(select_body(message["payload"]) or "") for message in sample_corpus(n_threads=4)]
+    assert all(bodies)
+    assert not any("CONFIDENTIALITY NOTICE" in body or "Sent from my iPhone" in body for body in bodies)
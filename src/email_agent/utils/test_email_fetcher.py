@@ -0,0 +1,74 @@
+import builtins
+import time
+
+import pytest
+
+from . import email_fetcher
+from .email_fetcher import save_sync_state, sync, sync_settings
+from .fake_gmail import FakeGmailService
+
+
+def _message(message_id: str, sender: str, internal_date: int = 1720000000000) -> dict:
+    headers = [{"name": "From", "value": sender}, {"name": "Subject", "value": "Lab schedule"}]
+    return {"id": message_id, "threadId": f"t{message_id}", "internalDate": str(internal_date), "payload": {"headers": headers}}
+
+
+@pytest.fixture(autouse=True)
+def sync_state(tmp_path, monkeypatch):
+    monkeypatch.setattr(email_fetcher, "SYNC_STATE", tmp_path / "sync_state.json")
+    monkeypatch.delenv("SYNC_MAX_RESULTS", raising=False)
+    monkeypatch.delenv("SYNC_QUERY", raising=False)
+
+    # sync may run on the ingest thread, so it must never ask the user anything
+    def no_prompt(prompt=""):
+        raise AssertionError(f"unexpected prompt: {prompt}")
+
+    monkeypatch.setattr(builtins, "input", no_prompt)
+    return tmp_path / "sync_state.json"
+
+
+@pytest.fixture
+def service():
+    messages = [_message(f"m{i}", f"Prof {i} <p{i}@columbia.edu>") for i in range(4)]
+    return FakeGmailService(messages + [_message("x0", "News <news@example.com>")])
+
+
+def test_full_sync_returns_the_state_without_saving_it(service, sync_state):
+    added, deleted, state = sync(service, max_results=10)
+    assert sorted(message["id"] for message in added) == ["m0", "m1", "m2", "m3"]
+    assert deleted == []
+    assert state["history_id"] == "1" and state["query"] == email_fetcher.DEFAULT_QUERY
+    # Saving is left to the caller, once the added emails are stored
+    assert not sync_state.exists()
+
+
+def test_settings_come_from_the_environment_then_the_saved_state(monkeypatch):
+    assert sync_settings() == (10, email_fetcher.DEFAULT_QUERY)
+    save_sync_state({"max_results": 5, "query": "from:*@cs.columbia.edu"})
+    assert sync_settings() == (5, "from:*@cs.columbia.edu")
+    monkeypatch.setenv("SYNC_MAX_RESULTS", "50")
+    assert sync_settings() == (50, "from:*@cs.columbia.edu")
+    assert sync_settings(max_results=3, query="subject:grant") == (3, "subject:grant")
+
+
+def test_incremental_sync_applies_the_saved_query(service):
+    _, _, state = sync(service, max_results=10)
+    save_sync_state(state)
+    now = int(time.time() * 1000)
+    service.add_message(_message("m4", "Dean <dean@columbia.edu>", now))
+    service.add_message(_message("x1", "Shop <deals@example.com>", now))
+    service.delete_message("m1")
+    added, deleted, state = sync(service)
+    assert [message["id"] for message in added] == ["m4"]
+    assert deleted == ["m1"]
+    assert state["history_id"] == str(service.history_id)
+
+
+def test_expired_history_reports_known_emails_that_are_gone(service):
+    _, _, state = sync(service, max_results=10)
+    save_sync_state(state)
+    service.delete_message("m2")
+    service.expire_history()
+    added, deleted, _ = sync(service, known_ids=["m0", "m1", "m2", "m3"])
+    assert "m2" not in {message["id"] for message in added}
+    assert deleted == ["m2"]
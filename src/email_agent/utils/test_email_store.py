@@ -0,0 +1,38 @@
+from .email_sample import EmailSample
+from .email_store import EmailStore
+
+
+def _email(email_id: str, sender: str = "Alice <alice@columbia.edu>", date: str = "Mon, 1 Jul 2024 10:00:00 +0000") -> EmailSample:
+    return EmailSample(
+        id=email_id, thread_id=f"t{email_id}", subject="Lab schedule", sender=sender, receiver="me@columbia.edu", date=date, content="See you at 3pm."
+    )
+
+
+def test_emails_round_trip_and_lookups(tmp_path):
+    store = EmailStore(tmp_path / "emails.db")
+    assert store.add_many([_email("a"), _email("b", "Bob <bob@columbia.edu>", "Fri, 5 Jul 2024 10:00:00 +0000")]) == 2
+    assert len(store) == 2 and "a" in store
+    assert store.get("a").content == "See you at 3pm."
+    assert [email.id for email in store.by_sender("Bob <bob@columbia.edu>")] == ["b"]
+    assert store.missing_ids(["a", "c"]) == ["c"]
+    store.close()
+    assert sorted(EmailStore(tmp_path / "emails.db").ids()) == ["a", "b"]
+
+
+def test_deleting_leaves_tombstones_until_cleared(tmp_path):
+    store = EmailStore(tmp_path / "emails.db")
+    store.add_many([_email("a"), _email("b")])
+    store.delete(["a"])
+    assert "a" not in store and store.tombstones() == ["a"]
+    store.clear_tombstones(["a"])
+    assert store.tombstones() == []
+
+
+def test_pending_messages_are_cleared_once_stored_or_deleted(tmp_path):
+    store = EmailStore(tmp_path / "emails.db")
+    store.add_pending([{"id": "a", "threadId": "ta"}, {"id": "b", "threadId": "tb"}, {"id": "c", "threadId": "tc"}])
+    # Listing the same message again does not queue it twice
+    store.add_pending([{"id": "a", "threadId": "ta"}])
+    store.add_many([_email("a")])
+    store.delete(["b"])
+    assert store.pending() == [{"id": "c", "threadId": "tc"}]